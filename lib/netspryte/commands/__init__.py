@@ -17,12 +17,32 @@
 # 02110-1301, USA.
 
 import netspryte
+import os
 import sys
+import time
+import zlib
+import heapq
+import queue
+import signal
 import logging
+import threading
 import argparse
+import datetime
+import traceback
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
+import netspryte.snmp
+import netspryte.snmp.store
+import netspryte.utils.stats
 from netspryte import constants as C
 from netspryte.utils import *
+import netspryte.utils.timer
+import netspryte.utils.profile
+from netspryte.utils.timer import Timer
+from netspryte.errors import NetspryteError, NetspryteTimeout
+from netspryte.manager import Manager, IdentityMap, MeasurementInstance, MeasurementClass, Host
 
 class BaseCommand(object):
 
@@ -37,15 +57,817 @@ class BaseCommand(object):
                                  help='Path to data directory')
         self.parser.add_argument('--nofork', default=False, action='store_true',
                                  help='Do not fork; useful for debugging')
-
-    def daemonize(self):
-        pass
+        self.parser.add_argument('--profile', nargs='?', const=C.DEFAULT_PROFILEDIR, default=None,
+                                 metavar='DIR',
+                                 help='Profile this process and each worker, writing profiles to DIR')
+        self.parser.add_argument('--profile-mode', choices=netspryte.utils.profile.PROFILE_MODES,
+                                 default=C.DEFAULT_PROFILE_MODE,
+                                 help='Profile by sampling stacks (low overhead) or with cProfile')
 
     def execute(self):
-        if self.daemonize:
-            return self._daemonize()
+        args, unknown = self.parser.parse_known_args()
+        if args.profile:
+            netspryte.utils.profile.configure(args.profile, args.profile_mode)
+        try:
+            with netspryte.utils.profile.profiled("%s-main" % self.parser.prog):
+                return self.run()
+        except NetspryteError as e:
+            logging.error("%s", e.message)
+            return 1
+        except KeyboardInterrupt:
+            print()
+
+
+class SampleBatch(object):
+    '''
+    The measurement instances a snmp module found on a device, detached
+    from the module so they can be handed to the storage stages while the
+    next module polls.  Has the attributes of the module that storing the
+    data needs, and the span of the module, which storage spans belong to.
+    '''
+
+    def __init__(self, snmp_mod, span=None):
+        self.NAME = snmp_mod.NAME
+        self.DESCRIPTION = getattr(snmp_mod, 'DESCRIPTION', None)
+        self.XLATE = getattr(snmp_mod, 'XLATE', dict())
+        self.data = snmp_mod.data
+        self.timestamp = int(time.time())
+        self.instances = list()
+        self.span = span
+
+
+class Stage(threading.Thread):
+    '''
+    A step of a Pipeline.  func is called with each item put on the stage;
+    if it returns something other than None, that is put on each of the
+    target stages.  The queue in front of a stage is bounded, so a stage
+    that falls behind blocks the stages feeding it rather than letting
+    work pile up.
+    '''
+
+    def __init__(self, name, func, targets=None, depth=C.DEFAULT_PIPELINE_DEPTH):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.func = func
+        self.targets = targets or list()
+        self.queue = queue.Queue(maxsize=depth)
+
+    def process(self, item):
+        ''' run func on item and pass the result on to the targets '''
+        try:
+            result = self.func(item)
+        except Exception as e:
+            logging.error("stage %s failed: %s", self.name, traceback.format_exc())
+            return
+        if result is not None:
+            for target in self.targets:
+                target.put(result)
+
+    def put(self, item):
+        ''' queue item for the stage, or process it now if the stage is not running '''
+        if self.is_alive():
+            self.queue.put(item)
+        else:
+            self.process(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.process(item)
+        for target in self.targets:
+            target.stop()
+
+    def stop(self):
+        ''' finish the queued items, stop the stage and then its targets '''
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
+class Pipeline(object):
+    '''
+    A tree of stages that items enter at the first stage.  If threaded,
+    each stage runs in its own thread so polling, catalog updates and
+    backend writes overlap; otherwise each item passes through every stage
+    before put() returns.
+    '''
+
+    def __init__(self, first, threaded=C.DEFAULT_PIPELINE):
+        self.first = first
+        self.threaded = threaded
+
+    def stages(self):
+        ''' return all stages of the pipeline '''
+        result = list()
+        pending = [self.first]
+        while pending:
+            stage = pending.pop(0)
+            result.append(stage)
+            pending.extend(stage.targets)
+        return result
+
+    def start(self):
+        if self.threaded:
+            for stage in self.stages():
+                stage.start()
+
+    def put(self, item):
+        self.first.put(item)
+
+    def stop(self):
+        ''' wait for queued items to pass through and stop the stages '''
+        self.first.stop()
+
+
+@contextlib.contextmanager
+def time_limit(seconds, session=None):
+    '''
+    Raise NetspryteTimeout in the block if it runs longer than seconds.
+    This interrupts calls that hang, such as pysnmp waiting on a device,
+    but relies on SIGALRM and so only applies in the main thread.  The
+    queries of session, if given, are also given the deadline, which is
+    how the threads polling with asyncio are limited.
+    '''
+    if not seconds:
+        yield
+        return
+    if session is not None:
+        session.deadline = time.time() + seconds
+    try:
+        if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+            with _alarm(seconds):
+                yield
+        else:
+            yield
+    finally:
+        if session is not None:
+            session.deadline = None
+
+
+@contextlib.contextmanager
+def _alarm(seconds):
+    def expired(signum, frame):
+        raise NetspryteTimeout("time limit of %.1f seconds exceeded" % seconds)
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class SerializedCatalog(object):
+    '''
+    The catalog lookups of a Manager, made while holding lock.  Lets the
+    modules polling in several threads, as with asyncio, share a worker's
+    Manager with each other and with its catalog stage.
+    '''
+
+    def __init__(self, mgr, lock):
+        self.mgr = mgr
+        self.lock = lock
+
+    def get_instances_by_host_and_class(self, host, cls):
+        with self.lock:
+            return self.mgr.get_instances_by_host_and_class(host, cls)
+
+    def get_instances_by_tags(self, tags):
+        with self.lock:
+            return self.mgr.get_instances_by_tags(tags)
+
+
+class CycleStats(object):
+    '''
+    Counts of the time budgets missed during a collection cycle, shared
+    by all the worker processes of a WorkerPool.
+    '''
+
+    FIELDS = ('devices_over_budget', 'modules_skipped', 'modules_timed_out', 'workers_killed')
+
+    def __init__(self):
+        self._values = dict((k, multiprocessing.Value('i', 0)) for k in CycleStats.FIELDS)
+
+    def incr(self, name, n=1):
+        with self._values[name].get_lock():
+            self._values[name].value += n
+
+    def as_dict(self):
+        return dict((k, v.value) for k, v in list(self._values.items()))
+
+
+class BaseWorker(multiprocessing.Process):
+    '''
+    Base class for workers that query devices with the SNMP plugin modules.
+    A worker either runs as its own process, pulling devices from a task queue,
+    or has process_device() called directly, as the asyncio mode does.
+    '''
+
+    NAME = "snmp"
+
+    def __init__(self, task_queue=None, modules=None, snmp_session=netspryte.snmp.SNMPSession):
+        multiprocessing.Process.__init__(self)
+        self.task_queue = task_queue
+        self.modules = modules or dict()
+        self.snmp_session = snmp_session
+        self.sessions = dict()    # device -> snmp session, kept across cycles
+        self.identity = IdentityMap()
+        self.pipeline = None
+        self.mgr = None
+        self.db_lock = threading.RLock()    # held while using mgr and identity
+        self.stats = CycleStats()
+        self.done_queue = None    # queue to put each device on once it is polled, if any
+        self.deadline = None    # time by which the cycle must be done, if any
+        self.device_budget = None    # seconds each device may take, if limited
+        self.module_budget = None    # seconds each module may take, if limited
+
+    def open(self):
+        ''' connect to the database and start the storage pipeline '''
+        netspryte.utils.stats.bind("%s-%s" % (self.NAME, self.name))
+        self.mgr = Manager()
+        self.pipeline = self.mk_pipeline()
+        self.pipeline.start()
+
+    def close(self):
+        ''' wait for the storage pipeline to drain and disconnect from the database '''
+        self.pipeline.stop()
+        self.mgr.close()
+        netspryte.utils.stats.save()
+        netspryte.utils.timer.export("%s-%s" % (self.NAME, self.name))
+
+    def mk_pipeline(self):
+        ''' return the pipeline that module data is stored through after polling '''
+        return Pipeline(Stage("catalog", self.store_batch))
+
+    def store_batch(self, batch):
+        ''' catalog stage: update the database and pass on the instances that have metrics '''
+        start = time.time()
+        with self.db_lock:
+            batch.instances = self.process_module_data(batch)
+        netspryte.utils.stats.histogram("db_write_seconds", "Time taken to store a module's data").observe(
+            time.time() - start, stage="catalog")
+        if batch.instances:
+            return batch
+        return None
+
+    def run(self):
+        if self.done_queue is not None:
+            # devices put on the queue are of no use once the pool stops, so
+            # do not wait at exit for them to be read
+            self.done_queue.cancel_join_thread()
+        with netspryte.utils.profile.profiled("%s-%s" % (self.NAME, self.name)):
+            self.open()
+            proc_name = self.name
+            while True:
+                task = self.task_queue.get()
+                if task is None:
+                    logging.info("worker %s exiting", proc_name)
+                    self.task_queue.task_done()
+                    break
+                self.run_task(*task)
+                self.task_queue.task_done()
+            self.close()
+        return
+
+    def run_task(self, device, names=None):
+        ''' process a device handed out by a WorkerPool and report back that it is done '''
+        try:
+            self.process_device(device, names)
+        finally:
+            if self.done_queue is not None:
+                self.done_queue.put(device)
+
+    def mk_context(self, device):
+        ''' return the collection context shared by all modules for a device '''
+        if device not in self.sessions:
+            self.sessions[device] = self.snmp_session(host=device)
         else:
+            self.sessions[device].start_cycle()
+        return netspryte.snmp.CollectionContext(self.sessions[device])
+
+    @staticmethod
+    def skip_module(cls):
+        ''' return True if the module should not be run against devices '''
+        return False
+
+    def module_applies(self, cls, msnmp):
+        ''' return True if the module applies to the device, going by its capability profile '''
+        if not C.DEFAULT_SNMP_PROFILE or msnmp.profile.applies(cls):
+            return True
+        logging.info("skipping module %s that does not apply to %s", cls.NAME, msnmp.host)
+        return False
+
+    def time_left(self, device_start):
+        '''
+        Return the seconds the next module may run on a device polled since
+        device_start, or None if there is no limit.  This is the smallest
+        of the module budget and what is left of the device budget and of
+        the cycle.
+        '''
+        now = time.time()
+        limits = list()
+        if self.module_budget:
+            limits.append(self.module_budget)
+        if self.device_budget:
+            limits.append(device_start + self.device_budget - now)
+        if self.deadline:
+            limits.append(self.deadline - now)
+        if not limits:
+            return None
+        return min(limits)
+
+    def process_device(self, device, names=None):
+        '''
+        Run the snmp modules against a device and process the results.
+        If names is given, only the modules with those NAMEs are run.
+        Modules stop being run once the device is out of time; the data
+        of the modules already run is still stored.
+        '''
+        t = Timer("%s %s worker" % (device, self.NAME), "device", device=device)
+        t.start_timer()
+        logging.warn("processing %s%s", device, " modules %s" % ", ".join(names) if names else "")
+        history = netspryte.snmp.store.get_task_history()
+        device_start = time.time()
+        try:
+            msnmp = self.mk_context(device)
+            classes = [cls for cls in self.modules if names is None or cls.NAME in names]
+            for i, cls in enumerate(classes):
+                if not msnmp.reachable:
+                    logging.warn("skipping remaining modules for unresponsive device %s", device)
+                    break
+                budget = self.time_left(device_start)
+                if budget is not None and budget <= 0:
+                    logging.error("%s is out of time; skipping modules %s", device,
+                                  ", ".join(c.NAME for c in classes[i:]))
+                    self.stats.incr('devices_over_budget')
+                    self.stats.incr('modules_skipped', len(classes) - i)
+                    break
+                if self.skip_module(cls) or not self.module_applies(cls, msnmp):
+                    continue
+                if C.DEFAULT_SNMP_PROFILE and msnmp.profile.device_class:
+                    # aggregate the spans of each kind of device apart
+                    t.category = "device/%s" % msnmp.profile.device_class
+                start = time.time()
+                try:
+                    with Timer("%s %s" % (device, cls.NAME), "module/%s" % cls.NAME, log=False,
+                               module=cls.NAME) as span:
+                        with time_limit(budget, msnmp.snmp):
+                            snmp_mod = msnmp.module(cls)
+                        if snmp_mod and hasattr(snmp_mod, 'data') and snmp_mod.data:
+                            self.pipeline.put(SampleBatch(snmp_mod, span))
+                except NetspryteTimeout as e:
+                    logging.error("module %s stopped against device %s: %s", cls.NAME, device, str(e))
+                    self.stats.incr('modules_timed_out')
+                    netspryte.utils.stats.counter("collector_module_timeouts",
+                                                  "Modules stopped for running out of time").inc(
+                        device=device, module=cls.NAME)
+                except Exception as e:
+                    logging.error("module %s failed against device %s: %s", cls.__name__, device, traceback.format_exc())
+                elapsed = time.time() - start
+                netspryte.utils.stats.histogram("collector_module_seconds", "Time taken to poll a module").observe(
+                    elapsed, device=device, module=cls.NAME)
+                if history is not None:
+                    history.record(device, cls.NAME, elapsed)
+            logging.debug("snmp cache for %s: %s", device, msnmp.cache.stats)
+        except Exception as e:
+            logging.error("encountered error with %s; skipping to next device: %s", device, traceback.format_exc())
+        finally:
+            t.stop_timer()
+            netspryte.utils.stats.histogram("collector_device_seconds", "Time taken to poll a device").observe(
+                t.elapsed, device=device)
+            netspryte.utils.stats.save(C.DEFAULT_STATS_INTERVAL)
+            netspryte.utils.timer.export("%s-%s" % (self.NAME, self.name), interval=C.DEFAULT_STATS_INTERVAL)
+
+    def get_host(self, name):
+        ''' return the Host row for name, looking it up once per worker '''
+        entry = self.identity.get(Host, name)
+        if entry is None:
+            host = self.mgr.get_or_create(Host, name=name)
+            if host is None:
+                return None
+            entry = self.identity.put(Host, name, host.id, obj=host)
+        return entry['obj']
+
+    def get_measurement_class(self, name, transport):
+        ''' return the MeasurementClass row for name and transport, looking it up once per worker '''
+        entry = self.identity.get(MeasurementClass, (name, transport))
+        if entry is None:
+            cls = self.mgr.get_or_create(MeasurementClass, name=name, transport=transport)
+            if cls is None:
+                return None
+            entry = self.identity.put(MeasurementClass, (name, transport), cls.id, obj=cls)
+        return entry['obj']
+
+    def process_module_data(self, snmp_mod):
+        '''
+        Update the database with the measurement instances found by a module.
+        Only fields that changed since this worker last wrote them are
+        written; instances that did not change just have lastseen updated.
+        Metrics go to the LatestMetric table rather than the instance.
+        Returns the list of measurement instances that have metrics.
+        '''
+        these_insts = list()
+        metric_types = dict()
+        if not snmp_mod.data:
+            return these_insts
+        t = Timer("database", "database", parent=getattr(snmp_mod, 'span', None))
+        t.start_timer()
+        now = datetime.datetime.now()
+        data = snmp_mod.data[0]
+        this_host = self.get_host(data['host'])
+        this_class = self.get_measurement_class(data['class'], data['transport'])
+        if this_host is None or this_class is None:
+            logging.error("encountered database error; skipping %s data", snmp_mod.NAME)
+            t.stop_timer()
+            return these_insts
+        t.set(host=this_host.name, cls=this_class.name)
+        logging.info("updating database for %s %s", this_host.name, this_class.name)
+        if hasattr(snmp_mod, 'DESCRIPTION') and not this_class.description:
+            this_class.description = snmp_mod.DESCRIPTION
+        rows = list()
+        touched = list()
+        samples = dict()
+        for data in snmp_mod.data:
+            fields = dict(attrs=json_ready(data['attrs']))
+            if 'presentation' in data:
+                fields['presentation'] = json_ready(data['presentation'])
+            if 'metrics' in data:
+                samples[data['name']] = data['metrics']
+                if not metric_types:
+                    for k, v in list(data['metrics'].items()):
+                        metric_types[k] = netspryte.snmp.get_value_type(v)
+                    this_class.metric_type = json_ready(metric_types)
+            entry = self.identity.get(MeasurementInstance, data['name'])
+            changed = self.identity.changed(MeasurementInstance, data['name'], fields)
+            if entry is not None and 'presentation' in entry['hashes'] and 'presentation' in changed:
+                # presentation is only ever set once
+                changed.remove('presentation')
+            if entry is not None and not changed:
+                touched.append(entry['id'])
+            else:
+                row = dict(name=data['name'], index=data['index'], host=this_host,
+                           measurement_class=this_class, lastseen=now)
+                for name in changed:
+                    row[name] = fields[name]
+                rows.append(row)
+            if data.get('metrics'):
+                these_insts.append(MeasurementInstance(name=data['name'], index=data['index'],
+                                                       host=this_host, measurement_class=this_class,
+                                                       lastseen=now, metrics=json_ready(data['metrics']),
+                                                       **fields))
+        ids = self.mgr.bulk_upsert(MeasurementInstance, rows, fill=('presentation',))
+        for row in rows:
+            if row['name'] in ids:
+                written = dict((k, row[k]) for k in ('attrs', 'presentation') if k in row)
+                self.identity.put(MeasurementInstance, row['name'], ids[row['name']], written)
+        for inst in these_insts:
+            entry = self.identity.get(MeasurementInstance, inst.name)
+            if entry is not None:
+                inst.id = entry['id']
+        these_insts = [inst for inst in these_insts if inst.id is not None]
+        latest = dict()
+        for inst in these_insts:
+            latest[inst.id] = dict((k, netspryte.snmp.get_metric_value(v))
+                                   for k, v in list(samples[inst.name].items()))
+        self.mgr.write_latest_metrics(latest, now)
+        if touched and self.mgr.update_by_id(MeasurementInstance, touched, lastseen=now) < len(touched):
+            logging.warn("measurement instances of %s disappeared from the database; rewriting them next cycle",
+                         this_host.name)
+            self.identity.forget(MeasurementInstance)
+        logging.info("wrote %s and touched %s %s instances of %s", len(rows), len(touched),
+                     this_class.name, this_host.name)
+        self.mgr.update_by_id(Host, [this_host.id], lastseen=now)
+        class_fields = dict(description=this_class.description, metric_type=this_class.metric_type)
+        if self.identity.changed(MeasurementClass, (this_class.name, this_class.transport), class_fields):
+            self.mgr.save(this_class)
+            self.identity.put(MeasurementClass, (this_class.name, this_class.transport),
+                              this_class.id, class_fields)
+        logging.info("done updating database for %s %s", this_host.name, this_class.name)
+        t.stop_timer()
+        return these_insts
+
+
+class WorkerPool(object):
+    '''
+    A set of workers that devices are handed to with submit().
+    By default, devices are handed out over a queue to num_workers processes.
+    With use_asyncio, a single worker in this process polls up to
+    C.DEFAULT_SNMP_CONCURRENCY devices at once over a shared asyncio engine.
+    If deadline is given, the devices must be processed within that many
+    seconds of start(); workers still running C.DEFAULT_CYCLE_GRACE seconds
+    after the deadline are killed.
+    A device is not handed out again while it is still being polled; see
+    in_flight and finished().
+    Any other keyword arguments are passed on to worker_cls.
+    '''
+
+    def __init__(self, worker_cls, modules, num_workers, use_asyncio=False, deadline=None, **kwargs):
+        self.worker_cls = worker_cls
+        self.modules = modules
+        self.num_workers = num_workers
+        self.use_asyncio = use_asyncio
+        self.deadline = deadline
+        self.kwargs = kwargs
+        self.workers = list()
+        self.task_queue = None
+        self.done_queue = None
+        self.in_flight = dict()    # device -> time it was handed out
+        self.stats = CycleStats()
+        self.started = None
+        self._engine = None
+        self._executor = None
+
+    def _setup_worker(self, worker):
+        worker.stats = self.stats
+        worker.done_queue = self.done_queue
+        if self.deadline:
+            worker.deadline = self.started + self.deadline
+        return worker
+
+    def start(self):
+        ''' start the workers '''
+        self.started = time.time()
+        if self.use_asyncio:
             try:
-                return self.run()
-            except KeyboardInterrupt:
-                print()
+                import netspryte.snmp.aio
+            except (ImportError, AttributeError) as e:
+                # pysnmp 4.4 builds its asyncio API on asyncio.coroutine, gone in Python 3.11
+                raise NetspryteError("polling with asyncio needs pysnmp 4.4 on Python 3.10 or earlier: %s" % e)
+            self.done_queue = queue.Queue()
+            logging.warn("polling devices with asyncio and concurrency %s", C.DEFAULT_SNMP_CONCURRENCY)
+            self._engine = netspryte.snmp.aio.AsyncSNMPEngine(C.DEFAULT_SNMP_CONCURRENCY)
+            self._engine.start()
+            worker = self._setup_worker(self.worker_cls(modules=self.modules, snmp_session=self._engine.session,
+                                                        **self.kwargs))
+            worker.open()
+            self.workers = [worker]
+            self._executor = ThreadPoolExecutor(max_workers=C.DEFAULT_SNMP_CONCURRENCY)
+            return
+        self.task_queue = multiprocessing.JoinableQueue()
+        self.done_queue = multiprocessing.Queue()
+        logging.info("creating %s workers", self.num_workers)
+        self.workers = [self._setup_worker(self.worker_cls(self.task_queue, self.modules, **self.kwargs))
+                        for i in range(self.num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, device, names=None):
+        ''' hand a device to the workers, to be polled by the modules in names or by all modules '''
+        self.in_flight[device] = time.time()
+        if self.use_asyncio:
+            self._executor.submit(self.workers[0].run_task, device, names)
+        else:
+            self.task_queue.put((device, names))
+
+    def finished(self):
+        ''' return the devices whose polls finished since the last call, and stop tracking them '''
+        devices = list()
+        while True:
+            try:
+                device = self.done_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.in_flight.pop(device, None)
+            devices.append(device)
+        return devices
+
+    def busy(self, device):
+        '''
+        Return True if device is still being polled.  A poll running longer
+        than the cycle deadline and grace is presumed lost with its worker.
+        '''
+        if device not in self.in_flight:
+            return False
+        if time.time() - self.in_flight[device] < C.DEFAULT_CYCLE_DEADLINE + C.DEFAULT_CYCLE_GRACE:
+            return True
+        logging.error("poll of %s handed out at %s never finished; polling it again",
+                      device, time.ctime(self.in_flight[device]))
+        return False
+
+    def submit_all(self, devices):
+        '''
+        hand devices to the workers with the modules to run on each, longest
+        first; devices still being polled are skipped until their next turn
+        '''
+        self.finished()
+        busy = [device for device in devices if self.busy(device)]
+        if busy:
+            logging.warn("skipping devices still being polled: %s", ", ".join(busy))
+            netspryte.utils.stats.counter("collector_polls_skipped",
+                                          "Polls skipped because the previous poll had not finished").inc(len(busy))
+            devices = [device for device in devices if device not in busy]
+        modules = [cls for cls in self.modules if not self.worker_cls.skip_module(cls)]
+        for device, names in mk_tasks(devices, modules):
+            self.submit(device, names)
+
+    def join(self):
+        ''' wait for submitted devices to be processed and stop the workers '''
+        if self.use_asyncio:
+            self._executor.shutdown(wait=True)
+            self.workers[0].close()
+            self._engine.stop()
+            self.report()
+            return
+        # add poison pill to queue
+        for i in range(self.num_workers):
+            self.task_queue.put(None)
+        for w in self.workers:
+            if not self.deadline:
+                w.join()
+                continue
+            w.join(max(0, self.started + self.deadline + C.DEFAULT_CYCLE_GRACE - time.time()))
+            if w.is_alive():
+                logging.error("worker %s is still running %s seconds past the deadline; killing it",
+                              w.name, C.DEFAULT_CYCLE_GRACE)
+                w.terminate()
+                w.join()
+                self.stats.incr('workers_killed')
+        self.report()
+
+    def report(self):
+        '''
+        Log how the cycle kept to its time budgets and record it in
+        cycle.json in the snmp state directory.
+        '''
+        if not self.deadline:
+            return
+        elapsed = time.time() - self.started
+        stats = self.stats.as_dict()
+        stats.update(started=int(self.started), elapsed=round(elapsed, 3), deadline=self.deadline,
+                     overrun=round(max(0, elapsed - self.deadline), 3))
+        netspryte.utils.stats.bind("%s-main" % self.worker_cls.NAME)
+        netspryte.utils.stats.gauge("collector_cycle_seconds", "Time taken by the last cycle").set(elapsed)
+        netspryte.utils.stats.gauge("collector_cycle_overrun_seconds",
+                                    "Time the last cycle ran past its deadline").set(stats['overrun'])
+        netspryte.utils.stats.counter("collector_cycles", "Collection cycles run").inc()
+        if stats['overrun']:
+            netspryte.utils.stats.counter("collector_cycle_overruns", "Cycles that missed their deadline").inc()
+        for k in CycleStats.FIELDS:
+            netspryte.utils.stats.counter("collector_%s" % k).inc(stats[k])
+        netspryte.utils.stats.save()
+        if stats['overrun'] or any(stats[k] for k in CycleStats.FIELDS):
+            logging.error("collection cycle took %.1f seconds of its %s second deadline: %s",
+                          elapsed, self.deadline,
+                          ", ".join("%s %s" % (stats[k], k.replace('_', ' ')) for k in CycleStats.FIELDS))
+        else:
+            logging.info("collection cycle took %.1f seconds of its %s second deadline", elapsed, self.deadline)
+        json2path(stats, os.path.join(C.DEFAULT_SNMP_STATEDIR, "cycle.json"))
+
+
+def run_workers(worker_cls, devices, modules, num_workers, use_asyncio=False, deadline=None, **kwargs):
+    ''' process devices once with a WorkerPool of worker_cls, within deadline seconds if given '''
+    pool = WorkerPool(worker_cls, modules, num_workers, use_asyncio, deadline, **kwargs)
+    pool.start()
+    pool.submit_all(devices)
+    pool.join()
+
+
+def mk_tasks(devices, modules):
+    '''
+    Return a (device, module NAMEs) task for each device, ordered by how
+    long polling the device took before so the longest tasks start first
+    and no worker is left with a big device at the end of the cycle.
+    Devices never timed go first, since nothing is known about them.
+    All the modules of a device go in one task, so a single worker polls
+    it with one collection context and device state.  Modules the saved
+    capability profile of a device rules out are left out.
+    '''
+    history = netspryte.snmp.store.get_task_history()
+    durations = history.durations() if history is not None else dict()
+    tasks = list()
+    for device in devices:
+        names = [cls.NAME for cls in modules if module_may_apply(cls, device)]
+        if not names:
+            logging.info("no modules apply to %s", device)
+            continue
+        elapsed = [durations[(device, name)] for name in names if (device, name) in durations]
+        estimate = sum(elapsed) if elapsed else float('inf')
+        tasks.append((estimate, device, names))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    logging.info("created %s tasks for %s devices", len(tasks), len(devices))
+    return [(device, names) for estimate, device, names in tasks]
+
+
+def module_may_apply(cls, device):
+    ''' return False if the saved capability profile of device rules out the snmp module cls '''
+    if not C.DEFAULT_SNMP_PROFILE:
+        return True
+    return netspryte.snmp.DeviceProfile(None, netspryte.snmp.DeviceState.for_host(device)).applies(cls, probe=False)
+
+
+class Scheduler(object):
+    '''
+    Decide when each device is next due to be polled.
+
+    A device is polled once every interval minutes, the interval of its
+    Host record.  Within the interval each device is given a fixed offset
+    derived from its name, which spreads devices across the step and keeps
+    their phase the same across restarts.
+    '''
+
+    def __init__(self, devices, interval=C.DEFAULT_INTERVAL):
+        self.intervals = dict((device, interval) for device in devices)
+        self._queue = list()   # heap of (due, device)
+        now = time.time()
+        for device in devices:
+            heapq.heappush(self._queue, (self._next_due(device, now), device))
+
+    def step(self, device):
+        ''' return the polling interval of device in seconds '''
+        return max(1, self.intervals[device]) * 60
+
+    def offset(self, device):
+        ''' return the offset of device within its interval in seconds '''
+        return zlib.crc32(device.encode('utf-8')) % self.step(device)
+
+    def _next_due(self, device, now):
+        step = self.step(device)
+        due = now - (now % step) + self.offset(device)
+        if due <= now:
+            due += step
+        return due
+
+    def set_interval(self, device, interval):
+        ''' change the interval of device, starting after its next poll '''
+        if device in self.intervals and interval and self.intervals[device] != interval:
+            logging.info("polling %s every %s minutes", device, interval)
+            self.intervals[device] = interval
+
+    def refresh(self, mgr):
+        ''' update intervals from the Host records in the database '''
+        for host in mgr.get_all(Host):
+            self.set_interval(host.name, host.interval)
+
+    def set_devices(self, devices, interval=C.DEFAULT_INTERVAL):
+        ''' poll devices from now on, dropping any others; new devices are polled every interval '''
+        now = time.time()
+        for device in devices:
+            if device not in self.intervals:
+                self.intervals[device] = interval
+                heapq.heappush(self._queue, (self._next_due(device, now), device))
+        for device in set(self.intervals) - set(devices):
+            del self.intervals[device]
+        self._queue = [(due, device) for due, device in self._queue if device in self.intervals]
+        heapq.heapify(self._queue)
+
+    def next_due(self):
+        ''' return the time the next device is due, or a second from now if there are none '''
+        if not self._queue:
+            return time.time() + 1
+        return self._queue[0][0]
+
+    def due(self, now=None):
+        ''' return the devices due by now and schedule their next poll '''
+        now = now or time.time()
+        devices = list()
+        while self._queue and self._queue[0][0] <= now:
+            due, device = heapq.heappop(self._queue)
+            devices.append(device)
+            heapq.heappush(self._queue, (self._next_due(device, now), device))
+        return devices
+
+
+def run_scheduled(pool, devices, shard=None):
+    '''
+    Poll devices with a started WorkerPool on their own intervals until
+    SIGTERM or SIGINT.  The workers, loaded modules and database
+    connections stay up between polls.  With a netspryte.shard.Shard, only
+    the share of devices assigned to this collector is polled, and that
+    share is looked up again every C.DEFAULT_SHARD_HEARTBEAT seconds.
+    '''
+    stopping = list()
+
+    def stop(signum, frame):
+        logging.warn("caught signal %s; stopping after submitted devices are processed", signum)
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    mgr = Manager()
+    config_devices = devices
+    if shard is not None:
+        shard.heartbeat(mgr)
+        devices = shard.devices(mgr, config_devices)
+    scheduler = Scheduler(devices)
+    refreshed = 0
+    beat = time.time()
+    while not stopping:
+        now = time.time()
+        if shard is not None and now - beat >= C.DEFAULT_SHARD_HEARTBEAT:
+            shard.heartbeat(mgr)
+            scheduler.set_devices(shard.devices(mgr, config_devices))
+            beat = now
+        if now - refreshed >= C.DEFAULT_DAEMON_REFRESH:
+            scheduler.refresh(mgr)
+            refreshed = now
+        devices = scheduler.due(now)
+        if devices:
+            pool.submit_all(devices)
+        time.sleep(min(1, max(0, scheduler.next_due() - time.time())))
+    if shard is not None:
+        shard.retire(mgr)
+    mgr.close()
+    pool.join()
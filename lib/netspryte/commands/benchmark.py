@@ -0,0 +1,190 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import platform
+import tempfile
+import itertools
+import subprocess
+
+import netspryte
+import netspryte.utils.timer
+from netspryte.snmp.simulator import mk_device, mk_agents
+from netspryte.commands import BaseCommand
+from netspryte import constants as C
+from netspryte.utils import setup_logging
+
+
+class BenchmarkCommand(BaseCommand):
+    '''
+    Run discover and collect-snmp against a fleet of simulated devices on
+    localhost and report how fast they went.
+
+    Each scenario, a combination of device count, interfaces per device
+    and worker count, gets its own data directory under the work
+    directory, so RRDs are written as in production.  Measurement
+    instances are cataloged in the postgres database given with --dbname,
+    since the Manager's schema needs postgres.  The simulated agents run
+    in this process.
+    '''
+
+    def __init__(self, daemonize=False):
+        super(BenchmarkCommand, self).__init__(daemonize)
+        self.parser.add_argument('-n', '--count', type=int, nargs='+', default=[10],
+                                 help='numbers of simulated devices')
+        self.parser.add_argument('--interfaces', type=int, nargs='+', default=[8],
+                                 help='numbers of interfaces per device')
+        self.parser.add_argument('--workers', type=int, nargs='+', default=[C.DEFAULT_WORKERS],
+                                 help='numbers of collector workers')
+        self.parser.add_argument('--cycles', type=int, default=2,
+                                 help='collect-snmp runs per scenario; the first creates the RRDs')
+        self.parser.add_argument('--dbname', required=True,
+                                 help='empty postgres database to catalog measurement instances in; '
+                                      'the host and credentials come from the configuration')
+        self.parser.add_argument('--workdir',
+                                 help='directory for data of the runs; defaults to a temporary directory')
+        self.parser.add_argument('--keep', default=False, action='store_true',
+                                 help='keep the work directory')
+        self.parser.add_argument('--bindir', default=os.path.dirname(os.path.abspath(sys.argv[0])),
+                                 help='directory of the netspryte commands to run')
+        self.parser.add_argument('--address', default='127.0.1.1',
+                                 help='address of the first simulated device')
+        self.parser.add_argument('--port', type=int, default=16100,
+                                 help='UDP port of the simulated devices')
+        self.parser.add_argument('--latency', type=float, default=0,
+                                 help='seconds the simulated devices delay each response')
+        self.parser.add_argument('--loss', type=float, default=0,
+                                 help='fraction of requests the simulated devices drop')
+        self.parser.add_argument('-o', '--output',
+                                 help='write results to this JSON file instead of stdout')
+
+    def run(self):
+        args = self.parser.parse_args()
+        setup_logging(args.verbose)
+        workdir = args.workdir or tempfile.mkdtemp(prefix="netspryte-benchmark-")
+        results = dict(
+            version=netspryte.__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            started=int(time.time()),
+            dbengine='postgres',
+            scenarios=list(),
+        )
+        try:
+            for count, interfaces, workers in itertools.product(args.count, args.interfaces, args.workers):
+                results['scenarios'].append(self.run_scenario(args, workdir, count, interfaces, workers))
+        finally:
+            if not args.keep and not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+        data = json.dumps(results, indent=4, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(data + "\n")
+            logging.warn("wrote benchmark results to %s", args.output)
+        else:
+            print(data)
+
+    def run_scenario(self, args, workdir, count, interfaces, workers):
+        ''' benchmark one discover and args.cycles collect-snmp runs against count simulated devices '''
+        name = "%sd-%si-%sw" % (count, interfaces, workers)
+        datadir = os.path.join(workdir, name)
+        os.makedirs(datadir)
+        logging.warn("benchmark %s: %s devices with %s interfaces and %s workers",
+                     name, count, interfaces, workers)
+        fixtures = [mk_device("sim%s" % i, interfaces) for i in range(count)]
+        agents = mk_agents(fixtures, args.address, args.port, latency=args.latency, loss=args.loss)
+        devices = [agent.host for agent in agents]
+        env = self.mk_env(args, datadir, workers)
+        runs = list()
+        try:
+            runs.append(self.run_command(args, env, datadir, agents, 'netspryte-discover', devices))
+            for i in range(args.cycles):
+                runs.append(self.run_command(args, env, datadir, agents, 'netspryte-collect-snmp', devices))
+        finally:
+            for agent in agents:
+                agent.stop()
+        return dict(name=name, devices=count, interfaces=interfaces, workers=workers, runs=runs)
+
+    def mk_env(self, args, datadir, workers):
+        ''' return the environment pointing the commands at datadir and the simulated devices '''
+        env = dict(os.environ)
+        env.update(
+            NETSPRYTE_DATADIR=datadir,
+            NETSPRYTE_SNMP_STATEDIR=os.path.join(datadir, "snmp"),
+            NETSPRYTE_STATSDIR=os.path.join(datadir, "stats"),
+            NETSPRYTE_TRACEDIR=os.path.join(datadir, "trace"),
+            NETSPRYTE_WORKERS=str(workers),
+            NETSPRYTE_DATABASE="rrd",
+            NETSPRYTE_DB_ENGINE='postgres',
+            NETSPRYTE_DB_NAME=args.dbname,
+            NETSPRYTE_SNMP_PORT=str(args.port),
+            NETSPRYTE_SNMP_VERSION="2c",
+            NETSPRYTE_SNMP_COMMUNITY="public",
+        )
+        return env
+
+    def run_command(self, args, env, datadir, agents, command, devices):
+        '''
+        Run command on devices and return its elapsed time, throughput,
+        peak RSS of its largest process and the latency of its stages.
+        '''
+        tracedir = env['NETSPRYTE_TRACEDIR']
+        shutil.rmtree(tracedir, ignore_errors=True)
+        cycle_path = os.path.join(env['NETSPRYTE_SNMP_STATEDIR'], "cycle.json")
+        if os.path.exists(cycle_path):
+            os.unlink(cycle_path)
+        requests = sum(agent.requests for agent in agents)
+        varbinds = sum(agent.varbinds for agent in agents)
+        cmd = [sys.executable, os.path.join(args.bindir, command)] + devices
+        with open(os.path.join(datadir, "%s.log" % command), 'a') as log:
+            start = time.time()
+            proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+            # wait4 gives the resource usage of the command and the workers it waited for
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            elapsed = time.time() - start
+        if os.WIFEXITED(status):
+            proc.returncode = os.WEXITSTATUS(status)
+        else:
+            proc.returncode = -os.WTERMSIG(status)
+        if proc.returncode:
+            logging.error("%s exited with %s; see %s", command, proc.returncode,
+                          os.path.join(datadir, "%s.log" % command))
+        requests = sum(agent.requests for agent in agents) - requests
+        varbinds = sum(agent.varbinds for agent in agents) - varbinds
+        result = dict(
+            command=command,
+            returncode=proc.returncode,
+            elapsed=round(elapsed, 3),
+            devices_per_second=round(len(devices) / elapsed, 3),
+            requests=requests,
+            varbinds=varbinds,
+            varbinds_per_second=round(varbinds / elapsed, 3),
+            peak_rss_kb=rusage.ru_maxrss,
+            stages=netspryte.utils.timer.read_spans(tracedir),
+        )
+        if os.path.exists(cycle_path):
+            with open(cycle_path) as f:
+                result['cycle'] = json.load(f)
+        logging.warn("%s: %.2f devices/s, %.1f varbinds/s, peak rss %s KB", command,
+                     result['devices_per_second'], result['varbinds_per_second'], result['peak_rss_kb'])
+        return result
@@ -27,16 +27,19 @@ import time
 import traceback
 import multiprocessing
 import random
+import functools
 
 import netspryte
 import netspryte.snmp
+import netspryte.utils.stats
 from netspryte.plugins import snmp_module_loader
+from netspryte.shard import Shard, shard_devices
 
-from netspryte.commands import BaseCommand
+from netspryte.commands import BaseCommand, BaseWorker, Pipeline, Stage, WorkerPool, SerializedCatalog, \
+    run_workers, run_scheduled
 from netspryte import constants as C
-from netspryte.utils import setup_logging, json_ready, xlate_metric_names, get_db_backend
+from netspryte.utils import setup_logging, json_ready, xlate_metric_names, get_db_backend, lock_path
 from netspryte.utils.timer import Timer
-from netspryte.manager import Manager, MeasurementInstance, MeasurementClass, Host
 from netspryte.db.rrd import *
 
 
@@ -49,6 +52,14 @@ class CollectSnmpCommand(BaseCommand):
         self.parser.add_argument('devices', type=str, nargs='*',
                                  default=C.DEFAULT_DEVICES,
                                  help='list of devices to query')
+        self.parser.add_argument('--asyncio', default=C.DEFAULT_SNMP_ASYNCIO, action='store_true',
+                                 help='Poll devices concurrently from a single process with asyncio')
+        self.parser.add_argument('--stat-only', default=C.DEFAULT_SNMP_STAT_ONLY, action='store_true',
+                                 help='Only walk measurement data; use attributes recorded by discover')
+        self.parser.add_argument('--daemon', default=daemonize, action='store_true',
+                                 help='Keep running, polling each device on its own interval')
+        self.parser.add_argument('--shard', default=C.DEFAULT_SHARD, action='store_true',
+                                 help='Share the devices with the other collectors using the database')
 
     def run(self):
         args = self.parser.parse_args()
@@ -56,127 +67,87 @@ class CollectSnmpCommand(BaseCommand):
             logging.error("Path to data directory does not exist: %s", args.datadir)
             return 1
         setup_logging(args.verbose)
+        lock = lock_path(os.path.join(C.DEFAULT_SNMP_STATEDIR, "collect-snmp.lock"))
+        if lock is None:
+            logging.error("previous snmp collection is still running; skipping this run")
+            return 1
         t = Timer("snmp collection")
         t.start_timer()
         cfg = C.load_config()
         num_workers = C.DEFAULT_WORKERS
-        if len(args.devices) < num_workers:
+        if len(args.devices) < num_workers and not args.shard:
             num_workers = len(args.devices)
-        logging.warn("beginning snmp collection with %s workers", num_workers)
-        CollectSnmpCommand.SNMP_MODULES = snmp_module_loader.all()
-        task_queue = multiprocessing.JoinableQueue()
         if args.nofork:
             num_workers = 1
-        logging.info("creating %s workers", num_workers)
-        workers = [CollectSnmpWorker(task_queue) for i in range(num_workers)]
-        for w in workers:
-            w.start()
-        for d in args.devices:
-            task_queue.put(d)
-        # add poison pill to queue
-        for i in range(num_workers):
-            task_queue.put(None)
-        task_queue.join()
+        CollectSnmpCommand.SNMP_MODULES = snmp_module_loader.all()
+        if args.daemon:
+            logging.warn("starting snmp collection daemon with %s workers", num_workers)
+            pool = WorkerPool(CollectSnmpWorker, CollectSnmpCommand.SNMP_MODULES,
+                              num_workers, args.asyncio, stat_only=args.stat_only)
+            pool.start()
+            if C.DEFAULT_STATS_PORT:
+                netspryte.utils.stats.serve(C.DEFAULT_STATS_PORT)
+            run_scheduled(pool, args.devices, Shard() if args.shard else None)
+            t.stop_timer()
+            return
+        devices = args.devices
+        if args.shard:
+            devices = shard_devices(devices)
+            num_workers = max(1, min(num_workers, len(devices)))
+        logging.warn("beginning snmp collection with %s workers", num_workers)
+        run_workers(CollectSnmpWorker, devices, CollectSnmpCommand.SNMP_MODULES,
+                    num_workers, args.asyncio, C.DEFAULT_CYCLE_DEADLINE, stat_only=args.stat_only)
         t.stop_timer()
 
 
-class CollectSnmpWorker(multiprocessing.Process):
+class CollectSnmpWorker(BaseWorker):
 
-    def __init__(self, task_queue):
-        multiprocessing.Process.__init__(self)
-        self.task_queue = task_queue
+    NAME = "snmp"
 
-    def run(self):
-        self.mgr = Manager()
-        proc_name = self.name
-        t = Timer()
-        while True:
-            device = self.task_queue.get()
-            if device is None:
-                logging.info("worker %s exiting", proc_name)
-                self.task_queue.task_done()
-                break
-            t.name = "%s snmp worker" % device
-            t.start_timer()
-            logging.warn("processing %s", device)
-            try:
-                msnmp = netspryte.snmp.SNMPSession(host=device)
-                for cls, module in list(CollectSnmpCommand.SNMP_MODULES.items()):
-                    if not cls.STAT:
-                        logging.info("skipping module %s that does not collect measurement data", cls.NAME)
-                        continue
-                    try:
-                        snmp_mod = cls(msnmp)
-                        name = snmp_mod.sysName or msnmp.host
-                        if snmp_mod and hasattr(snmp_mod, 'data'):
-                            self.process_module_data(snmp_mod)
-                    except Exception as e:
-                        logging.error("module %s failed against device %s: %s", cls.__name__, device, traceback.format_exc())
-                        continue
-            except Exception as e:
-                logging.error("encountered error with %s; skipping to next device: %s", device, traceback.format_exc())
-            finally:
-                t.stop_timer()
-            self.task_queue.task_done()
-        return
-
-    def process_module_data(self, snmp_mod):
-        this_class_updated = False
-        this_host = None
-        this_class = None
-        log_me = False
-        these_insts = list()
-        metric_types = dict()
-        if not snmp_mod.data:
-            return
-        t = Timer("database")
-        t.start_timer()
-        for data in snmp_mod.data:
-            now = datetime.datetime.now()
-            if not this_host:
-                this_host = self.mgr.get_or_create(Host, name=data['host'])
-            if not this_class:
-                this_class = self.mgr.get_or_create(MeasurementClass, name=data['class'], transport=data['transport'])
-            if this_host is None or this_class is None:
-                logging.error("encountered database error; skipping to next instance")
-                continue
-            t.name = "select and update database %s-%s" % (this_host.name, this_class.name)
-            if not log_me:
-                logging.info("updating database for %s %s", this_host.name, this_class.name)
-                log_me = True
-            if hasattr(snmp_mod, 'DESCRIPTION') and not this_class.description:
-                this_class.description = snmp_mod.DESCRIPTION
-            this_inst = self.mgr.get_or_create(MeasurementInstance,
-                                          name=data['name'], index=data['index'],
-                                          host=this_host, measurement_class=this_class)
-            this_host.lastseen = now
-            this_inst.lastseen = now
-            this_inst.attrs = json_ready(data['attrs'])
-            if 'presentation' in data and not this_inst.presentation:
-                this_inst.presentation = json_ready(data['presentation'])
-            if 'metrics' in data:
-                this_inst.metrics = json_ready(data['metrics'])
-                if not metric_types:
-                    for k, v in list(data['metrics'].items()):
-                        metric_types[k] = netspryte.snmp.get_value_type(v)
-                    this_class.metric_type = json_ready(metric_types)
-            self.mgr.save(this_inst)
-            if this_inst.metrics:
-                these_insts.append(this_inst)
-        self.mgr.save(this_host)
-        self.mgr.save(this_class)
-        logging.info("done updating database for %s %s", this_host.name, this_class.name)
-        t.stop_timer()
-        t = Timer("%s-%s-metrics update" % (this_host.name, this_class.name))
+    def __init__(self, task_queue=None, modules=None, snmp_session=netspryte.snmp.SNMPSession, stat_only=False):
+        super(CollectSnmpWorker, self).__init__(task_queue, modules, snmp_session)
+        self.stat_only = stat_only
+        self.device_budget = C.DEFAULT_DEVICE_BUDGET
+        self.module_budget = C.DEFAULT_MODULE_BUDGET
+        self.backends = list()
+
+    def mk_context(self, device):
+        '''
+        When collecting STAT only, modules look up attributes of measurement
+        instances in the database instead of walking them from the device.
+        '''
+        ctx = super(CollectSnmpWorker, self).mk_context(device)
+        if self.stat_only:
+            ctx.catalog = SerializedCatalog(self.mgr, self.db_lock)
+        return ctx
+
+    @staticmethod
+    def skip_module(cls):
+        if not cls.STAT:
+            logging.info("skipping module %s that does not collect measurement data", cls.NAME)
+            return True
+        return False
+
+    def mk_pipeline(self):
+        ''' the catalog stage feeds one stage per metrics backend, each with its own backend object '''
+        self.backends = [get_db_backend([name])[0] for name in C.DEFAULT_DATABASE]
+        stages = [Stage("db-%s" % backend.backend, functools.partial(self.store_metrics, backend))
+                  for backend in self.backends]
+        return Pipeline(Stage("catalog", self.store_batch, stages))
+
+    def close(self):
+        super(CollectSnmpWorker, self).close()
+        for backend in self.backends:
+            backend.close()
+
+    def store_metrics(self, backend, batch):
+        ''' backend stage: write the metrics of a batch to a backend in one call '''
+        t = Timer("%s-%s-metrics update" % (batch.data[0]['host'], batch.data[0]['class']),
+                  backend.backend, parent=batch.span, instances=len(batch.instances))
         t.start_timer()
-        for this_inst in these_insts:
-            self.process_data_instance(this_inst, snmp_mod.XLATE)
+        samples = [(this_inst, xlate_metric_names(this_inst.metrics, batch.XLATE))
+                   for this_inst in batch.instances]
+        backend.write_many(samples, batch.XLATE, batch.timestamp)
         t.stop_timer()
-
-    def process_data_instance(self, measurement_instance, xlate):
-        ''' '''
-        metrics = xlate_metric_names(measurement_instance.metrics, xlate)
-        dbs = get_db_backend()
-        for db in dbs:
-            db.measurement_instance = measurement_instance
-            db.write(metrics, xlate)
+        netspryte.utils.stats.histogram("db_write_seconds", "Time taken to store a module's data").observe(
+            t.elapsed, stage=backend.backend)
@@ -0,0 +1,70 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+
+import netspryte.microbench
+from netspryte.commands import BaseCommand
+from netspryte.utils import setup_logging, parse_json_from_file
+
+
+class MicrobenchCommand(BaseCommand):
+
+    def __init__(self, daemonize=False):
+        super(MicrobenchCommand, self).__init__(daemonize)
+        self.parser.add_argument('--interfaces', type=int, default=1000,
+                                 help='rows of the synthetic interface table')
+        self.parser.add_argument('--policers', type=int, default=2000,
+                                 help='rows of the synthetic cbqos table')
+        self.parser.add_argument('--entities', type=int, default=500,
+                                 help='rows of the synthetic entity table')
+        self.parser.add_argument('--repeat', type=int, default=5,
+                                 help='timed passes over each table')
+        self.parser.add_argument('-f', '--function', action='append',
+                                 help='only benchmark this function; may be given more than once')
+        self.parser.add_argument('-o', '--output',
+                                 help='write results to this JSON file')
+        self.parser.add_argument('-b', '--baseline',
+                                 help='JSON results of an earlier run to compare against')
+        self.parser.add_argument('--threshold', type=float, default=0.1,
+                                 help='fraction by which a benchmark may be worse than the baseline')
+
+    def run(self):
+        args = self.parser.parse_args()
+        setup_logging(args.verbose)
+        tables = netspryte.microbench.mk_tables(args.interfaces, args.policers, args.entities)
+        results = netspryte.microbench.run(tables, args.repeat, args.function)
+        print("%-22s %-10s %8s %12s %12s %10s" % ("function", "table", "ops", "ns/op", "blocks/op", "bytes/op"))
+        for r in results:
+            print("%-22s %-10s %8d %12.1f %12.2f %10.1f" % (r['function'], r['table'], r['ops'],
+                                                           r['ns_per_op'], r['blocks_per_op'], r['bytes_per_op']))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+        if args.baseline:
+            baseline = parse_json_from_file(args.baseline)
+            if baseline is None:
+                return 1
+            regressions = netspryte.microbench.compare(results, baseline, args.threshold)
+            for r in regressions:
+                logging.error("%s on %s regressed: %.1f ns/op and %.2f blocks/op, was %.1f and %.2f",
+                              r['function'], r['table'], r['ns_per_op'], r['blocks_per_op'],
+                              r['baseline_ns_per_op'], r['baseline_blocks_per_op'])
+            if regressions:
+                return 1
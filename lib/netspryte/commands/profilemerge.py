@@ -0,0 +1,48 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+
+import netspryte.utils.profile
+from netspryte.commands import BaseCommand
+from netspryte import constants as C
+from netspryte.utils import setup_logging
+
+
+class ProfileMergeCommand(BaseCommand):
+
+    def __init__(self, daemonize=False):
+        super(ProfileMergeCommand, self).__init__(daemonize)
+        self.parser.add_argument('path', type=str, nargs='?',
+                                 default=C.DEFAULT_PROFILEDIR,
+                                 help='directory of profiles written with --profile')
+        self.parser.add_argument('--name', default='merged',
+                                 help='write the merged profiles to NAME.pstats and NAME.folded')
+        self.parser.add_argument('--top', type=int, default=25,
+                                 help='print the top entries of the merged pstats by cumulative time')
+
+    def run(self):
+        args = self.parser.parse_args()
+        setup_logging(args.verbose)
+        if not os.path.isdir(args.path):
+            logging.error("profile directory does not exist: %s", args.path)
+            return 1
+        stats = netspryte.utils.profile.merge(args.path, args.name)
+        if stats is not None and args.top:
+            stats.sort_stats('cumulative').print_stats(args.top)
@@ -0,0 +1,105 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+
+import netspryte.snmp
+from netspryte.snmp.simulator import Fixture, mk_device, mk_agents, record
+from netspryte.commands import BaseCommand
+from netspryte import constants as C
+from netspryte.utils import setup_logging
+
+
+class SnmpSimCommand(BaseCommand):
+
+    def __init__(self, daemonize=False):
+        super(SnmpSimCommand, self).__init__(daemonize)
+        group1 = self.parser.add_argument_group('serve', 'Serve simulated devices')
+        group1.add_argument('-n', '--count', type=int, default=1,
+                            help='number of simulated devices')
+        group1.add_argument('--interfaces', type=int, default=8,
+                            help='number of interfaces of generated devices')
+        group1.add_argument('-f', '--fixture', action='append',
+                            help='snmprec file to serve; may be given more than once')
+        group1.add_argument('--address', default='127.0.1.1',
+                            help='address of the first device; others follow it')
+        group1.add_argument('--port', type=int, default=C.DEFAULT_SNMP_PORT,
+                            help='UDP port of every device')
+        group1.add_argument('--latency', type=float, default=0,
+                            help='seconds to delay each response')
+        group1.add_argument('--jitter', type=float, default=0,
+                            help='up to this many seconds added to the latency')
+        group1.add_argument('--loss', type=float, default=0,
+                            help='fraction of requests to drop')
+        group1.add_argument('--max-varbinds', type=int, default=None,
+                            help='answer responses with more varbinds with tooBig')
+        group2 = self.parser.add_argument_group('record', 'Record fixtures from devices')
+        group2.add_argument('-o', '--output', default='.',
+                            help='directory to write DEVICE.snmprec files to')
+        group2.add_argument('--oid', action='append',
+                            help='subtree to record; defaults to mib-2 and enterprises')
+        self.parser.add_argument('command', type=str, choices=['serve', 'record'],
+                                 help="Sub-command")
+        self.parser.add_argument('devices', type=str, nargs='*',
+                                 help='devices to record')
+
+    def run(self):
+        args = self.parser.parse_args()
+        setup_logging(args.verbose)
+        if args.command == 'serve':
+            return self.serve_command(args)
+        elif args.command == 'record':
+            return self.record_command(args.devices, args.output, args.oid)
+        else:
+            logging.error("unrecognized command")
+
+    def serve_command(self, args):
+        ''' serve simulated devices until interrupted '''
+        if args.fixture:
+            fixtures = [Fixture.load(path) for path in args.fixture]
+        else:
+            fixtures = [mk_device("sim%s" % i, args.interfaces) for i in range(args.count)]
+        agents = mk_agents(fixtures, args.address, args.port, latency=args.latency,
+                           jitter=args.jitter, loss=args.loss, max_varbinds=args.max_varbinds)
+        logging.warn("serving %s simulated devices from %s to %s on port %s", len(agents),
+                     agents[0].host, agents[-1].host, args.port)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for agent in agents:
+                agent.stop()
+
+    def record_command(self, devices, output, oids):
+        ''' walk devices and save them as snmprec fixtures '''
+        if not devices:
+            logging.error("no devices to record")
+            return 1
+        if not os.path.exists(output):
+            os.makedirs(output)
+        for device in devices:
+            snmp = netspryte.snmp.SNMPSession(host=device)
+            path = os.path.join(output, "%s.snmprec" % device)
+            if oids:
+                record(snmp, path, oids)
+            else:
+                record(snmp, path)
@@ -0,0 +1,59 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import logging
+
+import netspryte.utils.stats
+from netspryte.commands import BaseCommand
+from netspryte import constants as C
+from netspryte.utils import setup_logging, data2path
+
+
+class StatsCommand(BaseCommand):
+    '''
+    Print the collector statistics saved in the stats directory, or write
+    them to a file, for instance for the textfile collector of the
+    Prometheus node exporter when collect-snmp runs from cron.
+    '''
+
+    def __init__(self, daemonize=False):
+        super(StatsCommand, self).__init__(daemonize)
+        self.parser.add_argument('--statsdir', default=C.DEFAULT_STATSDIR,
+                                 help='directory the collectors save their statistics to')
+        self.parser.add_argument('--json', default=False, action='store_true',
+                                 help='print the merged statistics as JSON instead of OpenMetrics text')
+        self.parser.add_argument('-o', '--output', default=None,
+                                 help='write to OUTPUT, replacing it whole, instead of printing')
+
+    def run(self):
+        args = self.parser.parse_args()
+        setup_logging(args.verbose)
+        if not os.path.isdir(args.statsdir):
+            logging.error("stats directory does not exist: %s", args.statsdir)
+            return 1
+        stats = netspryte.utils.stats.read_stats(args.statsdir)
+        if args.json:
+            body = json.dumps(stats, indent=4, sort_keys=True) + "\n"
+        else:
+            body = netspryte.utils.stats.openmetrics(stats)
+        if args.output:
+            data2path(body, os.path.abspath(args.output))
+        else:
+            print(body, end='')
@@ -19,35 +19,36 @@
 import datetime
 import os
 import pwd
+import socket
 import configparser
 import multiprocessing
 from netspryte.errors import *
 
 def get_config(p, section, key, env_var, default, boolean=False, integer=False, islist=False):
+    value = None
     if env_var is not None:
         value = os.environ.get(env_var, None)
-        if value is not None:
-            return value
-    if p is not None:
+        if value is not None and islist:
+            return [ x.strip() for x in value.split(',') if x.strip() ]
+    if value is None and p is not None:
         try:
             value = p.get(section, key)
         except:
             return default
-        if integer:
-            return int(value)
-        elif boolean:
-            if value is None:
-                return False
-            value = str(value)
-            if value.lower() in ['true', 't', 'y', '1', 'yes']:
-                return True
-            else:
-                return False
-        elif islist:
+        if islist:
             return [ x.lstrip() for x in value.split('\n') ]
+    if value is None:
+        return default
+    if integer:
+        return int(value)
+    elif boolean:
+        value = str(value)
+        if value.lower() in ['true', 't', 'y', '1', 'yes']:
+            return True
         else:
-            return value
-    return default
+            return False
+    else:
+        return value
 
 def load_config():
     ''' load config file '''
@@ -83,6 +84,23 @@ DEFAULT_SNMP_AUTHKEY   = get_config(p, DEFAULTS, "snmp_authkey",   "NETSPRYTE_SN
 DEFAULT_SNMP_PRIVKEY   = get_config(p, DEFAULTS, "snmp_privkey",   "NETSPRYTE_SNMP_PRIVKEY",   "na")
 DEFAULT_SNMP_BULK      = get_config(p, DEFAULTS, "snmp_bulk",      "NETSPRYTE_SNMP_BULK",      20)
 DEFAULT_SNMP_CACHE_TIMEOUT = get_config(p, DEFAULTS, "snmp_cache_timeout", "NETSPRYTE_SNMP_CACHE_TIMEOUT", 60, integer=True)
+DEFAULT_SNMP_CACHE_SIZE = get_config(p, DEFAULTS, "snmp_cache_size", "NETSPRYTE_SNMP_CACHE_SIZE", 1000, integer=True)
+DEFAULT_SNMP_CACHE_PERSIST = get_config(p, DEFAULTS, "snmp_cache_persist", "NETSPRYTE_SNMP_CACHE_PERSIST", True, boolean=True)
+DEFAULT_SNMP_CACHE_PERSIST_TTL = get_config(p, DEFAULTS, "snmp_cache_persist_ttl", "NETSPRYTE_SNMP_CACHE_PERSIST_TTL", 300, integer=True)
+DEFAULT_SNMP_ASYNCIO   = get_config(p, DEFAULTS, "snmp_asyncio",   "NETSPRYTE_SNMP_ASYNCIO",   False, boolean=True)
+DEFAULT_SNMP_CONCURRENCY = get_config(p, DEFAULTS, "snmp_concurrency", "NETSPRYTE_SNMP_CONCURRENCY", 100, integer=True)
+DEFAULT_SNMP_STAT_ONLY = get_config(p, DEFAULTS, "snmp_stat_only", "NETSPRYTE_SNMP_STAT_ONLY", False, boolean=True)
+DEFAULT_SNMP_BACKOFF   = get_config(p, DEFAULTS, "snmp_backoff",   "NETSPRYTE_SNMP_BACKOFF",   60, integer=True)
+DEFAULT_SNMP_BACKOFF_MAX = get_config(p, DEFAULTS, "snmp_backoff_max", "NETSPRYTE_SNMP_BACKOFF_MAX", 3600, integer=True)
+DEFAULT_SNMP_PROFILE   = get_config(p, DEFAULTS, "snmp_profile",   "NETSPRYTE_SNMP_PROFILE",   True, boolean=True)
+DEFAULT_SNMP_PROFILE_TTL = get_config(p, DEFAULTS, "snmp_profile_ttl", "NETSPRYTE_SNMP_PROFILE_TTL", 86400, integer=True)
+DEFAULT_SNMP_GET_VARBINDS = get_config(p, DEFAULTS, "snmp_get_varbinds", "NETSPRYTE_SNMP_GET_VARBINDS", 40, integer=True)
+DEFAULT_SNMP_BULK_ADAPTIVE = get_config(p, DEFAULTS, "snmp_bulk_adaptive", "NETSPRYTE_SNMP_BULK_ADAPTIVE", True, boolean=True)
+DEFAULT_SNMP_BULK_MIN  = get_config(p, DEFAULTS, "snmp_bulk_min",  "NETSPRYTE_SNMP_BULK_MIN",  5, integer=True)
+DEFAULT_SNMP_BULK_MAX  = get_config(p, DEFAULTS, "snmp_bulk_max",  "NETSPRYTE_SNMP_BULK_MAX",  200, integer=True)
+DEFAULT_SNMP_BULK_STEP = get_config(p, DEFAULTS, "snmp_bulk_step", "NETSPRYTE_SNMP_BULK_STEP", 10, integer=True)
+DEFAULT_SNMP_BULK_VARBINDS = get_config(p, DEFAULTS, "snmp_bulk_varbinds", "NETSPRYTE_SNMP_BULK_VARBINDS", 500, integer=True)
+DEFAULT_SNMP_BULK_LATENCY  = float(get_config(p, DEFAULTS, "snmp_bulk_latency", "NETSPRYTE_SNMP_BULK_LATENCY", 1.0))
 
 DEFAULT_VERBOSE        = get_config(p, DEFAULTS, "verbose",        "NETSPRYTE_VERBOSE",        0, integer=True)
 DEFAULT_LOG_LEVEL      = get_config(p, DEFAULTS, "loglevel",       "NETSPRYTE_LOG_LEVEL",      0)
@@ -97,10 +115,30 @@ DEFAULT_DATABASE       = get_config(p, DEFAULTS, "database",       "NETSPRYTE_DA
 DEFAULT_WORKERS        = get_config(p, DEFAULTS, "workers",        "NETSPRYTE_WORKERS",        multiprocessing.cpu_count(), integer=True)
 DEFAULT_DEVICES        = get_config(p, DEFAULTS, "devices",        "NETSPRYTE_DEVICES",        ["localhost"], islist=True)
 DEFAULT_DATADIR        = get_config(p, DEFAULTS, "datadir",        "NETSPRYTE_DATADIR",        "/var/lib/netspryte/data")
+DEFAULT_SNMP_STATEDIR  = get_config(p, DEFAULTS, "snmp_statedir",  "NETSPRYTE_SNMP_STATEDIR",  os.path.join(DEFAULT_DATADIR, "snmp"))
+DEFAULT_STATS          = get_config(p, DEFAULTS, "stats",          "NETSPRYTE_STATS",          True, boolean=True)
+DEFAULT_STATSDIR       = get_config(p, DEFAULTS, "statsdir",       "NETSPRYTE_STATSDIR",       os.path.join(DEFAULT_DATADIR, "stats"))
+DEFAULT_STATS_PORT     = get_config(p, DEFAULTS, "stats_port",     "NETSPRYTE_STATS_PORT",     0, integer=True)
+DEFAULT_STATS_INTERVAL = get_config(p, DEFAULTS, "stats_interval", "NETSPRYTE_STATS_INTERVAL", 60, integer=True)
+DEFAULT_STATS_EXPIRE   = get_config(p, DEFAULTS, "stats_expire",   "NETSPRYTE_STATS_EXPIRE",   86400, integer=True)
+DEFAULT_TRACE          = get_config(p, DEFAULTS, "trace",          "NETSPRYTE_TRACE",          False, boolean=True)
+DEFAULT_TRACEDIR       = get_config(p, DEFAULTS, "tracedir",       "NETSPRYTE_TRACEDIR",       os.path.join(DEFAULT_DATADIR, "trace"))
+DEFAULT_TRACE_EVENTS   = get_config(p, DEFAULTS, "trace_events",   "NETSPRYTE_TRACE_EVENTS",   100000, integer=True)
+DEFAULT_PROFILEDIR     = get_config(p, DEFAULTS, "profiledir",     "NETSPRYTE_PROFILEDIR",     os.path.join(DEFAULT_DATADIR, "profile"))
+DEFAULT_PROFILE_MODE   = get_config(p, DEFAULTS, "profile_mode",   "NETSPRYTE_PROFILE_MODE",   "sample")
+DEFAULT_PROFILE_INTERVAL = float(get_config(p, DEFAULTS, "profile_interval", "NETSPRYTE_PROFILE_INTERVAL", 0.005))
 DEFAULT_CHECKSUM       = get_config(p, DEFAULTS, "checksum",       "NETSPRYTE_CHECKSUM",       "sha1")
 DEFAULT_STRFTIME       = get_config(p, DEFAULTS, 'strftime',       "NETSPRYTE_STRFTIME",       "%c")
 DEFAULT_INTERVAL       = get_config(p, DEFAULTS, "interval",       "NETSPRYTE_INTERVAL",       1, integer=True)
 DEFAULT_CRON_PATH      = get_config(p, DEFAULTS, "cron_path",       "NETSPRYTE_CRON_PATH",     "/usr/local/bin:/usr/bin:/bin")
+DEFAULT_DAEMON_REFRESH = get_config(p, DEFAULTS, "daemon_refresh", "NETSPRYTE_DAEMON_REFRESH", 300, integer=True)
+DEFAULT_PIPELINE       = get_config(p, DEFAULTS, "pipeline",       "NETSPRYTE_PIPELINE",       True, boolean=True)
+DEFAULT_PIPELINE_DEPTH = get_config(p, DEFAULTS, "pipeline_depth", "NETSPRYTE_PIPELINE_DEPTH", 16, integer=True)
+DEFAULT_SHARD          = get_config(p, DEFAULTS, "shard",          "NETSPRYTE_SHARD",          False, boolean=True)
+DEFAULT_SHARD_NAME     = get_config(p, DEFAULTS, "shard_name",     "NETSPRYTE_SHARD_NAME",     socket.getfqdn())
+DEFAULT_SHARD_HEARTBEAT = get_config(p, DEFAULTS, "shard_heartbeat", "NETSPRYTE_SHARD_HEARTBEAT", 30, integer=True)
+DEFAULT_SHARD_TIMEOUT  = get_config(p, DEFAULTS, "shard_timeout",  "NETSPRYTE_SHARD_TIMEOUT",  180, integer=True)
+DEFAULT_SHARD_REPLICAS = get_config(p, DEFAULTS, "shard_replicas", "NETSPRYTE_SHARD_REPLICAS", 100, integer=True)
 
 DEFAULT_ALLOWED_SNMP_VERSIONS = ['1', '2c', '3']
 DEFAULT_ALLOWED_SNMP_LEVELS   = ['authNoPriv', 'authPriv']
@@ -118,14 +156,22 @@ DEFAULT_RRD_RRA =        get_config(p, 'rrd', 'rra',       "NETSPRYTE_RRD_RRA",
                                                                                         "RRA:MAX:0.5:120:2232",
                                                                                         "RRA:MAX:0.5:1440:1098" ], islist=True)
 
+DEFAULT_CYCLE_DEADLINE = get_config(p, DEFAULTS, "cycle_deadline", "NETSPRYTE_CYCLE_DEADLINE", DEFAULT_RRD_STEP, integer=True)
+DEFAULT_CYCLE_GRACE    = get_config(p, DEFAULTS, "cycle_grace",    "NETSPRYTE_CYCLE_GRACE",    DEFAULT_RRD_STEP, integer=True)
+DEFAULT_DEVICE_BUDGET  = get_config(p, DEFAULTS, "device_budget",  "NETSPRYTE_DEVICE_BUDGET",  DEFAULT_CYCLE_DEADLINE, integer=True)
+DEFAULT_MODULE_BUDGET  = get_config(p, DEFAULTS, "module_budget",  "NETSPRYTE_MODULE_BUDGET",  DEFAULT_DEVICE_BUDGET, integer=True)
+
 DEFAULT_INFLUXDB_HOST     = get_config(p, 'influxdb', 'host',     'NETSPRYTE_INFLUXDB_HOST',     'localhost')
 DEFAULT_INFLUXDB_PORT     = get_config(p, 'influxdb', 'port',     'NETSPRYTE_INFLUXDB_PORT',     8086, integer=True)
 DEFAULT_INFLUXDB_USER     = get_config(p, 'influxdb', 'user',     'NETSPRYTE_INFLUXDB_USER',     'root')
 DEFAULT_INFLUXDB_PASSWORD = get_config(p, 'influxdb', 'password', 'NETSPRYTE_INFLUXDB_PASSWORD', 'root')
 DEFAULT_INFLUXDB_DATABASE = get_config(p, 'influxdb', 'database', 'NETSPRYTE_INFLUXDB_DATABASE', 'netspryte')
+DEFAULT_INFLUXDB_BATCH    = get_config(p, 'influxdb', 'batch',    'NETSPRYTE_INFLUXDB_BATCH',    5000, integer=True)
 
 DEFAULT_DB_ENGINE        = get_config(p, DEFAULTS, 'dbengine', 'NETSPRYTE_DB_ENGINE', 'postgres')
 DEFAULT_DB_NAME          = get_config(p, DEFAULTS, 'dbname',   'NETSPRYTE_DB_NAME', 'netspryte')
 DEFAULT_DB_HOST          = get_config(p, DEFAULTS, 'dbhost',   'NETSPRYTE_DB_HOST', 'localhost')
 DEFAULT_DB_USER          = get_config(p, DEFAULTS, 'dbuser',   'NETSPRYTE_DB_USER', 'netspryte')
 DEFAULT_DB_PASS          = get_config(p, DEFAULTS, 'dbpass',   'NETSPRYTE_DB_PASS', 'netspryte')
+DEFAULT_DB_BATCH         = get_config(p, DEFAULTS, 'dbbatch',  'NETSPRYTE_DB_BATCH', 100, integer=True)
+DEFAULT_DB_COPY_ROWS     = get_config(p, DEFAULTS, 'dbcopyrows', 'NETSPRYTE_DB_COPY_ROWS', 1000, integer=True)
@@ -26,7 +26,19 @@ class BaseDatabaseBackend(object):
         if 'host' in kwargs:
             self.host = kwargs['host']
 
-    def write(self, data):
+    def write(self, data, xlate=None, ts=None):
+        pass
+
+    def write_many(self, samples, xlate=None, ts=None):
+        '''
+        write samples, a list of (measurement instance, metrics) pairs
+        taken at ts; backends that can batch writes override this
+        '''
+        for measurement_instance, data in samples:
+            self.measurement_instance = measurement_instance
+            self.write(data, xlate, ts)
+
+    def close(self):
         pass
 
     @property
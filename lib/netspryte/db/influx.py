@@ -38,6 +38,7 @@ class InfluxDatabaseBackend(BaseDatabaseBackend):
     def __init__(self, backend, **kwargs):
         super(InfluxDatabaseBackend, self).__init__(backend, **kwargs)
         self.client = None
+        self._switched = False
         if not HAVE_INFLUXDB:
             logging.error("do not have influxdb bindings for python")
             return None
@@ -53,12 +54,24 @@ class InfluxDatabaseBackend(BaseDatabaseBackend):
         if self.database not in databases:
             influxdb_create_database(self.client, self.database)
 
-    def write(self, data):
-        ''' write data to rrd database '''
+    def write(self, data, xlate=None, ts=None):
+        ''' write data of the measurement_instance property to influxdb '''
+        return self.write_many([(self.measurement_instance, data)], xlate, ts)
+
+    def write_many(self, samples, xlate=None, ts=None):
+        '''
+        write samples, a list of (measurement instance, metrics) pairs,
+        to influxdb in a single request
+        '''
         if not self.client:
             return None
-        influxdb_switch_database(self.client, self.database)
-        return influxdb_write(self.client, data)
+        if not self._switched:
+            influxdb_switch_database(self.client, self.database)
+            self._switched = True
+        points = list()
+        for measurement_instance, data in samples:
+            points.extend(influxdb_points(measurement_instance, data, ts))
+        return influxdb_write(self.client, points)
 
     @property
     def host(self):
@@ -119,12 +132,15 @@ def influxdb_list_databases(client):
     dbs = client.get_list_database()
     return [ x['name'] for x in dbs ]
 
-def influxdb_write(client, data, ts=time.time()):
+def influxdb_points(measurement_instance, data, ts=None):
+    ''' return the influxdb points for the metrics in data of measurement_instance sampled at ts, or now '''
+    if ts is None:
+        ts = time.time()
     points = list()
-    data_class = data.measurement_class.name
-    data_title = data.presentation.title
-    data_id = data.name
-    data_host = data.host.name
+    data_class = measurement_instance.measurement_class.name
+    data_title = (measurement_instance.presentation or dict()).get('title', measurement_instance.name)
+    data_id = measurement_instance.name
+    data_host = measurement_instance.host.name
     for k, v in list(data.items()):
         if k.startswith('_'):
             continue
@@ -144,7 +160,11 @@ def influxdb_write(client, data, ts=time.time()):
             }
         }
         points.append(point)
+    return points
+
+def influxdb_write(client, points):
     try:
-        client.write_points(points, time_precision=InfluxDatabaseBackend.TIME_PRECISION)
+        client.write_points(points, time_precision=InfluxDatabaseBackend.TIME_PRECISION,
+                            batch_size=C.DEFAULT_INFLUXDB_BATCH)
     except influxdb.exceptions.InfluxDBClientError as e:
         logging.error("failed to write data: %s", str(e))
@@ -38,6 +38,7 @@ class RrdDatabaseBackend(BaseDatabaseBackend):
         else:
             self.path = None
         self.measurement_instance = None
+        self._created = set()   # paths known to exist
 
     @property
     def path(self):
@@ -47,22 +48,52 @@ class RrdDatabaseBackend(BaseDatabaseBackend):
     def path(self, arg):
         self._path = arg
 
-    def write(self, data, xlate=None):
+    def write(self, data, xlate=None, ts=None):
         ''' write data to rrd database '''
         if self.measurement_instance is None:
             logging.error("unable to write to rrd without a measurement_instance property")
             return None
-        host = self.measurement_instance.host.name
-        mcls = self.measurement_instance.measurement_class.name
-        transport = self.measurement_instance.measurement_class.transport
-        inst = self.measurement_instance.index
         if not self.path:
-            self.path = mk_rrd_filename(host, mcls, inst)
-        if not os.path.exists(self.path):
-            mcls_types = self.measurement_instance.measurement_class.metric_type
+            self.path = self._mk_rrd(self.measurement_instance, xlate)
+        elif not os.path.exists(self.path):
+            self._created.discard(self.path)
+            self._mk_rrd(self.measurement_instance, xlate, self.path)
+        if not self.path:
+            return False
+        return rrd_update(self.path, data, ts)
+
+    def write_many(self, samples, xlate=None, ts=None):
+        '''
+        write samples, a list of (measurement instance, metrics) pairs, to
+        the rrd of each measurement instance
+        '''
+        for measurement_instance, data in samples:
+            path = self._mk_rrd(measurement_instance, xlate)
+            if path is None:
+                continue
+            if not rrd_update(path, data, ts):
+                # check the rrd still exists before the next update
+                self._created.discard(path)
+
+    def _mk_rrd(self, measurement_instance, xlate=None, path=None):
+        '''
+        return the path to the rrd of measurement_instance, creating it if
+        missing, or None if it could not be created
+        '''
+        if path is None:
+            path = mk_rrd_filename(measurement_instance.host.name,
+                                   measurement_instance.measurement_class.name,
+                                   measurement_instance.index)
+        if path in self._created:
+            return path
+        if not os.path.exists(path):
+            mcls_types = measurement_instance.measurement_class.metric_type
             mcls_types = netspryte.utils.xlate_metric_names(mcls_types, xlate)
-            rrd_create(self.path, C.DEFAULT_RRD_STEP, mcls_types, C.DEFAULT_RRD_RRA)
-        return rrd_update(self.path, data)
+            rrd_create(path, C.DEFAULT_RRD_STEP, mcls_types, C.DEFAULT_RRD_RRA)
+            if not os.path.exists(path):
+                return None
+        self._created.add(path)
+        return path
 
 
 def rrd_create(path, step, data_types, rra):
@@ -81,8 +112,10 @@ def rrd_create(path, step, data_types, rra):
         logging.error("failed to create rrd %s: %s", path, str(e))
 
 
-def rrd_update(path, data, ts=time.time()):
-    ''' update rrd '''
+def rrd_update(path, data, ts=None):
+    ''' update rrd with data sampled at ts, or now; returns True if it was updated '''
+    if ts is None:
+        ts = int(time.time())
     template = list()
     values = list()
     for k, v in list(data.items()):
@@ -99,6 +132,8 @@ def rrd_update(path, data, ts=time.time()):
         rrdtool.update(str(path), '--template', flat_template, "%s:%s" % (ts, flat_values))
     except (rrdtool.OperationalError, rrdtool.ProgrammingError) as e:
         logging.error("failed to update rrd %s: %s", path, str(e))
+        return False
+    return True
 
 
 def rrd_graph(path, rrd_opts, graph_opts):
@@ -35,3 +35,9 @@ class NetspryteError(Exception):
 
 class NetspryteSNMPError(NetspryteError):
     pass
+
+class NetspryteSNMPUnreachable(NetspryteSNMPError):
+    pass
+
+class NetspryteTimeout(NetspryteError):
+    pass
@@ -17,6 +17,9 @@
 # along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
+import io
+import json
 import os
 import logging
 import operator
@@ -50,6 +53,65 @@ def build_clause(cls, col, val, timeop=operator.lt):
     return clause
 
 
+def copy_field(value):
+    '''
+    Return value as a field of COPY ... CSV input.  NULL is an unquoted
+    empty field; anything else is quoted, so empty strings stay strings.
+    '''
+    if value is None:
+        return ''
+    return '"%s"' % str(value).replace('"', '""')
+
+
+class IdentityMap(object):
+    '''
+    Rows a worker has written, kept across collection cycles along with a
+    hash of each field's value.  Comparing against the hashes tells which
+    fields of a row actually changed and need to be written again.
+    '''
+
+    def __init__(self):
+        self._rows = dict()   # (model name, key) -> { 'id', 'obj', 'hashes' }
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def hash(value):
+        ''' return a content hash of a json ready value '''
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, model, key):
+        ''' return the entry for the row of model with key, or None '''
+        return self._rows.get((model.__name__, key))
+
+    def put(self, model, key, rowid, fields=None, obj=None):
+        ''' remember the row of model with key and the values just written for fields '''
+        entry = self._rows.setdefault((model.__name__, key), {'id': rowid, 'obj': None, 'hashes': dict()})
+        entry['id'] = rowid
+        if obj is not None:
+            entry['obj'] = obj
+        for name, value in list((fields or dict()).items()):
+            entry['hashes'][name] = IdentityMap.hash(value)
+        return entry
+
+    def changed(self, model, key, fields):
+        ''' return the names of fields whose values differ from those last written '''
+        entry = self.get(model, key)
+        if entry is None:
+            return list(fields.keys())
+        return [name for name, value in list(fields.items())
+                if entry['hashes'].get(name) != IdentityMap.hash(value)]
+
+    def forget(self, model, key=None):
+        ''' forget the row of model with key, or all rows of model '''
+        if key is not None:
+            self._rows.pop((model.__name__, key), None)
+            return
+        for k in [k for k in self._rows if k[0] == model.__name__]:
+            del self._rows[k]
+
+
 class Manager(object):
     ''' db manager object '''
 
@@ -93,6 +155,26 @@ class Manager(object):
         Tag.create_table(fail_silently=True)
         MeasurementInstanceTag.create_table(fail_silently=True)
         HostTag.create_table(fail_silently=True)
+        LatestMetric.create_table(fail_silently=True)
+        Collector.create_table(fail_silently=True)
+        if 'postgres' in self.engine:
+            self._set_unlogged(LatestMetric)
+
+    def _set_unlogged(self, model):
+        '''
+        Make the table of model unlogged.  Its rows are rewritten on every
+        poll and can be rebuilt from the next poll, so they are not worth
+        the WAL traffic; Postgres empties unlogged tables after a crash.
+        '''
+        table = model._meta.table_name
+        try:
+            cursor = self.database.execute_sql("SELECT relpersistence FROM pg_class WHERE relname = %s", (table,))
+            row = cursor.fetchone()
+            if row is not None and row[0] != 'u':
+                self.database.execute_sql('ALTER TABLE "%s" SET UNLOGGED' % table)
+                logging.info("set table %s unlogged", table)
+        except peewee.DatabaseError as e:
+            logging.warn("failed to make table %s unlogged: %s", table, str(e))
 
     def execute(self, modquery, nocommit=False):
         ''' execute a model query; returns number of rows affected '''
@@ -141,6 +223,172 @@ class Manager(object):
             logging.error("error while attempting to update database: %s", traceback.format_exc())
         return instance
 
+    def update_by_id(self, model, ids, **kwargs):
+        ''' set fields to the given values on the rows of model with ids; returns rows updated '''
+        count = 0
+        try:
+            with self.database.atomic():
+                for batch in peewee.chunked(ids, C.DEFAULT_DB_BATCH):
+                    count += model.update(**kwargs).where(model.id << batch).execute()
+        except peewee.DatabaseError as e:
+            logging.error("error while attempting to update database: %s", traceback.format_exc())
+        return count
+
+    def bulk_upsert(self, model, rows, key='name', fill=(), returning=True):
+        '''
+        Insert rows of model, a list of dicts of field name to value, in one
+        transaction.  Rows that conflict with an existing row on the unique
+        field key (or tuple of fields) update it instead; fields in fill are
+        only written if the existing row has no value.  A field missing from
+        a row leaves the existing value alone.  Large batches on Postgres are
+        loaded with COPY.  Returns a dict of key value (a tuple for a tuple
+        of fields) to id, or an empty dict if returning is False.
+        '''
+        ids = dict()
+        if not rows:
+            return ids
+        keys = key if isinstance(key, tuple) else (key,)
+        groups = dict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row.keys())), list()).append(row)
+        try:
+            with self.database.atomic():
+                for fields, group in list(groups.items()):
+                    if 'postgres' in self.engine and len(group) >= C.DEFAULT_DB_COPY_ROWS:
+                        self._copy_upsert(model, fields, group, keys, fill)
+                    else:
+                        self._insert_upsert(model, fields, group, keys, fill)
+                if returning:
+                    ids = self._upserted_ids(model, rows, key, keys)
+        except peewee.DatabaseError as e:
+            logging.error("error while attempting to update database: %s", traceback.format_exc())
+        return ids
+
+    def _upserted_ids(self, model, rows, key, keys):
+        ''' return a dict of key value to id for upserted rows '''
+        ids = dict()
+        wanted = set(tuple(row[k] for k in keys) for row in rows)
+        first = getattr(model, keys[0])
+        values = list(set(row[keys[0]] for row in rows))
+        for batch in peewee.chunked(values, C.DEFAULT_DB_BATCH):
+            qry = model.select(model.id, *[getattr(model, k) for k in keys]).where(first << batch)
+            for inst in qry:
+                value = tuple(inst.__data__.get(k) for k in keys)
+                if value in wanted:
+                    ids[value if isinstance(key, tuple) else value[0]] = inst.id
+        return ids
+
+    def _upsert_update(self, model, fields, keys, fill):
+        ''' return the SET clause for rows conflicting on keys '''
+        update = dict()
+        for name in fields:
+            if name in keys:
+                continue
+            field = getattr(model, name)
+            if name in fill:
+                update[field] = fn.COALESCE(field, getattr(peewee.EXCLUDED, field.column_name))
+            else:
+                update[field] = getattr(peewee.EXCLUDED, field.column_name)
+        return update
+
+    def _insert_upsert(self, model, fields, rows, keys, fill):
+        ''' upsert rows with batched INSERT ... ON CONFLICT '''
+        update = self._upsert_update(model, fields, keys, fill)
+        for batch in peewee.chunked(rows, C.DEFAULT_DB_BATCH):
+            if update:
+                qry = model.insert_many(batch).on_conflict(conflict_target=[getattr(model, k) for k in keys],
+                                                           update=update)
+            else:
+                # rows of nothing but the key only need to exist
+                qry = model.insert_many(batch).on_conflict_ignore()
+            qry.execute()
+
+    def _copy_upsert(self, model, fields, rows, keys, fill):
+        ''' upsert rows by COPYing them to a temporary table and merging it '''
+        table = model._meta.table_name
+        temp = "%s_upsert" % table
+        columns = [getattr(model, name).column_name for name in fields]
+        buf = io.StringIO()
+        for row in rows:
+            values = list()
+            for name in fields:
+                field = getattr(model, name)
+                value = field.db_value(row[name])
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                elif hasattr(value, 'adapted'):
+                    value = json.dumps(value.adapted)
+                elif isinstance(value, datetime.datetime):
+                    value = value.isoformat()
+                values.append(copy_field(value))
+            buf.write(",".join(values) + "\n")
+        buf.seek(0)
+        assignments = list()
+        for name, column in zip(fields, columns):
+            if name in keys:
+                continue
+            if name in fill:
+                assignments.append('"%s" = COALESCE("%s"."%s", EXCLUDED."%s")' % (column, table, column, column))
+            else:
+                assignments.append('"%s" = EXCLUDED."%s"' % (column, column))
+        column_list = ", ".join('"%s"' % column for column in columns)
+        cursor = self.database.cursor()
+        cursor.execute('DROP TABLE IF EXISTS "%s"' % temp)
+        cursor.execute('CREATE TEMPORARY TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) ON COMMIT DROP' % (temp, table))
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH CSV' % (temp, column_list), buf)
+        conflict = ", ".join('"%s"' % getattr(model, k).column_name for k in keys)
+        action = "DO UPDATE SET %s" % ", ".join(assignments) if assignments else "DO NOTHING"
+        cursor.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s" ON CONFLICT (%s) %s' %
+                       (table, column_list, column_list, temp, conflict, action))
+        logging.debug("copied %s rows into %s", len(rows), table)
+
+    def write_latest_metrics(self, metrics, updated=None):
+        '''
+        Record the latest sample of measurement instances.  metrics is a
+        dict of measurement instance id to a dict of metric name to value.
+        '''
+        updated = updated or datetime.datetime.now()
+        rows = list()
+        for inst_id, values in list(metrics.items()):
+            for name, value in list(values.items()):
+                rows.append(dict(measurement_instance=inst_id, name=name, value=value, updated=updated))
+        self.bulk_upsert(LatestMetric, rows, key=('measurement_instance', 'name'), returning=False)
+        return len(rows)
+
+    def get_latest_metrics(self, instances):
+        '''
+        Return the latest samples of measurement instances as a dict of
+        measurement instance id to a dict of metric name to value.
+        '''
+        result = dict()
+        ids = [getattr(inst, 'id', inst) for inst in instances]
+        for batch in peewee.chunked(ids, C.DEFAULT_DB_BATCH):
+            qry = LatestMetric.select().where(LatestMetric.measurement_instance << batch)
+            for metric in qry:
+                result.setdefault(metric.measurement_instance_id, dict())[metric.name] = metric.value
+        return result
+
+    def heartbeat(self, name):
+        ''' record that the collector name is alive '''
+        self.bulk_upsert(Collector, [dict(name=name, heartbeat=datetime.datetime.now())], returning=False)
+
+    def get_collectors(self, timeout=C.DEFAULT_SHARD_TIMEOUT):
+        ''' return the names of the collectors that sent a heartbeat within timeout seconds '''
+        since = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        try:
+            qry = Collector.select(Collector.name).where(Collector.heartbeat >= since).order_by(Collector.name)
+            return [collector.name for collector in qry]
+        except peewee.DatabaseError as e:
+            logging.error("failed to look up collectors: %s", traceback.format_exc())
+            return list()
+
+    def retire_collector(self, name):
+        ''' forget the collector name so its devices are handed to other collectors at once '''
+        try:
+            Collector.delete().where(Collector.name == name).execute()
+        except peewee.DatabaseError as e:
+            logging.error("failed to remove collector %s: %s", name, traceback.format_exc())
+
     def delete(self, model, query):
         ''' delete instances of a model '''
         logging.debug("deleting object(s)")
@@ -204,6 +452,20 @@ class Manager(object):
         else:
             return [ q for q in qry ]
 
+    def get_instances_by_host_and_class(self, host, cls, paginated=False):
+        '''
+        Return list of measurement instances for a host name and measurement class name.
+        If paginated is True, return a peewee Query object.
+        '''
+        qry = (MeasurementInstance.select()
+               .join(Host).switch(MeasurementInstance)
+               .join(MeasurementClass)
+               .where((Host.name == host) & (MeasurementClass.name == cls)))
+        if paginated:
+            return qry
+        else:
+            return [ q for q in qry ]
+
     def get_instances_by_attribute(self, key, val, paginated=False):
         '''
         Return list of measurement instances based on a matching attribute value.
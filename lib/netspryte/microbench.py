@@ -0,0 +1,232 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Microbenchmarks of the functions run for every varbind and metric of a
+collection cycle, over synthetic tables the size of those of large
+devices.  Each benchmark calls its function once per item of a table and
+reports the time per call in nanoseconds and the memory blocks and bytes
+per call that are still allocated after the pass, as traced by
+tracemalloc.  Results are JSON ready so runs can be compared with
+compare().
+'''
+
+import gc
+import time
+import logging
+import tracemalloc
+
+from pysnmp.proto.rfc1902 import Counter64, Gauge32, Integer, ObjectIdentifier, ObjectName, OctetString
+
+import netspryte.snmp
+import netspryte.utils
+from netspryte.snmp import deconstruct_oid, get_oid_trie, strip_oid, mk_pretty_value, process_snmp_results
+from netspryte.snmp.simulator import Fixture, interface_table
+from netspryte.snmp.host.interface import HostInterface
+from netspryte.snmp.host.entity import HostEntity
+from netspryte.snmp.vendor.cisco.cbqos import CiscoCBQOS
+
+TABLES = ('interface', 'cbqos', 'entity')
+
+
+def _varbinds(objects):
+    ''' return (ObjectName, value) varbinds of objects, as returned by pysnmp, in OID order '''
+    fixture = Fixture(objects)
+    varbinds = list()
+    found = fixture.next('0')
+    while found is not None:
+        varbinds.append((ObjectName(found[0]), found[1]))
+        found = fixture.next(found[0])
+    return varbinds
+
+
+def interface_varbinds(count):
+    ''' the ifTable and ifXTable varbinds of count interfaces '''
+    return _varbinds(interface_table(count))
+
+
+def cbqos_varbinds(count):
+    ''' the configuration and police statistics varbinds of count policers '''
+    objects = dict()
+    for i in range(count):
+        index = "%s.%s" % (1000 + i // 8, 100000 + i)
+        for name, oid in list(CiscoCBQOS.ATTRS.items()):
+            if name in ('cbQosPolicyMapName', 'cbQosCMName'):
+                objects["%s.%s" % (oid, index)] = OctetString("%s-%s" % (name, i))
+            else:
+                objects["%s.%s" % (oid, index)] = Integer(i % 13 + 1)
+        for name, oid in list(CiscoCBQOS.STAT.items()):
+            if name.endswith('BitRate'):
+                objects["%s.%s" % (oid, index)] = Gauge32(i * 1000)
+            else:
+                objects["%s.%s" % (oid, index)] = Counter64(i * 10 ** 9)
+    return _varbinds(objects)
+
+
+def entity_varbinds(count):
+    ''' the entPhysicalTable varbinds of count components '''
+    objects = dict()
+    for i in range(1, count + 1):
+        for name, oid in list(HostEntity.ATTRS.items()):
+            if name == 'entPhysicalVendorType':
+                value = ObjectIdentifier('1.3.6.1.4.1.9.12.3.1.9.%s' % (i % 50))
+            elif name in ('entPhysicalContainedIn', 'entPhysicalClass', 'entPhysicalIsFRU'):
+                value = Integer(i % 10 + 1)
+            else:
+                value = OctetString("%s %s" % (name, i))
+            objects["%s.%s" % (oid, i)] = value
+    return _varbinds(objects)
+
+
+class Table(object):
+    ''' the varbinds of a SNMP module and the rows and metrics it makes of them '''
+
+    host = 'microbench'
+
+    def __init__(self, name, cls, varbinds):
+        self.name = name
+        self.cls = cls
+        self.oids = dict(cls.ATTRS)
+        self.oids.update(cls.STAT)
+        self.xlate = getattr(cls, 'XLATE', None)
+        self.varbinds = varbinds
+        self.values = [value for oid, value in varbinds]
+        self.names = [str(oid) for oid, value in varbinds]
+        rows = process_snmp_results(self, list(zip(self.names, self.values)), self.oids,
+                                    getattr(cls, 'CONVERSION', {}))
+        self.rows = list(rows.values())
+        self.metrics = [dict((k, v) for k, v in list(row.items()) if k in cls.STAT) for row in self.rows]
+        self.metric_names = [k for metrics in self.metrics for k in metrics]
+
+
+def mk_tables(interfaces=1000, policers=2000, entities=500):
+    ''' return the synthetic Tables, by name '''
+    return {
+        'interface' : Table('interface', HostInterface, interface_varbinds(interfaces)),
+        'cbqos'     : Table('cbqos', CiscoCBQOS, cbqos_varbinds(policers)),
+        'entity'    : Table('entity', HostEntity, entity_varbinds(entities)),
+    }
+
+
+def mk_cases(table, session):
+    '''
+    Return (name, func, items) for each benchmark of table: func is
+    called once with each item of items.
+    '''
+    trie = get_oid_trie(table.oids)
+    strip_items = [(deconstruct_oid(name, table.oids, trie).get('base', name), name) for name in table.names]
+    return [
+        ('deconstruct_oid', lambda arg: deconstruct_oid(arg, table.oids, trie), table.names),
+        ('strip_oid', lambda item: strip_oid(*item), strip_items),
+        ('_snmp_varbind_to_list', session._snmp_varbind_to_list, table.varbinds),
+        ('mk_pretty_value', mk_pretty_value, table.values),
+        ('json_ready', netspryte.utils.json_ready, table.rows),
+        ('xlate_metric_names', lambda metrics: netspryte.utils.xlate_metric_names(metrics, table.xlate),
+         table.metrics),
+        ('clean_metric_name', lambda name: netspryte.utils.clean_metric_name(name, table.xlate),
+         table.metric_names),
+    ]
+
+
+def measure(func, items, repeat=5):
+    '''
+    Call func on every item, repeat times, and return the best and median
+    nanoseconds per call, then once more under tracemalloc for the blocks
+    and bytes per call still allocated after the pass.
+    '''
+    if not items:
+        return None
+    timings = list()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            for item in items:
+                func(item)
+            timings.append((time.perf_counter() - start) * 1e9 / len(items))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    timings.sort()
+    tracemalloc.start()
+    try:
+        tracemalloc.clear_traces()
+        before = tracemalloc.take_snapshot()
+        kept = [func(item) for item in items]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    blocks = sum(max(0, stat.count_diff) for stat in diff)
+    size = sum(max(0, stat.size_diff) for stat in diff)
+    del kept
+    return dict(
+        ops=len(items),
+        ns_per_op=round(timings[0], 1),
+        ns_per_op_median=round(timings[len(timings) // 2], 1),
+        blocks_per_op=round(blocks / float(len(items)), 2),
+        bytes_per_op=round(size / float(len(items)), 1),
+    )
+
+
+def run(tables=None, repeat=5, only=None):
+    '''
+    Run the benchmarks of tables, or of mk_tables() if not given, and
+    return a list of results.  If only is given, only the functions named
+    in it are benchmarked.
+    '''
+    if tables is None:
+        tables = mk_tables()
+    session = netspryte.snmp.SNMPSession(host='127.0.0.1')
+    results = list()
+    for name in TABLES:
+        if name not in tables:
+            continue
+        for func_name, func, items in mk_cases(tables[name], session):
+            if only and func_name not in only:
+                continue
+            result = measure(func, items, repeat)
+            if result is None:
+                continue
+            result.update(function=func_name, table=name)
+            logging.info("%s on %s: %s ns/op, %s blocks/op", func_name, name,
+                         result['ns_per_op'], result['blocks_per_op'])
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Return the results that are more than threshold (a fraction) slower
+    or allocate more blocks per call than the same benchmark in baseline.
+    '''
+    previous = dict(((r['function'], r['table']), r) for r in baseline)
+    regressions = list()
+    for result in results:
+        before = previous.get((result['function'], result['table']))
+        if before is None:
+            continue
+        slower = result['ns_per_op'] > before['ns_per_op'] * (1 + threshold)
+        more_blocks = result['blocks_per_op'] > before['blocks_per_op'] * (1 + threshold) + 0.01
+        if slower or more_blocks:
+            regression = dict(result)
+            regression.update(baseline_ns_per_op=before['ns_per_op'],
+                              baseline_blocks_per_op=before['blocks_per_op'])
+            regressions.append(regression)
+    return regressions
@@ -107,3 +107,30 @@ class HostTag(BaseModel):
 
     class Meta:
         db_table = "host_tag"
+
+class LatestMetric(BaseModel):
+    measurement_instance = ForeignKeyField(MeasurementInstance, backref='latest_metrics', on_delete='CASCADE')
+    name = CharField()
+    value = DecimalField(max_digits=30, decimal_places=6, auto_round=True, null=True)
+    updated = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        db_table = "latest_metric"
+        indexes = (
+            (('measurement_instance', 'name'), True),
+        )
+
+    def __repr__(self):
+        return '<LatestMetric: %s>' % self.name
+
+class Collector(BaseModel):
+    name = CharField(unique=True)
+    heartbeat = DateTimeField(default=datetime.datetime.now, index=True)
+    started = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        db_table = "collector"
+        order_by = ("name",)
+
+    def __repr__(self):
+        return '<Collector: %s>' % self.name
@@ -0,0 +1,114 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import hashlib
+import logging
+
+from netspryte import constants as C
+from netspryte.manager import Manager
+
+
+class HashRing(object):
+    '''
+    A consistent hash ring of collector nodes.  Each node is placed on the
+    ring `replicas` times, and a key belongs to the first node clockwise
+    of its hash.  Adding or removing a node only moves the keys of that
+    node's arcs of the ring.
+    '''
+
+    def __init__(self, nodes=(), replicas=C.DEFAULT_SHARD_REPLICAS):
+        self.replicas = replicas
+        self._ring = list()   # sorted list of (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    @property
+    def nodes(self):
+        return sorted(set(node for h, node in self._ring))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self._ring, (HashRing.hash("%s#%s" % (node, i)), node))
+
+    def remove(self, node):
+        self._ring = [(h, n) for h, n in self._ring if n != node]
+
+    def get(self, key):
+        ''' return the node key belongs to, or None if the ring is empty '''
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._ring, (HashRing.hash(key),))
+        return self._ring[i % len(self._ring)][1]
+
+
+class Shard(object):
+    '''
+    The share of devices polled by one collector node.
+
+    Collectors register in the Collector table of the database and send
+    a heartbeat each time they look up their devices.  The devices given,
+    the addresses collectors poll, are spread over the collectors seen
+    within C.DEFAULT_SHARD_TIMEOUT with a HashRing, so the devices of a
+    collector that stops are taken over by the others.  Every collector
+    must be given the same device list.  Host records are not used, since
+    their names are the sysName of a device rather than its address.
+    '''
+
+    def __init__(self, name=C.DEFAULT_SHARD_NAME):
+        self.name = name
+        self.assigned = None
+
+    def heartbeat(self, mgr):
+        mgr.heartbeat(self.name)
+
+    def retire(self, mgr):
+        logging.warn("collector %s leaving", self.name)
+        mgr.retire_collector(self.name)
+
+    def ring(self, mgr):
+        ''' return the HashRing of live collectors, which always includes this one '''
+        nodes = set(mgr.get_collectors(C.DEFAULT_SHARD_TIMEOUT))
+        nodes.add(self.name)
+        return HashRing(nodes)
+
+    def devices(self, mgr, devices=()):
+        ''' return the devices, of those given, that this collector polls '''
+        names = set(devices)
+        ring = self.ring(mgr)
+        assigned = sorted(device for device in names if ring.get(device) == self.name)
+        if assigned != self.assigned:
+            logging.warn("collector %s polling %s of %s devices with %s collectors",
+                         self.name, len(assigned), len(names), len(ring.nodes))
+            self.assigned = assigned
+        return assigned
+
+
+def shard_devices(devices, name=C.DEFAULT_SHARD_NAME):
+    ''' send a heartbeat as collector name and return its share of devices '''
+    mgr = Manager()
+    try:
+        shard = Shard(name)
+        shard.heartbeat(mgr)
+        return shard.devices(mgr, devices)
+    finally:
+        mgr.close()
@@ -16,8 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import time
 import logging
+import threading
+from collections import OrderedDict
 from pysnmp.entity.rfc3413.oneliner import cmdgen
 from pysnmp.proto.rfc1902 import (
     Counter32,
@@ -33,11 +36,15 @@ from pysnmp.proto.rfc1902 import (
 )
 from pysnmp.proto.rfc1905 import (
     EndOfMibView,
+    NoSuchInstance,
+    NoSuchObject,
 )
 
 import netspryte.utils
+import netspryte.utils.stats
 from netspryte import constants as C
-from netspryte.errors import NetspryteSNMPError
+from netspryte.errors import NetspryteSNMPError, NetspryteSNMPUnreachable
+from netspryte.snmp.store import get_walk_store
 from netspryte.utils.timer import Timer
 
 
@@ -52,6 +59,14 @@ def value_is_metric(arg):
         return False
 
 
+def get_metric_value(arg):
+    ''' return the numeric value of a metric, or None if it is not numeric '''
+    try:
+        return int(arg)
+    except (TypeError, ValueError):
+        return None
+
+
 def get_value_type(arg):
     if isinstance(arg, Counter32) or isinstance(arg, Counter64):
         return 'counter'
@@ -113,17 +128,81 @@ def strip_oid(oid, arg):
         return result
 
 
-def deconstruct_oid(arg, oid_set):
-    ''' break an OID into parts '''
+class OidTrie(object):
+    '''
+    A prefix trie of OIDs split into their sub-identifiers.
+
+    Looking up an OID walks the trie one sub-identifier at a time, so the
+    cost depends on the depth of the OID rather than on the number of OIDs
+    in the trie.  The longest OID in the trie that is a strict prefix of
+    the one looked up wins.
+    '''
+
+    def __init__(self, oid_set=None):
+        self._root = dict()
+        if oid_set:
+            for name, oid in list(oid_set.items()):
+                self.add(name, oid)
+
+    def add(self, name, oid):
+        node = self._root
+        for part in oid.strip('.').split('.'):
+            node = node.setdefault(part, dict())
+        node[None] = (name, oid)
+
+    def match(self, arg, inclusive=False):
+        '''
+        return (name, base oid, index) for arg, or None if arg is not in the
+        trie.  If inclusive is True, an OID equal to arg also matches.
+        '''
+        parts = arg.lstrip('.').split('.')
+        node = self._root
+        found = None
+        for depth, part in enumerate(parts if inclusive else parts[:-1]):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], depth + 1)
+        if found is None:
+            return None
+        (name, oid), depth = found
+        return (name, oid, '.'.join(parts[depth:]))
+
+
+_OID_TRIES = OrderedDict()   # frozenset of (name, OID) -> OidTrie, least recently used first
+_OID_TRIES_SIZE = 256
+_OID_TRIES_LOCK = threading.Lock()
+
+
+def get_oid_trie(oid_set):
+    '''
+    Return the OidTrie for a dict of name to OID, building it the first
+    time those OIDs are seen.  Tries are kept by the dict's contents, so
+    modules that build their OID dicts per poll share one trie, and only
+    the _OID_TRIES_SIZE most recently used are kept.
+    '''
+    key = frozenset(oid_set.items())
+    with _OID_TRIES_LOCK:
+        trie = _OID_TRIES.get(key)
+        if trie is not None:
+            _OID_TRIES.move_to_end(key)
+            return trie
+    trie = OidTrie(oid_set)
+    with _OID_TRIES_LOCK:
+        _OID_TRIES[key] = trie
+        while len(_OID_TRIES) > _OID_TRIES_SIZE:
+            _OID_TRIES.popitem(last=False)
+    return trie
+
+
+def deconstruct_oid(arg, oid_set, trie=None):
+    ''' break an OID into parts; trie is the OidTrie of oid_set, if already at hand '''
     oid = dict()
     oid['oid'] = arg
-    for k in list(oid_set.keys()):
-        index = strip_oid(oid_set[k], arg)
-        if index != arg:
-            oid['base'] = oid_set[k]
-            oid['name'] = k
-            oid['index'] = index
-            break
+    match = (trie or get_oid_trie(oid_set)).match(arg)
+    if match is not None:
+        oid['name'], oid['base'], oid['index'] = match
     return oid
 
 
@@ -139,9 +218,8 @@ def get_snmp_data(snmp, host, cls_name, snmp_oids, snmp_conversion, chunk=None):
     - chunk: optional argument for splitting queries up into smaller chunks.  This is the chunk size.
     Returns a dictionary indexed by the SNMP index for the table.
     '''
-    t = Timer("snmp query {0}-{1}".format(snmp.host, cls_name))
+    t = Timer("snmp query {0}-{1}".format(snmp.host, cls_name), "walk")
     t.start_timer()
-    data = dict()
     results = list()
     if chunk:
         oids = list(snmp_oids.values())
@@ -150,9 +228,44 @@ def get_snmp_data(snmp, host, cls_name, snmp_oids, snmp_conversion, chunk=None):
             results.extend(snmp.walk(*qry_set))
     else:
         results = snmp.walk(*[oid for oid in list(snmp_oids.values())])
+    data = process_snmp_results(snmp, results, snmp_oids, snmp_conversion)
+    t.stop_timer()
+    return data
+
+
+def get_snmp_data_by_index(snmp, host, cls_name, snmp_oids, snmp_conversion, indexes,
+                           chunk=C.DEFAULT_SNMP_GET_VARBINDS):
+    '''
+    Like get_snmp_data, but rather than walking the columns in snmp_oids,
+    GET them for just the table rows in indexes.  The GETs are packed with
+    up to chunk varbinds per PDU.
+    Returns a dictionary indexed by the SNMP index for the table.
+    '''
+    t = Timer("snmp get {0}-{1}".format(snmp.host, cls_name), "get")
+    t.start_timer()
+    results = list()
+    oids = ["%s.%s" % (oid, index) for index in indexes for oid in list(snmp_oids.values())]
+    for i in range(0, len(oids), chunk):
+        try:
+            results.extend(snmp.get(*oids[i:i + chunk]))
+        except NetspryteSNMPError as e:
+            logging.error("caught snmp error with %s: %s", snmp.host, str(e))
+    results = [obj for obj in results if not isinstance(obj[1], (NoSuchInstance, NoSuchObject))]
+    data = process_snmp_results(snmp, results, snmp_oids, snmp_conversion)
+    t.stop_timer()
+    return data
+
+
+def process_snmp_results(snmp, results, snmp_oids, snmp_conversion):
+    '''
+    Take a list of (oid, value) results of querying snmp_oids and return
+    a dictionary indexed by the SNMP index for the table.
+    '''
+    data = dict()
+    trie = get_oid_trie(snmp_oids)
     for obj in results:
         logging.debug("Processing %s OID=%s, value=%s", snmp.host, obj[0], obj[1])
-        oid = deconstruct_oid(obj[0], snmp_oids)
+        oid = deconstruct_oid(obj[0], snmp_oids, trie)
         if 'index' not in oid:
             logging.debug("No match for OID=%s", obj[0])
             continue
@@ -165,10 +278,368 @@ def get_snmp_data(snmp, host, cls_name, snmp_oids, snmp_conversion, chunk=None):
             data[index][oid['name']] = snmp_conversion[oid['name']][int(obj[1])]
         else:
             data[index][oid['name']] = obj[1]
-    t.stop_timer()
     return data
 
 
+def is_timeout(error):
+    ''' return True if a snmp error message says the request timed out '''
+    return 'timeout' in str(error).lower()
+
+
+class DeviceState(object):
+    '''
+    Small key/value state learned about a device, such as its GETBULK
+    max-repetitions or whether it is reachable.  If a path is given, the
+    state is saved there whenever it changes so the next run starts from it.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = dict()
+        self.load()
+
+    def load(self):
+        ''' load previously saved state '''
+        if self.path is None or not os.path.exists(self.path):
+            return
+        data = netspryte.utils.parse_json_from_file(self.path)
+        if isinstance(data, dict):
+            self._data = data
+            logging.debug("loaded device state from %s", self.path)
+
+    @classmethod
+    def for_host(cls, host):
+        ''' return the state of host, saved in the snmp state directory '''
+        return cls(os.path.join(C.DEFAULT_SNMP_STATEDIR, "%s.json" % host))
+
+    def save(self):
+        ''' save the state '''
+        if self.path is None:
+            return
+        try:
+            netspryte.utils.json2path(self._data, self.path)
+        except (IOError, OSError) as e:
+            logging.error("failed to save device state to %s: %s", self.path, str(e))
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        ''' set a value, saving the state if it changed '''
+        self.update(**{key: value})
+
+    def update(self, **kwargs):
+        ''' set several values, saving the state if any changed '''
+        changed = [k for k, v in list(kwargs.items()) if self._data.get(k) != v]
+        if changed:
+            self._data.update(kwargs)
+            self.save()
+
+
+class AdaptiveBulk(object):
+    '''
+    Learn a GETBULK max-repetitions value for a device.
+
+    The value grows while walks need more than one PDU and each PDU stays
+    under the latency and size budgets, and is halved when the agent
+    answers tooBig, or times out after it has answered other queries, which
+    suggests the responses are too large rather than the device being
+    down.  The learned value is kept in the device's DeviceState.
+    '''
+
+    def __init__(self, value=C.DEFAULT_SNMP_BULK, state=None):
+        self.state = state or DeviceState()
+        self._value = int(self.state.get('max_repetitions', value))
+
+    def reload(self):
+        ''' pick up the value from the state, which may have been reloaded '''
+        self._value = int(self.state.get('max_repetitions', self._value))
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, arg):
+        self._value = int(arg)
+        self.state.set('max_repetitions', self._value)
+
+    def update(self, columns, varbinds, elapsed):
+        ''' adjust the value after a walk of columns returned varbinds in elapsed seconds '''
+        rows = varbinds // max(columns, 1)
+        pdus = rows // self.value + 1
+        if pdus <= 1:
+            return
+        latency = elapsed / pdus
+        value = self.value
+        if latency > C.DEFAULT_SNMP_BULK_LATENCY:
+            value = max(C.DEFAULT_SNMP_BULK_MIN, self.value - C.DEFAULT_SNMP_BULK_STEP)
+        elif columns * (self.value + C.DEFAULT_SNMP_BULK_STEP) <= C.DEFAULT_SNMP_BULK_VARBINDS:
+            value = min(C.DEFAULT_SNMP_BULK_MAX, self.value + C.DEFAULT_SNMP_BULK_STEP)
+        if value != self.value:
+            logging.debug("changing max-repetitions from %s to %s (%.3fs per pdu)", self.value, value, latency)
+            self.value = value
+
+    def backoff(self, error, responded=False):
+        '''
+        Halve the value if error suggests the responses are too large for
+        the agent: tooBig, or a timeout from an agent that responded to
+        earlier queries.  A timeout from an agent that has not responded
+        leaves the value alone, so an unreachable device does not lose
+        what was learned about it.  Returns True if the walk should be
+        retried with the new value.
+        '''
+        if 'toobig' not in error.lower() and not (responded and is_timeout(error)):
+            return False
+        if self.value <= C.DEFAULT_SNMP_BULK_MIN:
+            return False
+        self.value = max(C.DEFAULT_SNMP_BULK_MIN, self.value // 2)
+        return True
+
+
+class CircuitBreaker(object):
+    '''
+    Fail fast on queries to a device that does not respond.
+
+    The breaker trips when a query times out before the device has
+    answered anything in this cycle.  Once tripped, every further query
+    in the cycle fails immediately, so the remaining modules do not each
+    wait out the timeout.  Later cycles keep failing fast until a backoff
+    delay has passed; the delay doubles with each consecutive failure up to
+    C.DEFAULT_SNMP_BACKOFF_MAX.  After the delay one probe is let through
+    (half-open): an answer resets the breaker, another timeout trips it again.
+    A session kept across cycles must call reset() at the start of each.
+    '''
+
+    def __init__(self, state=None):
+        self.state = state or DeviceState()
+        self.tripped = False
+        self.responded = False
+
+    def reset(self):
+        ''' start a new cycle: nothing has been heard from the device yet '''
+        self.tripped = False
+        self.responded = False
+
+    @property
+    def failures(self):
+        return self.state.get('failures', 0)
+
+    @property
+    def retry_after(self):
+        return self.state.get('retry_after', 0)
+
+    def allow(self):
+        ''' return True if a query may be sent to the device '''
+        if self.tripped:
+            return False
+        return time.time() >= self.retry_after
+
+    def success(self):
+        ''' record that the device answered '''
+        self.responded = True
+        if self.failures:
+            logging.warn("device answered again after %s failures", self.failures)
+            self.state.update(failures=0, retry_after=0)
+
+    def failure(self, error):
+        ''' record a failed query; returns True if the breaker tripped '''
+        if self.responded or not is_timeout(error):
+            return False
+        failures = self.failures + 1
+        delay = min(C.DEFAULT_SNMP_BACKOFF_MAX, C.DEFAULT_SNMP_BACKOFF * 2 ** (failures - 1))
+        self.tripped = True
+        self.state.update(failures=failures, retry_after=time.time() + delay)
+        return True
+
+
+class SNMPCache(object):
+    '''
+    A size-bounded LRU cache of SNMP query results.
+
+    How long a result stays valid depends on the OIDs queried: a TTL may be
+    set for any OID prefix, the longest matching prefix wins and queries
+    for several OIDs use the shortest of their TTLs.  OIDs without a policy
+    use the default timeout.  A TTL of 0 means the result is never cached.
+
+    If a WalkStore is given, results cached for at least
+    snmp_cache_persist_ttl seconds are also written to it, and results
+    missing from memory are looked up there, so later runs find them.
+    '''
+
+    def __init__(self, size=C.DEFAULT_SNMP_CACHE_SIZE, timeout=C.DEFAULT_SNMP_CACHE_TIMEOUT,
+                 store=None, host=None):
+        self.size      = size
+        self.timeout   = timeout
+        self.store     = store
+        self.host      = host
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._entries  = OrderedDict()   # (kind, oids) -> [ expires, result ]
+        self._policy   = OidTrie()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_policy(self, prefix, ttl):
+        ''' cache results for OIDs under prefix for ttl seconds '''
+        self._policy.add(int(ttl), prefix)
+
+    def ttl(self, oids):
+        ''' return the number of seconds results for oids may be cached '''
+        ttl = None
+        for oid in oids:
+            found = self._policy.match(str(oid), inclusive=True)
+            oid_ttl = self.timeout if found is None else found[0]
+            if ttl is None or oid_ttl < ttl:
+                ttl = oid_ttl
+        return self.timeout if ttl is None else ttl
+
+    def get(self, key):
+        ''' return the cached result for key, or None if missing or expired '''
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            netspryte.utils.stats.counter("snmp_cache_hits", "SNMP queries answered from the cache").inc(
+                device=self.host)
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        if self.store is not None:
+            stored = self.store.get(self.host, key)
+            if stored is not None:
+                self._insert(key, stored[1], stored[0])
+                self.hits += 1
+                netspryte.utils.stats.counter("snmp_cache_hits", "SNMP queries answered from the cache").inc(
+                    device=self.host)
+                return stored[1]
+        self.misses += 1
+        netspryte.utils.stats.counter("snmp_cache_misses", "SNMP queries not answered from the cache").inc(
+            device=self.host)
+        return None
+
+    def put(self, key, result, ttl):
+        ''' cache result for key for ttl seconds, evicting the least recently used entries '''
+        if ttl <= 0:
+            return
+        expires = time.time() + ttl
+        if self.store is not None and ttl >= C.DEFAULT_SNMP_CACHE_PERSIST_TTL:
+            self.store.put(self.host, key, result, expires)
+        self._insert(key, result, expires)
+
+    def _insert(self, key, result, expires):
+        if self.size <= 0:
+            return
+        self._entries[key] = [expires, result]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, prefix=None):
+        ''' drop cached results for OIDs under prefix, or all results if prefix is None '''
+        if self.store is not None:
+            self.store.invalidate(self.host, prefix)
+        if prefix is None:
+            self._entries.clear()
+            return
+        prefix = prefix.strip('.')
+        for key in list(self._entries.keys()):
+            for oid in key[1]:
+                oid = oid.strip('.')
+                if oid == prefix or oid.startswith(prefix + '.'):
+                    del self._entries[key]
+                    break
+
+    @property
+    def stats(self):
+        ''' return a dict of cache statistics '''
+        return {
+            'entries'   : len(self._entries),
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+        }
+
+
+class DeviceProfile(object):
+    '''
+    What a device supports: its sysObjectID and which MIBs it answers
+    for.  The profile is kept in the device state, so it is learned once
+    and refreshed every snmp_profile_ttl seconds.  SNMP modules declare
+    the vendor subtree of sysObjectID they apply to in BASE_OID and the
+    MIBs they need in MIBS; applies() tells whether a module should be
+    run against the device.
+    '''
+
+    SYS_OBJECT_ID = '1.3.6.1.2.1.1.2.0'
+
+    def __init__(self, snmp, state=None):
+        self.snmp = snmp
+        self.state = state or DeviceState()
+        profile = self.state.get('profile') or dict()
+        if time.time() - profile.get('updated', 0) > C.DEFAULT_SNMP_PROFILE_TTL:
+            profile = dict()
+        self._profile = profile
+
+    def _save(self):
+        self._profile['updated'] = self._profile.get('updated') or time.time()
+        self.state.set('profile', dict(self._profile))
+
+    @property
+    def sysObjectID(self):
+        ''' the sysObjectID of the device, or None if it could not be read '''
+        if 'sysObjectID' not in self._profile:
+            try:
+                results = self.snmp.get(DeviceProfile.SYS_OBJECT_ID)
+            except NetspryteSNMPError as e:
+                logging.warn("failed to read sysObjectID of %s: %s", self.snmp.host, str(e))
+                return None
+            if not results or isinstance(results[0][1], (NoSuchInstance, NoSuchObject)):
+                return None
+            self._profile['sysObjectID'] = str(results[0][1].prettyPrint())
+            self._save()
+        return self._profile['sysObjectID']
+
+    @property
+    def device_class(self):
+        ''' the sysObjectID of the device if it is already known, without querying the device '''
+        return self._profile.get('sysObjectID')
+
+    def supports(self, mib):
+        ''' return True if the device has objects under the mib OID '''
+        mibs = self._profile.setdefault('mibs', dict())
+        if mib not in mibs:
+            try:
+                mibs[mib] = self.snmp.probe(mib)
+            except NetspryteSNMPError as e:
+                logging.warn("failed to probe %s for %s: %s", self.snmp.host, mib, str(e))
+                return True
+            logging.info("%s %s %s", self.snmp.host, "supports" if mibs[mib] else "does not support", mib)
+            self._save()
+        return mibs[mib]
+
+    def applies(self, cls, probe=True):
+        '''
+        return True if the snmp module cls applies to the device.  If probe
+        is False, only what is already known is used and the device is not
+        queried; a module is taken to apply unless known otherwise.
+        '''
+        base = getattr(cls, 'BASE_OID', None)
+        if base:
+            sys_object_id = self.sysObjectID if probe else self._profile.get('sysObjectID')
+            if sys_object_id is not None and not (sys_object_id + '.').startswith(base.strip('.') + '.'):
+                return False
+        for mib in getattr(cls, 'MIBS', ()):
+            if probe and not self.supports(mib):
+                return False
+            if not probe and not self._profile.get('mibs', dict()).get(mib, True):
+                return False
+        return True
+
+
 class SNMPSession(object):
     ''' a class to handle SNMP queries '''
 
@@ -186,12 +657,26 @@ class SNMPSession(object):
         self._authkey   = C.DEFAULT_SNMP_AUTHKEY
         self._privkey   = C.DEFAULT_SNMP_PRIVKEY
         self._bulk      = C.DEFAULT_SNMP_BULK
-        self._cache     = dict()   # (oids) -> [ time, result ]
+        self._cache     = SNMPCache()
+
+        self._adaptive_bulk = None
+        self._profile = None
+        self.deadline = None    # time by which queries must be answered, if limited
 
         for key in list(kwargs.keys()):
             if hasattr(self, key):
                 setattr(self, key, kwargs[key])
 
+        self._cache.host = self._host
+        self._cache.store = get_walk_store()
+        self._state = DeviceState.for_host(self._host)
+        self._breaker = CircuitBreaker(self._state)
+        if C.DEFAULT_SNMP_BULK_ADAPTIVE and self._bulk and 'bulk' not in kwargs:
+            self._adaptive_bulk = AdaptiveBulk(self._bulk, self._state)
+        self._setup_transport()
+
+    def _setup_transport(self):
+        ''' set up the command generator, credentials and transport for queries '''
         if self._version == '3':
             pass
         else:
@@ -265,6 +750,8 @@ class SNMPSession(object):
 
     @property
     def bulk(self):
+        if self._adaptive_bulk is not None:
+            return self._adaptive_bulk.value
         return self._bulk
 
     @bulk.setter
@@ -298,9 +785,37 @@ class SNMPSession(object):
         else:
             raise ValueError("SNMPv3 level must be one of: " + ", ".join(C.DEFAULT_ALLOWED_SNMP_LEVELS))
 
-    def expire_cache(self):
-        ''' expire the cache '''
-        self._cache = dict()
+    @property
+    def profile(self):
+        ''' the capability profile of the device '''
+        if self._profile is None:
+            self._profile = DeviceProfile(self, self._state)
+        return self._profile
+
+    def start_cycle(self):
+        '''
+        prepare a session kept from an earlier collection cycle for the next
+        one: pick up the device state saved since, possibly by another
+        worker, and give the circuit breaker a fresh start
+        '''
+        self._state.load()
+        self._breaker.reset()
+        if self._adaptive_bulk is not None:
+            self._adaptive_bulk.reload()
+        self._profile = None
+
+    @property
+    def reachable(self):
+        ''' False if queries to the device are being skipped because it stopped responding '''
+        return self._breaker.allow()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def expire_cache(self, prefix=None):
+        ''' expire cached results for OIDs under prefix, or the whole cache '''
+        self._cache.invalidate(prefix)
 
     def _snmp_varbind_to_list(self, varbind):
         ''' take a oid object and return a tuple of ( numerical_oid, value ) '''
@@ -316,37 +831,77 @@ class SNMPSession(object):
         logging.debug("snmp varbind %s: %s=%s", self.host, num_oid, mk_pretty_value(value))
         return (num_oid, value)
 
-    def _cache_results(self, oids, result):
-        ''' tie results to oid query set in cache '''
-        self._cache[oids] = [time.time(), result]
-
-    def _cmd(self, cmd, *oids):
-        ''' apply a generic snmp operation '''
+    def _cmd(self, cmd, *oids, **kwargs):
+        '''
+        apply a generic snmp operation; with decode=False a walk returns
+        the values as the command generator hands them back
+        '''
         results = []
-        errorIndication, errorStatus, errorIndex, varBindTable = cmd(
-            self._auth,
-            self._transport,
-            *oids
-        )
-        if errorIndication:
-            raise NetspryteSNMPError(str(errorIndication))
-        if errorStatus:
-            raise NetspryteSNMPError(errorStatus.prettyPrint())
-        if cmd in [self._cmdgen.getCmd, self._cmdgen.setCmd]:
-            results = [self._snmp_varbind_to_list(varbind) for varbind in varBindTable]
-        else:
-            results = [self._snmp_varbind_to_list(varbind)
-                       for row in varBindTable for varbind in row if not isinstance(varbind[1], EndOfMibView)]
+        decode = kwargs.pop('decode', True)
+        if not self._breaker.allow():
+            raise NetspryteSNMPUnreachable("skipping unresponsive device %s until %s" %
+                                           (self.host, time.ctime(self._breaker.retry_after)))
+        with Timer(cmd.__name__, "snmp/%s" % cmd.__name__, log=False, device=self.host) as span:
+            start = time.time()
+            errorIndication, errorStatus, errorIndex, varBindTable = cmd(
+                self._auth,
+                self._transport,
+                *oids,
+                **kwargs
+            )
+            elapsed = time.time() - start
+            netspryte.utils.stats.histogram("snmp_request_seconds", "Time taken by SNMP operations").observe(
+                elapsed, device=self.host, command=cmd.__name__)
+            if errorIndication:
+                if is_timeout(errorIndication):
+                    netspryte.utils.stats.counter("snmp_timeouts", "SNMP operations that timed out").inc(
+                        device=self.host)
+                else:
+                    netspryte.utils.stats.counter("snmp_errors", "SNMP operations that failed").inc(
+                        device=self.host)
+                if self._breaker.failure(errorIndication):
+                    logging.error("device %s did not respond; skipping it until %s", self.host,
+                                  time.ctime(self._breaker.retry_after))
+                raise NetspryteSNMPError(str(errorIndication))
+            self._breaker.success()
+            if errorStatus:
+                netspryte.utils.stats.counter("snmp_errors", "SNMP operations that failed").inc(device=self.host)
+                raise NetspryteSNMPError(errorStatus.prettyPrint())
+            with Timer("decode", "decode", log=False):
+                if not decode:
+                    results = [(str(oid), value) for row in varBindTable for oid, value in row
+                               if not isinstance(value, EndOfMibView)]
+                    pdus = len(varBindTable) + 1
+                elif cmd.__name__ in ('getCmd', 'setCmd'):
+                    results = [self._snmp_varbind_to_list(varbind) for varbind in varBindTable]
+                    pdus = 1
+                else:
+                    results = [self._snmp_varbind_to_list(varbind)
+                               for row in varBindTable for varbind in row
+                               if not isinstance(varbind[1], EndOfMibView)]
+                    if cmd == self._cmdgen.bulkCmd:
+                        pdus = len(varBindTable) // max(1, oids[1]) + 1
+                    else:
+                        pdus = len(varBindTable) + 1
+            span.set(varbinds=len(results))
+            netspryte.utils.stats.counter("snmp_pdus", "SNMP requests sent, estimated for walks").inc(
+                pdus, device=self.host)
+            netspryte.utils.stats.counter("snmp_varbinds", "SNMP variable bindings received").inc(
+                len(results), device=self.host)
+            if cmd == self._cmdgen.bulkCmd and self._adaptive_bulk is not None:
+                self._adaptive_bulk.update(len(oids) - 2, len(results), elapsed)
         return results
 
-    def _cache_or_cmd(self, cmd, *oids):
+    def _cache_or_cmd(self, cmd, *args):
         ''' pull result from cache or query host for OIDS '''
-        if oids in self._cache:
-            t, result = self._cache[oids]
-            if (time.time() - t) < C.DEFAULT_SNMP_CACHE_TIMEOUT:
-                return result
-        result = self._cmd(cmd, *oids)
-        self._cache_results(oids, result)
+        oids = tuple(str(arg) for arg in args if not isinstance(arg, int))
+        key = (cmd.__name__, oids)
+        result = self._cache.get(key)
+        if result is not None:
+            logging.debug("using cached %s results for %s", cmd.__name__, self.host)
+            return result
+        result = self._cmd(cmd, *args)
+        self._cache.put(key, result, self._cache.ttl(oids))
         return result
 
     def get(self, *oids):
@@ -360,14 +915,133 @@ class SNMPSession(object):
         if self.version == '1' or not self.bulk:
             return self._cache_or_cmd(self._cmdgen.nextCmd, *oids)
         args = [0, self.bulk] + list(oids)
+        try:
+            return self._cache_or_cmd(self._cmdgen.bulkCmd, *args)
+        except NetspryteSNMPError as e:
+            if self._adaptive_bulk is None or not self._adaptive_bulk.backoff(str(e), self._breaker.responded):
+                logging.error("caught snmp error with %s: %s", self.host, str(e))
+                return results
+        logging.warn("retrying walk of %s with max-repetitions %s", self.host, self.bulk)
+        netspryte.utils.stats.counter("snmp_retries", "SNMP walks retried with fewer repetitions").inc(
+            device=self.host)
+        args = [0, self.bulk] + list(oids)
         try:
             return self._cache_or_cmd(self._cmdgen.bulkCmd, *args)
         except NetspryteSNMPError as e:
             logging.error("caught snmp error with %s: %s", self.host, str(e))
             return results
 
+    def walk_raw(self, oid):
+        '''
+        Return the (OID, value) pairs under oid as the device sent them:
+        values keep their SNMP type and octet strings are not decoded to
+        text.  Results are not cached.  Used to record fixtures.
+        '''
+        return self._cmd(self._cmdgen.nextCmd, oid, lookupMib=False, decode=False)
+
+    def probe(self, oid):
+        ''' return True if the device has any object under oid, using a single GETNEXT '''
+        return len(self._cmd(self._cmdgen.nextCmd, oid, maxRows=1)) > 0
+
     def set(self, *args):
         ''' set an oid value via SET '''
         pass
         if len(args) % 2 != 0:
             raise ValueError("require an even number of arguments for SET")
+
+
+class CollectionContext(object):
+    '''
+    Per-device state shared by all SNMP modules during one collection cycle.
+
+    The context wraps a SNMPSession and can be passed anywhere a session is
+    expected.  Walks are memoized by column OID, so each table column is
+    walked at most once per device per cycle no matter how many modules ask
+    for it.  Module instances are also memoized so that modules building on
+    other modules (eg cbqos on interface) reuse the results.
+    '''
+
+    def __init__(self, snmp, catalog=None):
+        self._snmp = snmp
+        self._walks = dict()     # column oid -> [ (oid, value) ]
+        self._modules = dict()   # module NAME -> module instance
+        self._cached = dict()    # (host, measurement class) -> { index: instance }
+        self.catalog = catalog
+
+    def __getattr__(self, name):
+        if name == '_snmp':
+            raise AttributeError(name)
+        return getattr(self._snmp, name)
+
+    @property
+    def snmp(self):
+        return self._snmp
+
+    def _split_columns(self, columns, results):
+        ''' assign walk results to the column oid they fall under '''
+        data = dict((col, list()) for col in columns)
+        trie = OidTrie(dict((col, col) for col in columns))
+        for obj in results:
+            match = trie.match(obj[0])
+            if match is not None:
+                data[match[0]].append(obj)
+        return data
+
+    def walk(self, *oids):
+        ''' walk oids, only querying the device for columns not walked yet '''
+        missing = [oid for oid in oids if oid not in self._walks]
+        if missing:
+            self._walks.update(self._split_columns(missing, self._snmp.walk(*missing)))
+        else:
+            logging.debug("using walked columns for %s", self.host)
+        results = list()
+        for oid in oids:
+            results.extend(self._walks[oid])
+        return results
+
+    def get(self, *oids):
+        ''' perform snmp get queries for list of snmp oids '''
+        return self._snmp.get(*oids)
+
+    def module(self, cls):
+        '''
+        Return an instance of a snmp module for this device, creating it once.
+        Modules are keyed by NAME, since the plugin loader and a direct
+        import of the same module give different class objects.
+        '''
+        if cls.NAME not in self._modules:
+            self._modules[cls.NAME] = cls(self)
+        return self._modules[cls.NAME]
+
+    def cached_instances(self, host, measurement_class):
+        '''
+        Return the measurement instances recorded by discovery for a host and
+        measurement class as a dict of index to attrs and presentation.
+        Returns None when there is no catalog (ie attributes are walked
+        every cycle) or when nothing has been discovered yet.
+        The catalog is normally the worker's Manager.
+        '''
+        if self.catalog is None:
+            return None
+        key = (host, measurement_class)
+        if key not in self._cached:
+            instances = self.catalog.get_instances_by_host_and_class(host, measurement_class)
+            self._cached[key] = dict((inst.index, {'attrs': inst.attrs or dict(),
+                                                   'presentation': inst.presentation or dict()})
+                                     for inst in instances)
+        return self._cached[key] or None
+
+    def tagged_instances(self, tag):
+        ''' return the names of measurement instances tagged with tag '''
+        if self.catalog is None:
+            return set()
+        key = ('tag', tag)
+        if key not in self._cached:
+            self._cached[key] = set(inst.name for inst in self.catalog.get_instances_by_tags([tag]))
+        return self._cached[key]
+
+    def expire(self):
+        ''' forget walked columns, module instances and cached instances '''
+        self._walks = dict()
+        self._modules = dict()
+        self._cached = dict()
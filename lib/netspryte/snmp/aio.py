@@ -0,0 +1,231 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from pysnmp.hlapi import asyncio as hlapi
+from pysnmp.proto.rfc1905 import EndOfMibView
+from pysnmp.proto.rfc1902 import ObjectName
+
+from netspryte import constants as C
+from netspryte.errors import NetspryteSNMPError, NetspryteTimeout
+from netspryte.snmp import SNMPSession
+
+
+def oid_in_subtree(root, oid):
+    ''' return True if oid falls under the subtree root '''
+    return ObjectName(root).isPrefixOf(ObjectName(oid))
+
+
+class AsyncSNMPEngine(object):
+    '''
+    An asyncio event loop and pysnmp engine shared by many SNMP sessions.
+
+    The loop runs in a background thread.  All queries from all sessions
+    are multiplexed over the single UDP transport of the pysnmp engine.
+    Plugin modules remain synchronous: each device is processed in a
+    thread of a pool and its queries block on the shared loop, so up to
+    `concurrency` devices can have requests in flight at once.
+    '''
+
+    def __init__(self, concurrency=C.DEFAULT_SNMP_CONCURRENCY):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.snmp_engine = None
+        self._thread = threading.Thread(target=self._run_loop, name="snmp-asyncio")
+        self._thread.daemon = True
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        ''' start the event loop thread '''
+        logging.info("starting asyncio snmp engine with concurrency %s", self.concurrency)
+        self._thread.start()
+        self.run(self._create_engine())
+
+    async def _create_engine(self):
+        self.snmp_engine = hlapi.SnmpEngine()
+
+    def stop(self):
+        ''' stop the event loop thread '''
+        if self.snmp_engine is not None and self.snmp_engine.transportDispatcher is not None:
+            self.snmp_engine.transportDispatcher.closeDispatcher()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self, coro, timeout=None):
+        '''
+        run a coroutine on the shared event loop and wait for its result,
+        cancelling it and raising NetspryteTimeout after timeout seconds
+        '''
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(None if timeout is None else max(0, timeout))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise NetspryteTimeout("query still running after %.1f seconds" % timeout)
+
+    def session(self, **kwargs):
+        ''' return a SNMP session bound to this engine '''
+        return AsyncSNMPSession(self, **kwargs)
+
+    def map(self, func, devices):
+        ''' call func(device) for every device, with up to concurrency devices at once '''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(func, devices))
+
+
+class AsyncCommandGenerator(object):
+    '''
+    Coroutine-based replacement for the oneliner CommandGenerator.
+
+    The getCmd, nextCmd and bulkCmd methods have the same signature and
+    return value as the oneliner versions, so SNMPSession can use either;
+    there is no setCmd, since collection never sets anything.  Queries
+    stop at the deadline of session, if it has one.
+    '''
+
+    def __init__(self, engine, session=None):
+        self.engine = engine
+        self.session = session
+
+    def _run(self, coro):
+        deadline = getattr(self.session, 'deadline', None)
+        if deadline is None:
+            return self.engine.run(coro)
+        return self.engine.run(coro, deadline - time.time())
+
+    def _mk_var_binds(self, oids):
+        return [hlapi.ObjectType(hlapi.ObjectIdentity(str(oid))) for oid in oids]
+
+    async def get(self, auth, transport, *oids):
+        ''' perform a single GET for oids '''
+        return await hlapi.getCmd(self.engine.snmp_engine, auth, transport, hlapi.ContextData(),
+                                  *self._mk_var_binds(oids), lookupMib=False)
+
+    async def walk(self, auth, transport, non_repeaters, max_repetitions, *oids, max_rows=None):
+        '''
+        Walk the columns in oids with GETNEXT (if max_repetitions is None)
+        or GETBULK, stopping each column when it leaves its subtree, and
+        the whole walk after max_rows rows if given.
+        Returns (errorIndication, errorStatus, errorIndex, varBindTable).
+        '''
+        roots = [str(oid) for oid in oids]
+        current = list(roots)
+        table = list()
+        while current:
+            var_binds = self._mk_var_binds(current)
+            if max_repetitions is None:
+                errorIndication, errorStatus, errorIndex, rows = await hlapi.nextCmd(
+                    self.engine.snmp_engine, auth, transport, hlapi.ContextData(),
+                    *var_binds, lookupMib=False)
+            else:
+                errorIndication, errorStatus, errorIndex, rows = await hlapi.bulkCmd(
+                    self.engine.snmp_engine, auth, transport, hlapi.ContextData(),
+                    non_repeaters, max_repetitions, *var_binds, lookupMib=False)
+            if errorIndication or errorStatus:
+                return errorIndication, errorStatus, errorIndex, table
+            if not rows:
+                break
+            following = list()
+            for col, root in enumerate(roots):
+                last = None
+                for row in rows:
+                    name, value = row[col][0], row[col][1]
+                    if isinstance(value, EndOfMibView) or not oid_in_subtree(root, name):
+                        last = None
+                        break
+                    table.append([(name, value)])
+                    last = name
+                    if max_rows and len(table) >= max_rows:
+                        return None, 0, 0, table
+                if last is not None:
+                    following.append((root, str(last)))
+            roots = [root for root, last in following]
+            current = [last for root, last in following]
+        return None, 0, 0, table
+
+    def getCmd(self, auth, transport, *oids):
+        return self._run(self.get(auth, transport, *oids))
+
+    def nextCmd(self, auth, transport, *oids, **kwargs):
+        return self._run(self.walk(auth, transport, 0, None, *oids, max_rows=kwargs.get('maxRows')))
+
+    def bulkCmd(self, auth, transport, non_repeaters, max_repetitions, *oids):
+        return self._run(self.walk(auth, transport, non_repeaters, max_repetitions, *oids))
+
+
+class AsyncSNMPSession(SNMPSession):
+    '''
+    A SNMP session whose queries run on a shared AsyncSNMPEngine.
+
+    get() and walk() behave as they do for SNMPSession and may be called
+    from any thread other than the event loop thread.  Coroutine code
+    running on the loop should use async_get() and async_walk().
+    '''
+
+    def __init__(self, engine, **kwargs):
+        self._engine = engine
+        super(AsyncSNMPSession, self).__init__(**kwargs)
+
+    def _setup_transport(self):
+        if self._version == '3':
+            pass
+        else:
+            self._auth = hlapi.CommunityData(self._community)
+        self._cmdgen = AsyncCommandGenerator(self._engine, self)
+        self._transport = hlapi.UdpTransportTarget((self._host, self._port),
+                                                   timeout=self._timeout, retries=self._retries)
+
+    def _check_errors(self, errorIndication, errorStatus):
+        if errorIndication:
+            raise NetspryteSNMPError(str(errorIndication))
+        if errorStatus:
+            raise NetspryteSNMPError(errorStatus.prettyPrint())
+
+    async def async_get(self, *oids):
+        ''' perform snmp get queries for list of snmp oids '''
+        errorIndication, errorStatus, errorIndex, varBinds = await self._cmdgen.get(
+            self._auth, self._transport, *oids)
+        self._check_errors(errorIndication, errorStatus)
+        return [self._snmp_varbind_to_list(varbind) for varbind in varBinds]
+
+    async def async_walk(self, *oids):
+        ''' perform snmp getnext or getbulk queries for list of snmp oids '''
+        max_repetitions = None
+        if self.version != '1' and self.bulk:
+            max_repetitions = self.bulk
+        errorIndication, errorStatus, errorIndex, varBindTable = await self._cmdgen.walk(
+            self._auth, self._transport, 0, max_repetitions, *oids)
+        self._check_errors(errorIndication, errorStatus)
+        return [self._snmp_varbind_to_list(varbind) for row in varBindTable for varbind in row]
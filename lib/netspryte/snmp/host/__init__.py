@@ -19,9 +19,28 @@
 import logging
 import netspryte.snmp
 import netspryte.utils
+from netspryte import constants as C
 from netspryte.errors import NetspryteError
 
 
+def get_select_rules(measurement_class):
+    '''
+    Return the rules from the select option of the snmp_<measurement_class>
+    configuration section as a list of (key, value) tuples.  Each rule is
+    written as attr=value, matching an attribute of the measurement instance,
+    or tag=name, matching a tag of the measurement instance.
+    '''
+    rules = list()
+    select = C.get_config(C.p, "snmp_%s" % measurement_class, "select", None, None, islist=True)
+    for rule in select or list():
+        if '=' not in rule:
+            logging.warn("ignoring select rule without '=' for %s: %s", measurement_class, rule)
+            continue
+        key, value = rule.split('=', 1)
+        rules.append((key.strip(), value.strip()))
+    return rules
+
+
 class HostSystem(object):
 
     NAME = 'system'
@@ -43,6 +62,19 @@ class HostSystem(object):
 
     CONVERSION = { }
 
+    # OID prefix -> seconds results may be cached; STAT columns are never cached
+    CACHE_TTL = { }
+
+    # NAMEs of modules this module uses through snmp.module(); they are
+    # polled in the same task
+    DEPENDS = ( )
+
+    # subtree of sysObjectID the module applies to, or None for any device
+    BASE_OID = None
+
+    # OIDs of MIBs the device must have objects under for the module to apply
+    MIBS = ( )
+
     def __init__(self, snmp):
         self._sysDescr    = None
         self._sysObjectID = None
@@ -51,7 +83,10 @@ class HostSystem(object):
         self._sysName     = None
         self._sysLocation = None
         self._sysServices = None
+        if not isinstance(snmp, netspryte.snmp.CollectionContext):
+            snmp = netspryte.snmp.CollectionContext(snmp)
         self.snmp         = snmp
+        self.set_cache_policy()
         logging.info("inspecting %s for sys data", snmp.host)
         self.data = self._get_system()
         if not self.data:
@@ -71,6 +106,16 @@ class HostSystem(object):
             data[k]['attrs'] = v
         return data
 
+    def set_cache_policy(self):
+        ''' apply the cache TTLs declared by the module to the snmp session '''
+        cache = getattr(self.snmp, 'cache', None)
+        if cache is None:
+            return
+        for oid in list(self.STAT.values()):
+            cache.set_policy(oid, 0)
+        for prefix, ttl in list(self.CACHE_TTL.items()):
+            cache.set_policy(prefix, ttl)
+
     def initialize_instance(self, measurement_class, index, host=None):
         ''' return a dictionary with the basics of a measurement instance '''
         data = dict()
@@ -83,6 +128,78 @@ class HostSystem(object):
         data['name'] = netspryte.utils.mk_data_instance_id(data['host'], measurement_class, index)
         return data
 
+    def get_cached_instances(self, measurement_class):
+        '''
+        Return the measurement instances discovery recorded for this device,
+        as a dict of index to attrs and presentation, or None if attributes
+        should be walked from the device.
+        '''
+        return self.snmp.cached_instances(self.sysName or self.snmp.host, measurement_class)
+
+    def get_polled_indexes(self, measurement_class, cached):
+        '''
+        Return the indexes of cached measurement instances selected by the
+        select rules for the measurement class, or None if the whole table
+        should be walked.
+        '''
+        rules = get_select_rules(measurement_class)
+        if not cached or not rules:
+            return None
+        indexes = list()
+        for k, v in list(cached.items()):
+            for key, value in rules:
+                if key == 'tag':
+                    name = netspryte.utils.mk_data_instance_id(self.sysName or self.snmp.host,
+                                                               measurement_class, k)
+                    if name in self.snmp.tagged_instances(value):
+                        indexes.append(k)
+                        break
+                elif str(v['attrs'].get(key)) == value:
+                    indexes.append(k)
+                    break
+        logging.info("polling %s of %s %s instances on %s", len(indexes), len(cached),
+                     measurement_class, self.snmp.host)
+        return indexes
+
+    def get_stat_data(self, measurement_class, stat, conversion, cached, chunk=None):
+        '''
+        Query the STAT columns for a measurement class.  If select rules pick
+        out a subset of the cached instances, only their rows are fetched with
+        GET requests; otherwise the columns are walked.
+        '''
+        indexes = self.get_polled_indexes(measurement_class, cached)
+        if indexes is None:
+            return netspryte.snmp.get_snmp_data(self.snmp, self, measurement_class, stat, conversion, chunk)
+        return netspryte.snmp.get_snmp_data_by_index(self.snmp, self, measurement_class, stat, conversion, indexes)
+
+    def cached_instances_cover(self, measurement_class, cached, metrics):
+        '''
+        Return True if discovery recorded every instance the device returned
+        metrics for.  An index missing from cached is a new instance, so
+        its attributes have to be walked again.
+        '''
+        if not cached:
+            return False
+        if not set(metrics).issubset(cached):
+            logging.info("found new %s instances on %s; refreshing attributes", measurement_class, self.snmp.host)
+            return False
+        return True
+
+    def initialize_cached_instances(self, measurement_class, cached, metrics):
+        '''
+        Return measurement instances built from discovery-cached attributes,
+        for the indexes the device returned metrics for.  Cached instances
+        that no longer answer are left out, so they are not seen again.
+        '''
+        data = dict()
+        for k, v in list(cached.items()):
+            if k not in metrics:
+                continue
+            data[k] = self.initialize_instance(measurement_class, k)
+            data[k]['attrs'] = v['attrs']
+            data[k]['presentation'] = v['presentation']
+        return data
+
     @property
     def data(self):
         return self._data
@@ -27,6 +27,7 @@ class HostEntity(HostSystem):
 
     NAME = 'entity'
     DESCRIPTION = "Device Physical and Logical Components"
+    MIBS = ( '1.3.6.1.2.1.47', )
 
     ATTRS = {
         'entPhysicalDescr'       : '1.3.6.1.2.1.47.1.1.1.1.2',
@@ -47,6 +48,10 @@ class HostEntity(HostSystem):
 
     STAT = { }
 
+    CACHE_TTL = {
+        '1.3.6.1.2.1.47.1.1.1' : 3600,   # entPhysicalTable
+    }
+
     CONVERSION = {
         'entPhysicalClass': {
             1  : 'other',
@@ -90,7 +90,7 @@ class HostInterface(HostSystem):
     def __init__(self, snmp):
         self.snmp = snmp
         super(HostInterface, self).__init__(snmp)
-        t = Timer("snmp inspect %s %s" % (HostInterface.NAME, snmp.host))
+        t = Timer("snmp inspect %s %s" % (HostInterface.NAME, snmp.host), "inspect")
         t.start_timer()
         self.data = self._get_interface()
         t.stop_timer()
@@ -100,9 +100,28 @@ class HostInterface(HostSystem):
         Pull together attributes and metrics for all interfaces into a dictionary
         associated with with a SNMP object for a device.
         '''
+        cached = self.get_cached_instances(HostInterface.NAME)
+        metrics = self.get_stat_data(HostInterface.NAME, HostInterface.STAT, HostInterface.CONVERSION, cached)
+        if self.cached_instances_cover(HostInterface.NAME, cached, metrics):
+            data = self.initialize_cached_instances(HostInterface.NAME, cached, metrics)
+        else:
+            data = self._get_interface_attrs()
+        for k in list(data.keys()):
+            if k in metrics:
+                data[k]['metrics'] = metrics[k]
+                # In the event that not all STATs are returned
+                # (eg not available or supported for a particular ifType),
+                # go back and put them in the recorded metrics for this measurement
+                # instance.  Fake a COUNTER value of 0.
+                for stat in list(HostInterface.STAT.keys()):
+                    if stat not in data[k]['metrics']:
+                        data[k]['metrics'][stat] = Counter32(0)
+        return data
+
+    def _get_interface_attrs(self):
+        ''' walk attributes for all interfaces '''
         data = dict()
         attrs = netspryte.snmp.get_snmp_data(self.snmp, self, HostInterface.NAME, HostInterface.ATTRS, HostInterface.CONVERSION)
-        metrics = netspryte.snmp.get_snmp_data(self.snmp, self, HostInterface.NAME, HostInterface.STAT, HostInterface.CONVERSION)
         for k, v in list(attrs.items()):
             ifdescr = attrs[k].get('ifDescr', 'NA')
             title = "{0}:{1}".format(self.sysName, ifdescr)
@@ -113,15 +132,6 @@ class HostInterface(HostSystem):
                 data[k]['attrs']['ifPhysAddress'] = ':'.join(['%x' % ord(x) for x in v['ifPhysAddress']])
 
             data[k]['presentation'] = {'title': title, 'description': descr}
-            if k in metrics:
-                data[k]['metrics'] = metrics[k]
-                # In the event that not all STATs are returned
-                # (eg not available or supported for a particular ifType),
-                # go back and put them in the recorded metrics for this measurement
-                # instance.  Fake a COUNTER value of 0.
-                for stat in list(HostInterface.STAT.keys()):
-                    if stat not in data[k]['metrics']:
-                        data[k]['metrics'][stat] = Counter32(0)
         return data
 
     @property
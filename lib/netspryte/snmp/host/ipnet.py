@@ -41,6 +41,10 @@ class HostIpNetwork(HostSystem):
 
     STAT = { }
 
+    CACHE_TTL = {
+        '1.3.6.1.2.1.4.34' : 3600,   # ipAddressTable
+    }
+
     XLATE = { }
 
     CONVERSION = {
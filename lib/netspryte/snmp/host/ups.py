@@ -25,6 +25,7 @@ class HostUPS(HostSystem):
 
     NAME = 'ups'
     DESCRIPTION = 'UPS'
+    MIBS = ( '1.3.6.1.2.1.33', )
 
     ATTRS = {
         'upsIdentManufacturer'         : '1.3.6.1.2.1.33.1.1.1',
@@ -83,10 +84,16 @@ class HostUPS(HostSystem):
 
     def _get_ups_data(self):
         data = dict()
-        attrs = netspryte.snmp.get_snmp_data(self.snmp, self, HostUPS.NAME, HostUPS.ATTRS, HostUPS.CONVERSION)
-        metrics = netspryte.snmp.get_snmp_data(self.snmp, self, HostUPS.NAME, HostUPS.STAT, HostUPS.CONVERSION)
-        for k, v in list(attrs.items()):
-            data[k] = self.initialize_instance(HostUPS.NAME, k)
-            data[k]['attrs'] = v
-            data[k]['metrics'] = metrics[k]
+        cached = self.get_cached_instances(HostUPS.NAME)
+        metrics = self.get_stat_data(HostUPS.NAME, HostUPS.STAT, HostUPS.CONVERSION, cached)
+        if self.cached_instances_cover(HostUPS.NAME, cached, metrics):
+            data = self.initialize_cached_instances(HostUPS.NAME, cached, metrics)
+        else:
+            attrs = netspryte.snmp.get_snmp_data(self.snmp, self, HostUPS.NAME, HostUPS.ATTRS, HostUPS.CONVERSION)
+            for k, v in list(attrs.items()):
+                data[k] = self.initialize_instance(HostUPS.NAME, k)
+                data[k]['attrs'] = v
+        for k in list(data.keys()):
+            if k in metrics:
+                data[k]['metrics'] = metrics[k]
         return data
@@ -0,0 +1,430 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import bisect
+import random
+import socket
+import logging
+import binascii
+import ipaddress
+import threading
+
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pyasn1.type import univ
+from pysnmp.proto import api
+from pysnmp.proto.rfc1902 import (
+    Counter32,
+    Counter64,
+    Gauge32,
+    Integer,
+    IpAddress,
+    OctetString,
+    ObjectIdentifier,
+    TimeTicks,
+)
+from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
+
+from netspryte import constants as C
+
+# snmprec type tags, as used by snmpsim
+SNMPREC_TYPES = {
+    '2'  : Integer,
+    '4'  : OctetString,
+    '6'  : ObjectIdentifier,
+    '64' : IpAddress,
+    '65' : Counter32,
+    '66' : Gauge32,
+    '67' : TimeTicks,
+    '70' : Counter64,
+}
+
+SYSTEM = '1.3.6.1.2.1.1'
+IF_TABLE = '1.3.6.1.2.1.2.2.1'
+IFX_TABLE = '1.3.6.1.2.1.31.1.1.1'
+
+TOO_BIG = 1
+NO_SUCH_NAME = 2
+
+
+def oid_to_tuple(oid):
+    return tuple(int(x) for x in str(oid).strip('.').split('.'))
+
+
+class Counter(object):
+    '''
+    A counter that grows by rate per second from when the agent started,
+    wrapping like the SNMP type it is reported as.
+    '''
+
+    def __init__(self, start=0, rate=1000, snmp_type=Counter64):
+        self.start = start
+        self.rate = rate
+        self.snmp_type = snmp_type
+        self.epoch = time.time()
+
+    def value(self):
+        bits = 64 if self.snmp_type is Counter64 else 32
+        return self.snmp_type(int(self.start + self.rate * (time.time() - self.epoch)) % (2 ** bits))
+
+
+class Fixture(object):
+    '''
+    The objects an agent serves: a sorted table of OID to value.  Values
+    are pysnmp objects or Counter generators.  Fixtures are read from
+    snmprec files (OID|type|value lines, as written by record() and
+    snmpsim) or built with the generators below, and may be combined
+    with update().
+    '''
+
+    def __init__(self, objects=None):
+        self._oids = list()     # sorted oid tuples
+        self._values = dict()   # oid tuple -> value
+        if objects:
+            self.update(objects)
+
+    def __len__(self):
+        return len(self._oids)
+
+    def update(self, objects):
+        ''' add objects, a dict of OID string or tuple to value, or another Fixture '''
+        if isinstance(objects, Fixture):
+            objects = objects._values
+        for oid, value in list(objects.items()):
+            key = oid if isinstance(oid, tuple) else oid_to_tuple(oid)
+            if key not in self._values:
+                bisect.insort(self._oids, key)
+            self._values[key] = value
+
+    def _value(self, key):
+        value = self._values[key]
+        if isinstance(value, Counter):
+            return value.value()
+        return value
+
+    def get(self, oid):
+        ''' return the value of oid, or None if there is no such object '''
+        key = oid_to_tuple(oid)
+        if key not in self._values:
+            return None
+        return self._value(key)
+
+    def next(self, oid):
+        ''' return (oid, value) of the object following oid, or None at the end of the MIB '''
+        i = bisect.bisect_right(self._oids, oid_to_tuple(oid))
+        if i >= len(self._oids):
+            return None
+        key = self._oids[i]
+        return ObjectIdentifier(key), self._value(key)
+
+    @classmethod
+    def load(cls, path):
+        ''' read a fixture from a snmprec file '''
+        objects = dict()
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                oid, tag, value = line.split('|', 2)
+                if tag.endswith('x'):
+                    value = binascii.unhexlify(value)
+                    tag = tag[:-1]
+                if tag not in SNMPREC_TYPES:
+                    logging.warn("skipping %s with unsupported type %s", oid, tag)
+                    continue
+                objects[oid] = SNMPREC_TYPES[tag](value)
+        return cls(objects)
+
+    def save(self, path):
+        ''' write the fixture, with the current value of counters, to a snmprec file '''
+        with open(path, 'w') as f:
+            for key in self._oids:
+                f.write(snmprec_line(ObjectIdentifier(key), self._value(key)) + "\n")
+
+
+def snmprec_line(oid, value):
+    '''
+    return the snmprec line of oid and value.  The type tag is found from
+    the ASN.1 tag of value, so values decoded off the wire record the same
+    as the pysnmp types they stand for.
+    '''
+    tag = None
+    for name, cls in list(SNMPREC_TYPES.items()):
+        if getattr(value, 'tagSet', None) == cls.tagSet:
+            tag = name
+            break
+    if tag is None:
+        raise ValueError("cannot record %s of type %s" % (oid, type(value).__name__))
+    if isinstance(value, univ.OctetString):
+        return "%s|%sx|%s" % (oid, tag, binascii.hexlify(value.asOctets()).decode('ascii'))
+    return "%s|%s|%s" % (oid, tag, value.prettyPrint())
+
+
+def system_table(name="simulated", sys_object_id='1.3.6.1.4.1.8072.3.2.10', descr="netspryte simulated agent"):
+    ''' return the objects of the system group '''
+    return {
+        SYSTEM + '.1.0' : OctetString(descr),
+        SYSTEM + '.2.0' : ObjectIdentifier(sys_object_id),
+        SYSTEM + '.3.0' : Counter(0, 100, TimeTicks),
+        SYSTEM + '.4.0' : OctetString("netspryte"),
+        SYSTEM + '.5.0' : OctetString(name),
+        SYSTEM + '.6.0' : OctetString("localhost"),
+    }
+
+
+def interface_table(count, rate=1000000, speed=1000):
+    '''
+    Return the ifTable and ifXTable objects of count interfaces, all up,
+    with octet and packet counters growing by rate bytes per second.
+    '''
+    objects = dict()
+    for index in range(1, count + 1):
+        name = "eth%s" % (index - 1)
+        row = {
+            IF_TABLE + '.1'   : Integer(index),
+            IF_TABLE + '.2'   : OctetString(name),
+            IF_TABLE + '.3'   : Integer(6),
+            IF_TABLE + '.4'   : Integer(1500),
+            IF_TABLE + '.5'   : Gauge32(min(speed * 10 ** 6, 2 ** 32 - 1)),
+            IF_TABLE + '.6'   : OctetString(bytes([0, 0, 0x5e, 0, index >> 8 & 0xff, index & 0xff])),
+            IF_TABLE + '.7'   : Integer(1),
+            IF_TABLE + '.8'   : Integer(1),
+            IF_TABLE + '.9'   : TimeTicks(0),
+            IF_TABLE + '.10'  : Counter(index, rate, Counter32),
+            IF_TABLE + '.11'  : Counter(index, rate // 1000, Counter32),
+            IF_TABLE + '.13'  : Counter(0, 0, Counter32),
+            IF_TABLE + '.14'  : Counter(0, 0, Counter32),
+            IF_TABLE + '.16'  : Counter(index, rate, Counter32),
+            IF_TABLE + '.17'  : Counter(index, rate // 1000, Counter32),
+            IF_TABLE + '.19'  : Counter(0, 0, Counter32),
+            IF_TABLE + '.20'  : Counter(0, 0, Counter32),
+            IFX_TABLE + '.1'  : OctetString(name),
+            IFX_TABLE + '.2'  : Counter(0, 1, Counter32),
+            IFX_TABLE + '.3'  : Counter(0, 0, Counter32),
+            IFX_TABLE + '.4'  : Counter(0, 0, Counter32),
+            IFX_TABLE + '.5'  : Counter(0, 0, Counter32),
+            IFX_TABLE + '.6'  : Counter(index, rate),
+            IFX_TABLE + '.7'  : Counter(index, rate // 1000),
+            IFX_TABLE + '.8'  : Counter(0, 1),
+            IFX_TABLE + '.9'  : Counter(0, 0),
+            IFX_TABLE + '.10' : Counter(index, rate),
+            IFX_TABLE + '.11' : Counter(index, rate // 1000),
+            IFX_TABLE + '.12' : Counter(0, 1),
+            IFX_TABLE + '.13' : Counter(0, 0),
+            IFX_TABLE + '.15' : Gauge32(speed),
+            IFX_TABLE + '.18' : OctetString("simulated interface %s" % index),
+        }
+        for column, value in list(row.items()):
+            objects["%s.%s" % (column, index)] = value
+    return objects
+
+
+def mk_device(name="simulated", interfaces=8, rate=1000000):
+    ''' return a Fixture for a device with the system group and interfaces '''
+    fixture = Fixture(system_table(name))
+    fixture.update(interface_table(interfaces, rate))
+    return fixture
+
+
+class SNMPAgent(object):
+    '''
+    A SNMP v1/v2c agent on a local UDP port answering GET, GETNEXT and
+    GETBULK from a Fixture, for tests and benchmarks.
+
+    Each response can be delayed by latency seconds (plus up to jitter
+    seconds), a loss fraction of requests is dropped, and responses with
+    more than max_varbinds varbinds are answered with tooBig.  Port 0
+    picks a free port; see the port attribute once started.
+    '''
+
+    def __init__(self, fixture, host='127.0.0.1', port=0, community='public',
+                 latency=0, jitter=0, loss=0, max_varbinds=None):
+        self.fixture = fixture
+        self.host = host
+        self.port = port
+        self.community = community
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.max_varbinds = max_varbinds
+        self.requests = 0
+        self.dropped = 0
+        self.varbinds = 0
+        self._sock = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((self.host, self.port))
+        self._sock.settimeout(0.1)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._run, name="snmp-agent-%s" % self.port)
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("simulated snmp agent listening on %s:%s", self.host, self.port)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._sock is not None:
+            self._sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                msg, addr = self._sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.requests += 1
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            try:
+                response = self.respond(msg)
+            except (PyAsn1Error, ValueError) as e:
+                logging.warn("simulated agent could not answer request from %s: %s", addr, str(e))
+                continue
+            if response is None:
+                continue
+            delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                time.sleep(delay)
+            self._sock.sendto(response, addr)
+
+    def respond(self, msg):
+        ''' return the encoded response to the encoded request msg, or None to ignore it '''
+        version = int(api.decodeMessageVersion(msg))
+        if version not in api.protoModules:
+            return None
+        pMod = api.protoModules[version]
+        req, rest = decoder.decode(msg, asn1Spec=pMod.Message())
+        if str(pMod.apiMessage.getCommunity(req)) != self.community:
+            return None
+        rsp = pMod.apiMessage.getResponse(req)
+        req_pdu = pMod.apiMessage.getPDU(req)
+        rsp_pdu = pMod.apiMessage.getPDU(rsp)
+        oids = [oid for oid, value in pMod.apiPDU.getVarBinds(req_pdu)]
+        error = None
+        if req_pdu.isSameTypeWith(pMod.GetRequestPDU()):
+            var_binds, error = self._get(oids, version)
+        elif req_pdu.isSameTypeWith(pMod.GetNextRequestPDU()):
+            var_binds, error = self._next(oids, version)
+        elif version != api.protoVersion1 and req_pdu.isSameTypeWith(pMod.GetBulkRequestPDU()):
+            non_repeaters = int(pMod.apiBulkPDU.getNonRepeaters(req_pdu))
+            max_repetitions = int(pMod.apiBulkPDU.getMaxRepetitions(req_pdu))
+            var_binds, error = self._bulk(oids, non_repeaters, max_repetitions)
+        else:
+            return None
+        if error is None and self.max_varbinds and len(var_binds) > self.max_varbinds:
+            error = (TOO_BIG, 0)
+        if error is not None:
+            pMod.apiPDU.setErrorStatus(rsp_pdu, error[0])
+            pMod.apiPDU.setErrorIndex(rsp_pdu, error[1])
+            var_binds = [(oid, pMod.Null('')) for oid in oids]
+        else:
+            self.varbinds += len(var_binds)
+        pMod.apiPDU.setVarBinds(rsp_pdu, var_binds)
+        return encoder.encode(rsp)
+
+    def _get(self, oids, version):
+        var_binds = list()
+        for i, oid in enumerate(oids):
+            value = self.fixture.get(oid)
+            if value is None:
+                if version == api.protoVersion1:
+                    return None, (NO_SUCH_NAME, i + 1)
+                value = NoSuchInstance('')
+            var_binds.append((oid, value))
+        return var_binds, None
+
+    def _next(self, oids, version):
+        var_binds = list()
+        for i, oid in enumerate(oids):
+            found = self.fixture.next(oid)
+            if found is None:
+                if version == api.protoVersion1:
+                    return None, (NO_SUCH_NAME, i + 1)
+                found = (oid, EndOfMibView(''))
+            var_binds.append(found)
+        return var_binds, None
+
+    def _bulk(self, oids, non_repeaters, max_repetitions):
+        var_binds, error = self._next(oids[:non_repeaters], api.protoVersion2c)
+        current = list(oids[non_repeaters:])
+        for i in range(max_repetitions):
+            if not current:
+                break
+            row, error = self._next(current, api.protoVersion2c)
+            var_binds.extend(row)
+            current = [oid for oid, value in row]
+            if all(isinstance(value, EndOfMibView) for oid, value in row):
+                break
+        return var_binds, None
+
+
+def record(snmp, path, oids=('1.3.6.1.2.1', '1.3.6.1.4.1')):
+    '''
+    Walk the subtrees in oids on the device of the SNMPSession snmp and
+    write the varbinds it returns, with their SNMP type and undecoded
+    value, to path as a snmprec fixture.  Returns the number of objects
+    recorded.
+    '''
+    count = 0
+    with open(path, 'w') as f:
+        for oid in oids:
+            for name, value in snmp.walk_raw(oid):
+                if isinstance(value, (EndOfMibView, NoSuchInstance, NoSuchObject)):
+                    continue
+                try:
+                    f.write(snmprec_line(name, value) + "\n")
+                    count += 1
+                except ValueError as e:
+                    logging.warn("not recording %s", str(e))
+    logging.info("recorded %s objects from %s to %s", count, snmp.host, path)
+    return count
+
+
+def mk_agents(fixtures, address='127.0.1.1', port=C.DEFAULT_SNMP_PORT, **kwargs):
+    '''
+    Return a started SNMPAgent for each fixture, on consecutive loopback
+    addresses from address, all on the same port, so collectors can poll
+    them by address without changing their SNMP port.
+    '''
+    agents = list()
+    first = ipaddress.ip_address(address)
+    try:
+        for i, fixture in enumerate(fixtures):
+            agents.append(SNMPAgent(fixture, host=str(first + i), port=port, **kwargs).start())
+    except Exception:
+        for agent in agents:
+            agent.stop()
+        raise
+    return agents
@@ -0,0 +1,229 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+
+import netspryte.utils
+from netspryte import constants as C
+
+
+class WalkStore(object):
+    '''
+    An on-disk cache of SNMP query results, shared by every worker process
+    and every run of the collectors.
+
+    Results are kept in a SQLite database keyed by device, command and
+    OIDs, together with the time they expire.  SQLite takes care of
+    locking, so several processes may read and write the same file; each
+    process opens its own connection, see get_walk_store().
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS walk_cache (
+            host    TEXT NOT NULL,
+            kind    TEXT NOT NULL,
+            oids    TEXT NOT NULL,
+            expires REAL NOT NULL,
+            result  BLOB NOT NULL,
+            PRIMARY KEY (host, kind, oids)
+        )
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        ''' open the database, creating it if needed, and drop expired results '''
+        netspryte.utils.mk_path(os.path.dirname(self.path))
+        self._conn = sqlite3.connect(self.path, timeout=C.DEFAULT_SNMP_TIMEOUT * 10,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(WalkStore.SCHEMA)
+        self._conn.execute("DELETE FROM walk_cache WHERE expires < ?", (time.time(),))
+        self._conn.commit()
+        logging.debug("opened snmp walk store %s", self.path)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, host, key):
+        ''' return (expires, result) stored for key on host, or None if missing or expired '''
+        kind, oids = key
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT expires, result FROM walk_cache WHERE host = ? AND kind = ? AND oids = ?",
+                    (host, kind, ','.join(oids))).fetchone()
+        except sqlite3.Error as e:
+            logging.error("failed to read snmp walk store %s: %s", self.path, str(e))
+            return None
+        if row is None or row[0] < time.time():
+            return None
+        return row[0], pickle.loads(row[1])
+
+    def put(self, host, key, result, expires):
+        ''' store result for key on host until expires '''
+        kind, oids = key
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO walk_cache (host, kind, oids, expires, result) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (host, kind, ','.join(oids), expires, sqlite3.Binary(pickle.dumps(result))))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error("failed to write snmp walk store %s: %s", self.path, str(e))
+
+    def invalidate(self, host, prefix=None):
+        ''' drop stored results for host under prefix, or all of them if prefix is None '''
+        try:
+            with self._lock:
+                if prefix is None:
+                    self._conn.execute("DELETE FROM walk_cache WHERE host = ?", (host,))
+                else:
+                    prefix = prefix.strip('.')
+                    rows = self._conn.execute("SELECT kind, oids FROM walk_cache WHERE host = ?",
+                                              (host,)).fetchall()
+                    for kind, oids in rows:
+                        for oid in oids.split(','):
+                            oid = oid.strip('.')
+                            if oid == prefix or oid.startswith(prefix + '.'):
+                                self._conn.execute(
+                                    "DELETE FROM walk_cache WHERE host = ? AND kind = ? AND oids = ?",
+                                    (host, kind, oids))
+                                break
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error("failed to invalidate snmp walk store %s: %s", self.path, str(e))
+
+
+class TaskHistory(object):
+    '''
+    How long each snmp module took to poll each device, kept as a moving
+    average in the same SQLite database as the WalkStore.  Collectors use
+    it to start the longest tasks first.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS task_duration (
+            host    TEXT NOT NULL,
+            module  TEXT NOT NULL,
+            elapsed REAL NOT NULL,
+            PRIMARY KEY (host, module)
+        )
+    '''
+
+    # weight of the newest duration in the moving average
+    WEIGHT = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        ''' open the database, creating it if needed '''
+        netspryte.utils.mk_path(os.path.dirname(self.path))
+        self._conn = sqlite3.connect(self.path, timeout=C.DEFAULT_SNMP_TIMEOUT * 10,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(TaskHistory.SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def record(self, host, module, elapsed):
+        ''' fold the time module took on host into its average '''
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT elapsed FROM task_duration WHERE host = ? AND module = ?",
+                    (host, module)).fetchone()
+                if row is not None:
+                    elapsed = TaskHistory.WEIGHT * elapsed + (1 - TaskHistory.WEIGHT) * row[0]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO task_duration (host, module, elapsed) VALUES (?, ?, ?)",
+                    (host, module, elapsed))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error("failed to record task duration in %s: %s", self.path, str(e))
+
+    def durations(self):
+        ''' return a dict of (host, module) to average seconds '''
+        try:
+            with self._lock:
+                rows = self._conn.execute("SELECT host, module, elapsed FROM task_duration").fetchall()
+        except sqlite3.Error as e:
+            logging.error("failed to read task durations from %s: %s", self.path, str(e))
+            return dict()
+        return dict(((host, module), elapsed) for host, module, elapsed in rows)
+
+
+_WALK_STORES = dict()   # (pid, path) -> WalkStore
+_TASK_HISTORIES = dict()   # (pid, path) -> TaskHistory
+
+
+def get_walk_store(path=None):
+    '''
+    Return the WalkStore for path opened by this process, or None if the
+    store is disabled or cannot be opened.  A connection is opened once per
+    process, since SQLite connections must not cross a fork.
+    '''
+    if not C.DEFAULT_SNMP_CACHE_PERSIST:
+        return None
+    path = path or os.path.join(C.DEFAULT_SNMP_STATEDIR, "cache.db")
+    key = (os.getpid(), path)
+    if key not in _WALK_STORES:
+        store = WalkStore(path)
+        try:
+            store.open()
+        except (sqlite3.Error, IOError, OSError) as e:
+            logging.error("failed to open snmp walk store %s: %s", path, str(e))
+            store = None
+        _WALK_STORES[key] = store
+    return _WALK_STORES[key]
+
+
+def get_task_history(path=None):
+    '''
+    Return the TaskHistory for path opened by this process, or None if it
+    cannot be opened.
+    '''
+    path = path or os.path.join(C.DEFAULT_SNMP_STATEDIR, "cache.db")
+    key = (os.getpid(), path)
+    if key not in _TASK_HISTORIES:
+        history = TaskHistory(path)
+        try:
+            history.open()
+        except (sqlite3.Error, IOError, OSError) as e:
+            logging.error("failed to open task history %s: %s", path, str(e))
+            history = None
+        _TASK_HISTORIES[key] = history
+    return _TASK_HISTORIES[key]
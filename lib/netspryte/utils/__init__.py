@@ -17,6 +17,7 @@
 # along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import fcntl
 import datetime
 import dateutil.parser
 import glob
@@ -142,6 +143,21 @@ def mk_path(arg):
         os.makedirs(arg)
 
 
+def lock_path(path):
+    '''
+    take an exclusive lock on path without waiting; return the open lock
+    file, which holds the lock until closed, or None if another process
+    holds it
+    '''
+    mk_path(os.path.dirname(path))
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock.close()
+        return None
+    return lock
+
 def json_ready(data):
     ''' take a dictionary and make it json friendly '''
     newdata = dict()
@@ -161,7 +177,8 @@ def parse_json(data):
 def parse_json_from_file(path):
     ''' read json string from path and convert to data structure '''
     try:
-        data = file(path).read()
+        with open(path) as f:
+            data = f.read()
         return parse_json(data)
     except IOError as e:
         logging.error('failed to read file %s: %s', path, str(e))
@@ -190,12 +207,15 @@ def get_data_instances_by_id():
     return data_set
 
 
-def get_db_backend():
+def get_db_backend(names=None):
     backends = list()
-    conf_backends = C.DEFAULT_DATABASE
+    conf_backends = names or C.DEFAULT_DATABASE
     for backend in conf_backends:
         if backend == "rrd":
             backends.append(netspryte.db.rrd.RrdDatabaseBackend(backend))
+        elif backend == "influxdb":
+            from netspryte.db import influx
+            backends.append(influx.InfluxDatabaseBackend(backend))
     if not backends:
         backends.append(netspryte.db.rrd.RrdDatabaseBackend("rrd"))
     return backends
@@ -0,0 +1,172 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import glob
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+from collections import Counter
+
+from netspryte import constants as C
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+_config = None    # (directory, mode) once profiling is turned on
+
+
+class Sampler(object):
+    '''
+    A statistical profiler.  A background thread looks at the stack of
+    every other thread of the process each interval seconds and counts
+    the stacks it sees, so the cost does not depend on how many calls are
+    made.  The counts are written in the collapsed stack format read by
+    flamegraph.pl and speedscope, with the thread name as the root frame.
+    '''
+
+    def __init__(self, interval=C.DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler")
+        self._thread.daemon = True
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in list(sys._current_frames().items()):
+                if ident == me:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        ''' write the stacks seen to path in collapsed stack format '''
+        write_folded(self.stacks, path)
+
+
+def write_folded(stacks, path):
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("%s %d\n" % (stack, count))
+
+
+def read_folded(path):
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, sep, count = line.rstrip('\n').rpartition(' ')
+            if sep and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def configure(directory=C.DEFAULT_PROFILEDIR, mode=C.DEFAULT_PROFILE_MODE):
+    '''
+    Turn on profiling for this process and the worker processes it forks
+    from now on; profiled() blocks write their profiles to directory.
+    '''
+    global _config
+    if mode not in PROFILE_MODES:
+        raise ValueError("profile mode must be one of %s" % ", ".join(PROFILE_MODES))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    _config = (directory, mode)
+    logging.warn("writing %s profiles to %s", mode, directory)
+
+
+@contextlib.contextmanager
+def profiled(name):
+    '''
+    Profile the block, if profiling is configured, writing name.folded
+    (sample mode) or name.pstats (cprofile mode) to the profile directory.
+    '''
+    if _config is None:
+        yield
+        return
+    directory, mode = _config
+    # a forked worker inherits the profile hook of the thread that forked it
+    sys.setprofile(None)
+    if mode == 'cprofile':
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError as e:
+            logging.error("failed to start profiler for %s: %s", name, str(e))
+            yield
+            return
+        try:
+            yield
+        finally:
+            prof.disable()
+            path = os.path.join(directory, "%s.pstats" % name)
+            prof.dump_stats(path)
+            logging.info("wrote profile %s", path)
+    else:
+        sampler = Sampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            path = os.path.join(directory, "%s.folded" % name)
+            sampler.write(path)
+            logging.info("wrote %s samples to %s", sampler.samples, path)
+
+
+def merge(directory=C.DEFAULT_PROFILEDIR, name="merged"):
+    '''
+    Combine the profiles in directory, from all workers, into name.pstats
+    and name.folded.  Returns the merged pstats.Stats, or None if there
+    were no pstats files.
+    '''
+    stats = None
+    pstats_files = [path for path in sorted(glob.glob(os.path.join(directory, "*.pstats")))
+                    if os.path.basename(path) != "%s.pstats" % name]
+    if pstats_files:
+        stats = pstats.Stats(*pstats_files)
+        stats.dump_stats(os.path.join(directory, "%s.pstats" % name))
+        logging.info("merged %s pstats files", len(pstats_files))
+    stacks = Counter()
+    folded_files = [path for path in sorted(glob.glob(os.path.join(directory, "*.folded")))
+                    if os.path.basename(path) != "%s.folded" % name]
+    for path in folded_files:
+        stacks.update(read_folded(path))
+    if folded_files:
+        write_folded(stacks, os.path.join(directory, "%s.folded" % name))
+        logging.info("merged %s collapsed stack files", len(folded_files))
+    return stats
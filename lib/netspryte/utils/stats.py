@@ -0,0 +1,355 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2017 University of Oregon
+#
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Counters, gauges and histograms describing how the collectors perform.
+
+Each process keeps its own Registry, returned by get_registry().  A
+process that calls bind() saves its registry as JSON to a file in the
+stats directory, picking up the counts of the previous run from it, so
+counters keep growing across cron runs.  read_stats() merges the files of
+all processes, and openmetrics() renders the result in the OpenMetrics
+text format; serve() answers /metrics and /stats.json over HTTP, and the
+netspryte-stats command prints or writes them.  Files that have not been
+saved for C.DEFAULT_STATS_EXPIRE seconds are from processes that are gone,
+such as workers of a run that had more of them, and are removed.
+'''
+
+import os
+import glob
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import netspryte.utils
+from netspryte import constants as C
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(kwargs):
+    return tuple(sorted((k, str(v)) for k, v in list(kwargs.items())))
+
+
+class Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = dict()   # tuple of (label, value) -> value
+
+    def samples(self):
+        with self._lock:
+            return [dict(labels=dict(k), value=v) for k, v in list(self._values.items())]
+
+    def restore(self, samples):
+        for sample in samples:
+            self._values[_labels(sample['labels'])] = sample['value']
+
+
+class Counter(Metric):
+
+    TYPE = "counter"
+
+    def inc(self, n=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+
+class Gauge(Metric):
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def restore(self, samples):
+        pass
+
+
+class Histogram(Metric):
+    ''' a histogram of observations with cumulative bucket counts, a sum and a count '''
+
+    TYPE = "histogram"
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = dict(buckets=[0] * len(self.buckets), sum=0, count=0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            return [dict(labels=dict(k), le=list(self.buckets), buckets=list(v['buckets']),
+                         sum=v['sum'], count=v['count']) for k, v in list(self._values.items())]
+
+    def restore(self, samples):
+        for sample in samples:
+            if sample.get('le') == list(self.buckets):
+                self._values[_labels(sample['labels'])] = dict(buckets=list(sample['buckets']),
+                                                               sum=sample['sum'], count=sample['count'])
+
+
+class Registry(object):
+    ''' the metrics of a process, by name '''
+
+    def __init__(self):
+        self.metrics = dict()
+        self.path = None
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, description, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, description, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, description=""):
+        return self._get(Counter, name, description)
+
+    def gauge(self, name, description=""):
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name, description="", buckets=BUCKETS):
+        return self._get(Histogram, name, description, buckets=buckets)
+
+    def snapshot(self):
+        ''' return the metrics as a JSON ready dict '''
+        data = dict()
+        for name, metric in list(self.metrics.items()):
+            data[name] = dict(type=metric.TYPE, help=metric.description, samples=metric.samples())
+        return data
+
+    def bind(self, path):
+        '''
+        save to path from now on, continuing the counters saved there by an
+        earlier process; a registry is only bound once
+        '''
+        if self.path is not None:
+            return
+        self.path = path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warn("failed to load stats from %s: %s", path, str(e))
+            return
+        types = dict((cls.TYPE, cls) for cls in (Counter, Gauge, Histogram))
+        for name, entry in list(data.items()):
+            if entry.get('type') in types:
+                self._get(types[entry['type']], name, entry.get('help', "")).restore(entry.get('samples', []))
+
+    def save(self):
+        ''' write the metrics to the bound path, if any '''
+        if self.path is None:
+            return
+        netspryte.utils.json2path(self.snapshot(), self.path)
+        self.saved = time.time()
+
+
+_REGISTRIES = dict()   # pid -> Registry
+
+
+def get_registry():
+    ''' return the Registry of this process; a forked process starts with an empty one '''
+    pid = os.getpid()
+    if pid not in _REGISTRIES:
+        _REGISTRIES[pid] = Registry()
+    return _REGISTRIES[pid]
+
+
+def counter(name, description=""):
+    return get_registry().counter(name, description)
+
+
+def gauge(name, description=""):
+    return get_registry().gauge(name, description)
+
+
+def histogram(name, description="", buckets=BUCKETS):
+    return get_registry().histogram(name, description, buckets)
+
+
+def bind(name, statsdir=None):
+    ''' save the registry of this process as name.json in the stats directory '''
+    if not C.DEFAULT_STATS:
+        return
+    statsdir = statsdir or C.DEFAULT_STATSDIR
+    get_registry().bind(os.path.join(statsdir, "%s.json" % name))
+
+
+def save(interval=None):
+    '''
+    save the registry of this process; with interval, only if it has not
+    been saved in the last interval seconds
+    '''
+    if not C.DEFAULT_STATS:
+        return
+    registry = get_registry()
+    if interval and time.time() - registry.saved < interval:
+        return
+    registry.save()
+
+
+def merge(snapshots):
+    ''' merge registry snapshots, adding up counters and histograms; gauges keep the last value '''
+    merged = dict()
+    for snapshot in snapshots:
+        for name, entry in list(snapshot.items()):
+            target = merged.setdefault(name, dict(type=entry['type'], help=entry.get('help', ""), samples=dict()))
+            for sample in entry.get('samples', []):
+                key = _labels(sample['labels'])
+                if entry['type'] == 'gauge' or key not in target['samples']:
+                    target['samples'][key] = json.loads(json.dumps(sample))
+                elif entry['type'] == 'counter':
+                    target['samples'][key]['value'] += sample['value']
+                elif target['samples'][key].get('le') == sample.get('le'):
+                    existing = target['samples'][key]
+                    existing['buckets'] = [a + b for a, b in zip(existing['buckets'], sample['buckets'])]
+                    existing['sum'] += sample['sum']
+                    existing['count'] += sample['count']
+    for entry in list(merged.values()):
+        entry['samples'] = list(entry['samples'].values())
+    return merged
+
+
+def prune(statsdir=None, expire=None):
+    '''
+    Remove the stats files in the stats directory that have not been saved
+    for expire seconds; returns the paths of the files that are left
+    '''
+    statsdir = statsdir or C.DEFAULT_STATSDIR
+    expire = expire or C.DEFAULT_STATS_EXPIRE
+    now = time.time()
+    paths = list()
+    for path in glob.glob(os.path.join(statsdir, "*.json")):
+        try:
+            if now - os.path.getmtime(path) <= expire:
+                paths.append(path)
+                continue
+            logging.info("removing stats of a process that is gone: %s", path)
+            os.unlink(path)
+        except OSError as e:
+            logging.warn("failed to check stats file %s: %s", path, str(e))
+    return paths
+
+
+def read_stats(statsdir=None, expire=None):
+    ''' return the merged stats saved by the processes in the stats directory, pruning those that are gone '''
+    snapshots = list()
+    for path in sorted(prune(statsdir, expire), key=os.path.getmtime):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            logging.warn("failed to read stats from %s: %s", path, str(e))
+    return merge(snapshots)
+
+
+def _fmt_labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in items)
+
+
+def openmetrics(stats):
+    ''' render merged stats in the OpenMetrics text format '''
+    lines = list()
+    for name in sorted(stats):
+        entry = stats[name]
+        lines.append("# TYPE %s %s" % (name, entry['type']))
+        if entry.get('help'):
+            lines.append("# HELP %s %s" % (name, entry['help']))
+        for sample in entry['samples']:
+            labels = sample['labels']
+            if entry['type'] == 'counter':
+                lines.append("%s_total%s %s" % (name, _fmt_labels(labels), sample['value']))
+            elif entry['type'] == 'gauge':
+                lines.append("%s%s %s" % (name, _fmt_labels(labels), sample['value']))
+            else:
+                for bound, count in zip(sample['le'], sample['buckets']):
+                    lines.append("%s_bucket%s %s" % (name, _fmt_labels(labels, ('le', bound)), count))
+                lines.append("%s_bucket%s %s" % (name, _fmt_labels(labels, ('le', '+Inf')), sample['count']))
+                lines.append("%s_sum%s %s" % (name, _fmt_labels(labels), sample['sum']))
+                lines.append("%s_count%s %s" % (name, _fmt_labels(labels), sample['count']))
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stats = read_stats(self.server.statsdir)
+        if self.path == "/metrics":
+            body = openmetrics(stats)
+            ctype = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+        elif self.path == "/stats.json":
+            body = json.dumps(stats, indent=4, sort_keys=True)
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("stats request from %s: %s", self.address_string(), fmt % args)
+
+
+class StatsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=C.DEFAULT_STATS_PORT, statsdir=None):
+    ''' serve the merged stats over HTTP from a background thread; returns the server '''
+    server = StatsServer(('', port), StatsHandler)
+    server.statsdir = statsdir or C.DEFAULT_STATSDIR
+    thread = threading.Thread(target=server.serve_forever, name="stats-http")
+    thread.daemon = True
+    thread.start()
+    logging.warn("serving collector stats on port %s", server.server_address[1])
+    return server
@@ -16,30 +16,85 @@
 # You should have received a copy of the GNU General Public License
 # along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import glob
+import json
 import time
+import random
+import tempfile
 import logging
+import threading
+
+from netspryte import constants as C
+
+_local = threading.local()
+_lock = threading.Lock()
+_spans = dict()     # path -> SpanStats
+_events = list()    # chrome trace events, if tracing
+_exported = dict()  # name -> time spans were last exported
+
 
 class Timer(object):
 
     '''
     A class to help measure how long a section of code takes to run.
 
+    A Timer is also a tracing span.  A Timer started while another is
+    running in the same thread becomes its child, unless a parent is given,
+    and its path is the parent's path followed by its category (or name).
+    Stopped spans are aggregated by path in this process, see
+    span_summary(), and with tracing on are kept as Chrome trace events,
+    see export_trace().  Attributes such as a varbind count may be given
+    as keyword arguments or with set().
     '''
-    def __init__(self, name=None):
+    def __init__(self, name=None, category=None, parent=None, log=True, **attrs):
         self._start = time.time()
         self._stop = 0
         self._elapsed = 0
         self._name = "Generic Timer"
         if name:
             self.name = name
+        self.category = category
+        self.parent = parent
+        self.log = log
+        self.attrs = attrs
+
+    @staticmethod
+    def current():
+        ''' return the innermost running Timer of this thread, or None '''
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    @property
+    def path(self):
+        this = self.category or self.name
+        if self.parent is None:
+            return this
+        return "%s/%s" % (self.parent.path, this)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
 
     def start_timer(self):
         self.start = time.time()
+        if self.parent is None:
+            self.parent = Timer.current()
+        if not hasattr(_local, 'stack'):
+            _local.stack = list()
+        _local.stack.append(self)
 
     def stop_timer(self):
         self.stop = time.time()
         self.elapsed = self.stop - self.start
-        logging.warn("%s elapsed time: %.3fs", self.name, self.elapsed)
+        stack = getattr(_local, 'stack', [])
+        if self in stack:
+            # children that were never stopped end with their parent
+            del stack[stack.index(self):]
+        record_span(self)
+        if self.log:
+            logging.warn("%s elapsed time: %.3fs", self.name, self.elapsed)
 
     '''
     The following methods allow one to invoke Timer() thusly:
@@ -48,13 +103,11 @@ class Timer(object):
         run_method()
     '''
     def __enter__(self):
-        self.start = time.time()
+        self.start_timer()
         return self
 
     def __exit__(self, *args):
-        self.stop = time.time()
-        self.elapsed = self.stop - self.start
-        logging.warn("%s elapsed time: %.3fs", self.name, self.elapsed)
+        self.stop_timer()
 
     @property
     def start(self):
@@ -87,3 +140,170 @@ class Timer(object):
     @name.setter
     def name(self, arg):
         self._name = arg
+
+
+class SpanStats(object):
+    '''
+    The durations of the spans with one path: count, total and maximum,
+    and a uniform sample of up to SAMPLES durations for percentiles.
+    '''
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = list()
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if len(self.samples) < SpanStats.SAMPLES:
+            self.samples.append(elapsed)
+        else:
+            i = random.randrange(self.count)
+            if i < SpanStats.SAMPLES:
+                self.samples[i] = elapsed
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+    def summary(self, samples=False):
+        data = dict(count=self.count, total=round(self.total, 6), mean=round(self.total / self.count, 6),
+                    max=round(self.max, 6), p50=round(self.percentile(50), 6),
+                    p90=round(self.percentile(90), 6), p99=round(self.percentile(99), 6))
+        if samples:
+            data['samples'] = [round(elapsed, 6) for elapsed in self.samples]
+        return data
+
+
+def weighted_percentile(samples, pct):
+    '''
+    Return the pct percentile of a list of (duration, weight) pairs, where
+    a sample stands for weight spans, as when reservoirs of processes that
+    saw different numbers of spans are put together.
+    '''
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    limit = sum(weight for elapsed, weight in ordered) * pct / 100.0
+    seen = 0.0
+    for elapsed, weight in ordered:
+        seen += weight
+        if seen > limit:
+            return elapsed
+    return ordered[-1][0]
+
+
+def record_span(span):
+    ''' add a stopped Timer to the span statistics, and to the trace if tracing '''
+    path = span.path
+    with _lock:
+        if path not in _spans:
+            _spans[path] = SpanStats()
+        _spans[path].add(span.elapsed)
+        if C.DEFAULT_TRACE and len(_events) < C.DEFAULT_TRACE_EVENTS:
+            _events.append({
+                "name": span.name,
+                "cat": span.category or "",
+                "ph": "X",
+                "ts": int(span.start * 1000000),
+                "dur": int(span.elapsed * 1000000),
+                "pid": os.getpid(),
+                "tid": threading.current_thread().ident,
+                "args": dict((k, str(v)) for k, v in list(span.attrs.items())),
+            })
+
+
+def span_summary():
+    ''' return a dict of span path to count, total, mean, max and percentiles of durations '''
+    with _lock:
+        return dict((path, stats.summary()) for path, stats in list(_spans.items()))
+
+
+def _write_json(data, path):
+    ''' write data to path as JSON through a temporary file, so readers never see a partial file '''
+    dir_name = os.path.dirname(path) or '.'
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    tmpfd, temp_path = tempfile.mkstemp(dir=dir_name)
+    try:
+        with os.fdopen(tmpfd, 'w') as tmp:
+            json.dump(data, tmp, indent=1, sort_keys=True)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def export_spans(path):
+    ''' write span_summary() to path as JSON, with the sampled durations so read_spans() can merge percentiles '''
+    with _lock:
+        data = dict((path, stats.summary(samples=True)) for path, stats in list(_spans.items()))
+    _write_json(data, path)
+
+
+def export_trace(path):
+    ''' write the spans traced so far to path as a Chrome trace, for chrome://tracing or Perfetto '''
+    with _lock:
+        events = list(_events)
+    _write_json({"traceEvents": events, "displayTimeUnit": "ms"}, path)
+
+
+def read_spans(tracedir=None):
+    '''
+    Return the span summaries exported by all processes to tracedir,
+    merged by path.  Counts and totals are added up, max is the largest,
+    and the percentiles are computed over the samples of all processes,
+    each weighted by how many spans of its process it stands for.
+    '''
+    tracedir = tracedir or C.DEFAULT_TRACEDIR
+    merged = dict()
+    samples = dict()
+    for path in sorted(glob.glob(os.path.join(tracedir, "spans-*.json"))):
+        try:
+            with open(path) as f:
+                summary = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logging.warn("failed to read spans from %s: %s", path, str(e))
+            continue
+        for span_path, stats in list(summary.items()):
+            sampled = stats.pop('samples', [])
+            if sampled:
+                weight = stats['count'] / float(len(sampled))
+                samples.setdefault(span_path, list()).extend((elapsed, weight) for elapsed in sampled)
+            if span_path not in merged:
+                merged[span_path] = dict(stats)
+                continue
+            entry = merged[span_path]
+            entry['count'] += stats['count']
+            entry['total'] = round(entry['total'] + stats['total'], 6)
+            entry['mean'] = round(entry['total'] / entry['count'], 6)
+            entry['max'] = max(entry['max'], stats['max'])
+    for span_path, sampled in list(samples.items()):
+        for pct in (50, 90, 99):
+            merged[span_path]['p%d' % pct] = round(weighted_percentile(sampled, pct), 6)
+    return merged
+
+
+def export(name, tracedir=None, interval=None):
+    '''
+    write the span summary and, if tracing, the Chrome trace of this
+    process to tracedir; with interval, only if they have not been
+    written in the last interval seconds
+    '''
+    if interval and time.time() - _exported.get(name, 0) < interval:
+        return
+    _exported[name] = time.time()
+    tracedir = tracedir or C.DEFAULT_TRACEDIR
+    try:
+        export_spans(os.path.join(tracedir, "spans-%s.json" % name))
+        if C.DEFAULT_TRACE:
+            export_trace(os.path.join(tracedir, "trace-%s.json" % name))
+    except (IOError, OSError) as e:
+        logging.error("failed to export spans to %s: %s", tracedir, str(e))
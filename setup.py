@@ -29,7 +29,7 @@ setup(name='netspryte',
           'Flask',
           'peewee',
           'psycopg2',
-          'pysnmp',
+          'pysnmp>=4.4,<5',
           'python-crontab',
           'rrdtool',
           ],
@@ -53,9 +53,14 @@ setup(name='netspryte',
           'Topic :: Utilities',
       ],
       scripts=[
+          'bin/netspryte-benchmark',
           'bin/netspryte-collect-snmp',
           'bin/netspryte-discover',
           'bin/netspryte-janitor',
+          'bin/netspryte-microbench',
+          'bin/netspryte-profile-merge',
+          'bin/netspryte-snmpsim',
+          'bin/netspryte-stats',
           'bin/rrd-add-ds',
           'bin/rrd-merge-rrd',
           'bin/rrd-tune',
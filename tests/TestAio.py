@@ -0,0 +1,64 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import asyncio
+import unittest
+
+from netspryte.commands import BaseWorker, WorkerPool
+from netspryte.errors import NetspryteError, NetspryteTimeout
+
+try:
+    import netspryte.snmp.aio
+    HAVE_AIO = True
+except (ImportError, AttributeError):
+    # pysnmp 4.4 needs asyncio.coroutine, gone in Python 3.11
+    HAVE_AIO = False
+
+
+class FakeSession(object):
+    deadline = None
+
+
+class TestAio(unittest.TestCase):
+
+    @unittest.skipIf(HAVE_AIO, "the pysnmp asyncio API is available")
+    def test_unavailable(self):
+        pool = WorkerPool(BaseWorker, [], 1, use_asyncio=True)
+        self.assertRaises(NetspryteError, pool.start)
+
+    @unittest.skipUnless(HAVE_AIO, "the pysnmp asyncio API is not available")
+    def test_async_query_deadline(self):
+        engine = netspryte.snmp.aio.AsyncSNMPEngine(2)
+        engine.start()
+        try:
+            session = FakeSession()
+            cmdgen = netspryte.snmp.aio.AsyncCommandGenerator(engine, session)
+            self.assertEqual(cmdgen._run(asyncio.sleep(0, result=1)), 1)
+            session.deadline = time.time() + 0.1
+            start = time.time()
+            self.assertRaises(NetspryteTimeout, cmdgen._run, asyncio.sleep(5))
+            self.assertLess(time.time() - start, 1)
+            session.deadline = None
+            self.assertEqual(cmdgen._run(asyncio.sleep(0, result=2)), 2)
+        finally:
+            engine.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,387 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import netspryte.snmp
+import netspryte.snmp.store
+import netspryte.utils.timer
+from netspryte import constants as C
+from netspryte.commands import time_limit, BaseWorker, Pipeline, Stage, SerializedCatalog, Scheduler, WorkerPool
+from netspryte.errors import NetspryteTimeout
+from netspryte.manager import MeasurementInstance
+
+
+class FakeSession(object):
+    deadline = None
+
+
+class FakePollSession(object):
+    ''' stands in for a SNMP session of a device that always answers '''
+
+    reachable = True
+    deadline = None
+
+    def __init__(self, host=None):
+        self.host = host
+        self.cache = netspryte.snmp.SNMPCache()
+
+
+def mk_module(name, seconds, ran):
+    ''' return a snmp module class that takes seconds to poll and notes in ran that it started '''
+    class Module(object):
+        NAME = name
+        STAT = True
+
+        def __init__(self, snmp):
+            ran.append(name)
+            time.sleep(seconds)
+            self.data = list()
+    return Module
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeManager(object):
+    ''' records what a worker writes to the database '''
+
+    def __init__(self):
+        self.ids = dict()
+        self.upserted = list()
+        self.touched = list()
+        self.missing = 0
+
+    def get_or_create(self, model, **kwargs):
+        return Row(id=1, description=None, metric_type=None, **kwargs)
+
+    def bulk_upsert(self, model, rows, fill=()):
+        self.upserted.append(rows)
+        for row in rows:
+            self.ids.setdefault(row['name'], len(self.ids) + 1)
+        return dict((row['name'], self.ids[row['name']]) for row in rows)
+
+    def write_latest_metrics(self, metrics, updated=None):
+        self.latest = metrics
+
+    def update_by_id(self, model, ids, **kwargs):
+        if model is MeasurementInstance:
+            self.touched.append(ids)
+            return len(ids) - self.missing
+        return len(ids)
+
+    def save(self, obj):
+        pass
+
+
+class FakeBatch(object):
+    NAME = "interface"
+    DESCRIPTION = "interfaces"
+
+    def __init__(self, speeds):
+        self.data = [dict(host="router", name="router-if-%s" % i, index=str(i), transport="snmp",
+                          attrs=dict(ifSpeed=speed), metrics=dict(ifInOctets=i * 100), **{'class': "interface"})
+                     for i, speed in enumerate(speeds)]
+
+
+class FakeCatalog(object):
+    ''' records whether the lock was held during each lookup '''
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.held = list()
+
+    def get_instances_by_host_and_class(self, host, cls):
+        self.held.append(self.lock._is_owned())
+        return [(host, cls)]
+
+    def get_instances_by_tags(self, tags):
+        self.held.append(self.lock._is_owned())
+        return list(tags)
+
+
+class TestCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.statedir = C.DEFAULT_SNMP_STATEDIR
+        self.profile = C.DEFAULT_SNMP_PROFILE
+        self.tracedir = C.DEFAULT_TRACEDIR
+        C.DEFAULT_SNMP_STATEDIR = tempfile.mkdtemp()
+        C.DEFAULT_TRACEDIR = tempfile.mkdtemp()
+        C.DEFAULT_SNMP_PROFILE = False
+
+    def tearDown(self):
+        shutil.rmtree(C.DEFAULT_SNMP_STATEDIR)
+        shutil.rmtree(C.DEFAULT_TRACEDIR)
+        C.DEFAULT_SNMP_STATEDIR = self.statedir
+        C.DEFAULT_TRACEDIR = self.tracedir
+        C.DEFAULT_SNMP_PROFILE = self.profile
+
+    def mk_worker(self, modules):
+        worker = BaseWorker(modules=modules, snmp_session=FakePollSession)
+        worker.pipeline = Pipeline(Stage("catalog", lambda batch: None), threaded=False)
+        return worker
+
+    def test_time_limit(self):
+        start = time.time()
+        with self.assertRaises(NetspryteTimeout):
+            with time_limit(0.1):
+                time.sleep(2)
+        self.assertLess(time.time() - start, 1)
+        with time_limit(None):
+            time.sleep(0.01)
+        with time_limit(1):
+            time.sleep(0.01)
+
+    def test_time_left(self):
+        worker = self.mk_worker([])
+        now = time.time()
+        self.assertIsNone(worker.time_left(now))
+        worker.module_budget = 10
+        self.assertEqual(worker.time_left(now), 10)
+        worker.device_budget = 5
+        self.assertAlmostEqual(worker.time_left(now), 5, delta=0.1)
+        self.assertAlmostEqual(worker.time_left(now - 4), 1, delta=0.1)
+        worker.deadline = now + 0.5
+        self.assertAlmostEqual(worker.time_left(now), 0.5, delta=0.1)
+        worker.deadline = now - 1
+        self.assertLess(worker.time_left(now), 0)
+
+    def test_process_device_budgets(self):
+        ran = list()
+        modules = [mk_module("slow", 2, ran), mk_module("slower", 2, ran), mk_module("fast", 0, ran)]
+        worker = self.mk_worker(modules)
+        worker.module_budget = 0.2
+        worker.device_budget = 0.3
+        start = time.time()
+        worker.process_device("router")
+        self.assertLess(time.time() - start, 1)
+        # slow runs out of its module budget, slower of what is left of the device budget
+        self.assertEqual(ran, ["slow", "slower"])
+        stats = worker.stats.as_dict()
+        self.assertEqual(stats['modules_timed_out'], 2)
+        self.assertEqual(stats['devices_over_budget'], 1)
+        self.assertEqual(stats['modules_skipped'], 1)
+
+    def test_process_device_within_budget(self):
+        ran = list()
+        worker = self.mk_worker([mk_module("a", 0, ran), mk_module("b", 0, ran)])
+        worker.module_budget = 1
+        worker.device_budget = 1
+        worker.process_device("router", ["b"])
+        self.assertEqual(ran, ["b"])
+        self.assertEqual(worker.stats.as_dict()['modules_timed_out'], 0)
+
+    def test_process_device_span_paths(self):
+        class Profile(object):
+            device_class = "1.3.6.1.4.1.9.1.1"
+
+            def applies(self, cls):
+                return True
+
+        class ProfiledSession(FakePollSession):
+            profile = Profile()
+
+        worker = self.mk_worker([mk_module("a", 0, []), mk_module("b", 0, [])])
+        worker.snmp_session = ProfiledSession
+        C.DEFAULT_SNMP_PROFILE = True
+        worker.process_device("router")
+        # spans are kept apart by module and by kind of device
+        paths = netspryte.utils.timer.span_summary()
+        self.assertIn("device/1.3.6.1.4.1.9.1.1", paths)
+        self.assertIn("device/1.3.6.1.4.1.9.1.1/module/a", paths)
+        self.assertIn("device/1.3.6.1.4.1.9.1.1/module/b", paths)
+
+    def test_time_limit_sets_session_deadline(self):
+        session = FakeSession()
+        seen = list()
+
+        def poll():
+            with time_limit(5, session):
+                seen.append(session.deadline)
+
+        thread = threading.Thread(target=poll)
+        thread.start()
+        thread.join()
+        self.assertAlmostEqual(seen[0], time.time() + 5, delta=1)
+        self.assertIsNone(session.deadline)
+        with time_limit(None, session):
+            self.assertIsNone(session.deadline)
+
+    def test_process_module_data_writes_changes_only(self):
+        worker = self.mk_worker([])
+        worker.mgr = FakeManager()
+        insts = worker.process_module_data(FakeBatch([100, 1000]))
+        self.assertEqual([row['name'] for row in worker.mgr.upserted[-1]], ["router-if-0", "router-if-1"])
+        self.assertEqual([inst.id for inst in insts], [1, 2])
+        self.assertEqual(worker.mgr.latest, {1: {'ifInOctets': 0}, 2: {'ifInOctets': 100}})
+        # unchanged instances are only touched; changed ones are rewritten
+        insts = worker.process_module_data(FakeBatch([100, 10000]))
+        self.assertEqual([(row['name'], row['attrs']) for row in worker.mgr.upserted[-1]],
+                         [("router-if-1", {'ifSpeed': '10000'})])
+        self.assertEqual(worker.mgr.touched[-1], [1])
+        self.assertEqual([inst.id for inst in insts], [1, 2])
+        # when touched rows have gone from the database, everything is written next time
+        worker.mgr.missing = 1
+        worker.process_module_data(FakeBatch([100, 10000]))
+        self.assertEqual(worker.mgr.upserted[-1], [])
+        worker.process_module_data(FakeBatch([100, 10000]))
+        self.assertEqual(len(worker.mgr.upserted[-1]), 2)
+
+    def mk_pipeline(self, threaded, results, depth=C.DEFAULT_PIPELINE_DEPTH):
+        ''' a catalog stage that doubles items, feeding two backend stages that record them '''
+        backends = [Stage("db-%s" % name, lambda item, name=name: results.append((name, item)), depth=depth)
+                    for name in ("rrd", "influx")]
+
+        def catalog(item):
+            if item == "bad":
+                raise ValueError(item)
+            return item * 2
+        return Pipeline(Stage("catalog", catalog, backends, depth=depth), threaded=threaded)
+
+    def test_pipeline(self):
+        for threaded in (False, True):
+            results = list()
+            pipeline = self.mk_pipeline(threaded, results)
+            self.assertEqual([stage.name for stage in pipeline.stages()], ["catalog", "db-rrd", "db-influx"])
+            pipeline.start()
+            for item in (1, "bad", 2, 3):
+                pipeline.put(item)
+            pipeline.stop()
+            self.assertFalse(any(stage.is_alive() for stage in pipeline.stages()))
+            # a failed item is dropped; the others reach every backend in order
+            self.assertEqual([item for name, item in results if name == "rrd"], [2, 4, 6])
+            self.assertEqual([item for name, item in results if name == "influx"], [2, 4, 6])
+
+    def test_pipeline_is_bounded(self):
+        results = list()
+        release = threading.Event()
+        blocked = Stage("slow", lambda item: release.wait() and results.append(item), depth=1)
+        pipeline = Pipeline(blocked, threaded=True)
+        pipeline.start()
+        feeder = threading.Thread(target=lambda: [pipeline.put(i) for i in range(3)])
+        feeder.start()
+        feeder.join(0.2)
+        # one item is being processed and one waits in the queue, so the third blocks
+        self.assertTrue(feeder.is_alive())
+        release.set()
+        feeder.join()
+        pipeline.stop()
+        self.assertEqual(results, [0, 1, 2])
+
+    def polls(self, scheduler, start, seconds):
+        ''' return the times each device is due in the seconds after start '''
+        seen = dict()
+        for t in range(int(start), int(start) + seconds + 1):
+            for device in scheduler.due(t):
+                seen.setdefault(device, list()).append(t)
+        return seen
+
+    def test_scheduler(self):
+        devices = ["router-%s" % i for i in range(20)]
+        scheduler = Scheduler(devices, interval=1)
+        start = time.time()
+        self.assertTrue(start < scheduler.next_due() <= start + 60)
+        self.assertEqual(scheduler.due(start), [])
+        seen = self.polls(scheduler, start, 180)
+        self.assertEqual(sorted(seen), sorted(devices))
+        for device, times in seen.items():
+            # once a minute, always at the same offset into the minute
+            self.assertEqual(len(times), 3)
+            self.assertEqual(set(t % 60 for t in times), set([scheduler.offset(device)]))
+        # offsets depend only on the name, and spread devices across the minute
+        self.assertEqual(Scheduler(devices).offset("router-1"), scheduler.offset("router-1"))
+        self.assertGreater(len(set(scheduler.offset(device) for device in devices)), 10)
+
+    def test_scheduler_intervals(self):
+        scheduler = Scheduler(["a", "b"], interval=1)
+
+        class FakeManager(object):
+            def get_all(self, model):
+                return [Row(name="a", interval=2), Row(name="b", interval=1), Row(name="z", interval=5)]
+
+        scheduler.refresh(FakeManager())
+        self.assertEqual(scheduler.intervals, {"a": 2, "b": 1})
+        seen = self.polls(scheduler, time.time(), 600)
+        self.assertIn(len(seen["a"]), (5, 6))
+        self.assertEqual(len(seen["b"]), 10)
+
+    def test_scheduler_set_devices(self):
+        scheduler = Scheduler(["a", "b"])
+        scheduler.set_devices(["b", "c"])
+        self.assertEqual(sorted(scheduler.intervals), ["b", "c"])
+        seen = self.polls(scheduler, time.time(), 120)
+        self.assertEqual(sorted(seen), ["b", "c"])
+        scheduler.set_devices([])
+        self.assertEqual(scheduler.due(time.time() + 3600), [])
+        self.assertAlmostEqual(scheduler.next_due(), time.time() + 1, delta=0.5)
+
+    def test_pool_in_flight(self):
+        pool = WorkerPool(BaseWorker, [mk_module("a", 0, [])], 1)
+        pool.done_queue = queue.Queue()
+        submitted = list()
+        pool.submit = lambda device, names=None: (pool.in_flight.__setitem__(device, time.time()),
+                                                  submitted.append(device))
+        pool.submit_all(["a", "b"])
+        # a device still being polled is not handed out again
+        pool.submit_all(["a", "b", "c"])
+        self.assertEqual(sorted(submitted), ["a", "b", "c"])
+        pool.done_queue.put("a")
+        pool.submit_all(["a", "b"])
+        self.assertEqual(sorted(submitted), ["a", "a", "b", "c"])
+        self.assertEqual(sorted(pool.in_flight), ["a", "b", "c"])
+        # a poll that outlived the cycle is given up on
+        pool.in_flight["b"] -= C.DEFAULT_CYCLE_DEADLINE + C.DEFAULT_CYCLE_GRACE
+        self.assertFalse(pool.busy("b"))
+        self.assertTrue(pool.busy("c"))
+
+    def test_run_task(self):
+        worker = BaseWorker(None, [])
+        worker.done_queue = queue.Queue()
+        worker.process_device = lambda device, names: 1 / 0
+        self.assertRaises(ZeroDivisionError, worker.run_task, "router")
+        # the device is reported done even when polling it failed
+        self.assertEqual(worker.done_queue.get_nowait(), "router")
+
+    def test_task_history(self):
+        history = netspryte.snmp.store.TaskHistory(os.path.join(C.DEFAULT_SNMP_STATEDIR, "cache.db"))
+        history.open()
+        history.record("router", "interface", 2.0)
+        history.record("router", "interface", 4.0)
+        history.record("switch", "interface", 1.0)
+        self.assertEqual(history.durations(), {("router", "interface"): 3.0, ("switch", "interface"): 1.0})
+        history.close()
+
+    def test_serialized_catalog(self):
+        lock = threading.RLock()
+        catalog = SerializedCatalog(FakeCatalog(lock), lock)
+        self.assertEqual(catalog.get_instances_by_host_and_class("router", "interface"), [("router", "interface")])
+        self.assertEqual(catalog.get_instances_by_tags(["core"]), ["core"])
+        self.assertEqual(catalog.mgr.held, [True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
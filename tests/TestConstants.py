@@ -31,6 +31,11 @@ class TestConstants(unittest.TestCase):
 
     def setUp(self):
         self.msnmp = netspryte.snmp.SNMPSession()
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
 
     def test_constants_missing_config(self):
         os.environ['NETSPRYTE_CONFIG'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -47,3 +52,10 @@ class TestConstants(unittest.TestCase):
         os.environ['NETSPRYTE_CONFIG'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                                       'netspryte.cfg')
         C.load_config()
+
+    def test_constants_environment(self):
+        os.environ['NETSPRYTE_TEST_WORKERS'] = '4'
+        os.environ['NETSPRYTE_TEST_DATABASE'] = 'rrd, influxdb'
+        self.assertEqual(C.get_config(None, C.DEFAULTS, 'workers', 'NETSPRYTE_TEST_WORKERS', 1, integer=True), 4)
+        self.assertEqual(C.get_config(None, C.DEFAULTS, 'database', 'NETSPRYTE_TEST_DATABASE', ['rrd'], islist=True),
+                         ['rrd', 'influxdb'])
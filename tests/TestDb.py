@@ -0,0 +1,119 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import netspryte.db.rrd
+from netspryte import constants as C
+from netspryte.db import BaseDatabaseBackend
+from netspryte.utils import get_db_backend
+
+
+class FakeRrdtool(object):
+    ''' creates empty files for rrds and records updates '''
+
+    class OperationalError(Exception):
+        pass
+
+    class ProgrammingError(Exception):
+        pass
+
+    def __init__(self):
+        self.broken = False
+        self.updates = list()
+
+    def create(self, path, *args):
+        if self.broken:
+            raise FakeRrdtool.OperationalError("cannot create %s" % path)
+        open(path, 'w').close()
+
+    def update(self, path, *args):
+        if not os.path.exists(path):
+            raise FakeRrdtool.OperationalError("%s does not exist" % path)
+        self.updates.append(path)
+
+
+class FakeRecord(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def mk_instance(index):
+    host = FakeRecord(name="router")
+    cls = FakeRecord(name="interface", metric_type=dict(ifHCInOctets='counter'))
+    return FakeRecord(host=host, measurement_class=cls, index=str(index))
+
+
+class TestDb(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = C.DEFAULT_DATADIR
+        C.DEFAULT_DATADIR = tempfile.mkdtemp()
+        self.rrdtool = netspryte.db.rrd.rrdtool
+        self.fake = netspryte.db.rrd.rrdtool = FakeRrdtool()
+
+    def tearDown(self):
+        shutil.rmtree(C.DEFAULT_DATADIR)
+        C.DEFAULT_DATADIR = self.datadir
+        netspryte.db.rrd.rrdtool = self.rrdtool
+
+    def test_get_db_backend(self):
+        self.assertEqual([db.backend for db in get_db_backend()], C.DEFAULT_DATABASE)
+        self.assertEqual([db.backend for db in get_db_backend(['rrd', 'influxdb'])], ['rrd', 'influxdb'])
+        self.assertEqual([db.backend for db in get_db_backend(['bogus'])], ['rrd'])
+
+    def test_base_write_many(self):
+        class Recorder(BaseDatabaseBackend):
+            def write(self, data, xlate=None, ts=None):
+                self.written.append((self.measurement_instance, data, ts))
+        backend = Recorder("recorder")
+        backend.written = list()
+        backend.write_many([('a', {'x': 1}), ('b', {'x': 2})], ts=10)
+        self.assertEqual(backend.written, [('a', {'x': 1}, 10), ('b', {'x': 2}, 10)])
+
+    def test_rrd_write_many(self):
+        backend = netspryte.db.rrd.RrdDatabaseBackend("rrd")
+        samples = [(mk_instance(i), {'ifHCInOctets': i}) for i in (1, 2)]
+        backend.write_many(samples, ts=10)
+        self.assertEqual(len(self.fake.updates), 2)
+        self.assertTrue(all(os.path.exists(path) for path in self.fake.updates))
+
+    def test_rrd_write_many_retries_failed_create(self):
+        backend = netspryte.db.rrd.RrdDatabaseBackend("rrd")
+        samples = [(mk_instance(1), {'ifHCInOctets': 1})]
+        self.fake.broken = True
+        backend.write_many(samples, ts=10)
+        self.assertEqual(self.fake.updates, [])
+        self.fake.broken = False
+        backend.write_many(samples, ts=20)
+        self.assertEqual(len(self.fake.updates), 1)
+
+    def test_rrd_write_many_recreates_deleted_rrd(self):
+        backend = netspryte.db.rrd.RrdDatabaseBackend("rrd")
+        samples = [(mk_instance(1), {'ifHCInOctets': 1})]
+        backend.write_many(samples, ts=10)
+        path = self.fake.updates[0]
+        os.unlink(path)
+        backend.write_many(samples, ts=20)
+        self.assertEqual(len(self.fake.updates), 1)
+        backend.write_many(samples, ts=30)
+        self.assertEqual(self.fake.updates, [path, path])
@@ -0,0 +1,182 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+
+from peewee import SqliteDatabase, CharField, IntegerField
+
+from netspryte.manager import Manager, IdentityMap, copy_field
+from netspryte.model import DB_PROXY, BaseModel, Collector, LatestMetric, Host, MeasurementInstance
+
+
+class Widget(BaseModel):
+    name = CharField(unique=True)
+    size = IntegerField(null=True)
+    note = CharField(null=True)
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCursor(object):
+    ''' records the statements and COPY input a Manager sends to Postgres '''
+
+    def __init__(self):
+        self.statements = list()
+        self.copied = None
+
+    def execute(self, sql):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql, buf):
+        self.statements.append(sql)
+        self.copied = buf.read()
+
+
+class TestManager(unittest.TestCase):
+    '''
+    Runs the Manager against an in-memory SQLite database.  The Manager is
+    made without __init__, which connects to the configured database and
+    creates the real tables.
+    '''
+
+    def setUp(self):
+        self.database = SqliteDatabase(':memory:')
+        DB_PROXY.initialize(self.database)
+        self.database.connect()
+        self.database.create_tables([Widget, Collector, LatestMetric])
+        self.mgr = object.__new__(Manager)
+        self.mgr.engine = 'sqlite'
+        self.mgr.name = ':memory:'
+        self.mgr.database = self.database
+
+    def tearDown(self):
+        self.database.close()
+
+    def widgets(self):
+        return dict((w.name, (w.size, w.note)) for w in Widget.select())
+
+    def test_bulk_upsert(self):
+        self.assertEqual(self.mgr.bulk_upsert(Widget, []), dict())
+        ids = self.mgr.bulk_upsert(Widget, [dict(name="a", size=1, note="first"), dict(name="b", size=2)])
+        self.assertEqual(sorted(ids), ["a", "b"])
+        self.assertEqual(self.widgets(), {"a": (1, "first"), "b": (2, None)})
+        # conflicting rows update the existing ones and keep their ids;
+        # fields left out of a row are not touched
+        again = self.mgr.bulk_upsert(Widget, [dict(name="a", size=10), dict(name="c", size=3, note="new")])
+        self.assertEqual(again["a"], ids["a"])
+        self.assertEqual(self.widgets(), {"a": (10, "first"), "b": (2, None), "c": (3, "new")})
+        # rows of nothing but the key leave existing rows alone
+        self.assertEqual(self.mgr.bulk_upsert(Widget, [dict(name="a"), dict(name="d")]),
+                         {"a": ids["a"], "d": again["c"] + 1})
+        self.assertEqual(self.widgets()["a"], (10, "first"))
+
+    def test_bulk_upsert_fill(self):
+        self.mgr.bulk_upsert(Widget, [dict(name="a", note="first"), dict(name="b")])
+        self.mgr.bulk_upsert(Widget, [dict(name="a", note="second"), dict(name="b", note="second")],
+                             fill=('note',))
+        self.assertEqual(self.widgets(), {"a": (None, "first"), "b": (None, "second")})
+
+    def test_bulk_upsert_no_returning(self):
+        self.assertEqual(self.mgr.bulk_upsert(Widget, [dict(name="a", size=1)], returning=False), dict())
+        self.assertEqual(self.widgets(), {"a": (1, None)})
+
+    def test_update_by_id(self):
+        ids = self.mgr.bulk_upsert(Widget, [dict(name=n, size=0) for n in "abc"])
+        self.assertEqual(self.mgr.update_by_id(Widget, [ids["a"], ids["c"], 999], size=5), 2)
+        self.assertEqual(self.widgets(), {"a": (5, None), "b": (0, None), "c": (5, None)})
+
+    def test_copy_upsert_nulls(self):
+        self.assertEqual(copy_field(None), '')
+        self.assertEqual(copy_field(''), '""')
+        self.assertEqual(copy_field('say "hi"'), '"say ""hi"""')
+        cursor = FakeCursor()
+        self.mgr.database = Row(cursor=lambda: cursor)
+        updated = datetime.datetime(2017, 1, 2, 3, 4, 5)
+        rows = [dict(measurement_instance=1, name="upsBatteryStatus", value=None, updated=updated),
+                dict(measurement_instance=2, name="", value=5, updated=updated)]
+        fields = ('measurement_instance', 'name', 'updated', 'value')
+        self.mgr._copy_upsert(LatestMetric, fields, rows, ('measurement_instance', 'name'), ())
+        # a NULL value is an unquoted empty field, which COPY reads as NULL;
+        # an empty string is quoted so it stays an empty string
+        self.assertEqual(cursor.copied.splitlines(),
+                         ['"1","upsBatteryStatus","2017-01-02T03:04:05",',
+                          '"2","","2017-01-02T03:04:05","5.000000"'])
+        self.assertTrue(cursor.statements[-1].endswith(
+            'ON CONFLICT ("measurement_instance_id", "name") DO UPDATE SET '
+            '"updated" = EXCLUDED."updated", "value" = EXCLUDED."value"'))
+
+    def test_latest_metrics(self):
+        metrics = {1: dict(ifInOctets=5, ifOutOctets=None), 2: dict(ifInOctets=7)}
+        self.assertEqual(self.mgr.write_latest_metrics(metrics), 3)
+        self.assertEqual(self.mgr.get_latest_metrics([1, 2, 3]),
+                         {1: dict(ifInOctets=5, ifOutOctets=None), 2: dict(ifInOctets=7)})
+        # a new sample replaces the last one rather than adding a row
+        self.mgr.write_latest_metrics({1: dict(ifInOctets=6)})
+        self.assertEqual(self.mgr.get_latest_metrics([1])[1]['ifInOctets'], 6)
+        self.assertEqual(LatestMetric.select().count(), 3)
+
+    def test_collector_heartbeats(self):
+        self.mgr.heartbeat("collector-b")
+        self.mgr.heartbeat("collector-a")
+        self.mgr.heartbeat("collector-a")
+        self.assertEqual(Collector.select().count(), 2)
+        self.assertEqual(self.mgr.get_collectors(60), ["collector-a", "collector-b"])
+        # a collector that stopped sending heartbeats drops out after timeout
+        stale = datetime.datetime.now() - datetime.timedelta(seconds=120)
+        Collector.update(heartbeat=stale).where(Collector.name == "collector-b").execute()
+        self.assertEqual(self.mgr.get_collectors(60), ["collector-a"])
+        self.mgr.heartbeat("collector-b")
+        self.assertEqual(self.mgr.get_collectors(60), ["collector-a", "collector-b"])
+        self.mgr.retire_collector("collector-a")
+        self.mgr.retire_collector("collector-x")
+        self.assertEqual(self.mgr.get_collectors(60), ["collector-b"])
+
+    def test_identity_map(self):
+        identity = IdentityMap()
+        fields = dict(attrs={"ifName": "ge-0/0/0", "ifSpeed": "1000"}, presentation={"title": "uplink"})
+        self.assertEqual(sorted(identity.changed(MeasurementInstance, "a", fields)), ["attrs", "presentation"])
+        identity.put(MeasurementInstance, "a", 1, fields)
+        self.assertEqual(len(identity), 1)
+        self.assertEqual(identity.get(MeasurementInstance, "a")['id'], 1)
+        # the same values in another order are unchanged
+        same = dict(attrs={"ifSpeed": "1000", "ifName": "ge-0/0/0"}, presentation={"title": "uplink"})
+        self.assertEqual(identity.changed(MeasurementInstance, "a", same), [])
+        self.assertEqual(identity.changed(MeasurementInstance, "a", dict(attrs={"ifName": "ge-0/0/1"})),
+                         ["attrs"])
+        # rows are kept apart by model
+        self.assertIsNone(identity.get(Host, "a"))
+
+    def test_identity_map_forget(self):
+        identity = IdentityMap()
+        identity.put(MeasurementInstance, "a", 1, dict(attrs={}))
+        identity.put(MeasurementInstance, "b", 2, dict(attrs={}))
+        identity.put(Host, "router", 3, obj="host")
+        identity.forget(MeasurementInstance, "a")
+        self.assertIsNone(identity.get(MeasurementInstance, "a"))
+        self.assertIsNotNone(identity.get(MeasurementInstance, "b"))
+        identity.forget(MeasurementInstance)
+        self.assertEqual(len(identity), 1)
+        self.assertEqual(identity.get(Host, "router")['obj'], "host")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import netspryte.utils.profile as profile
+from netspryte.commands import BaseCommand
+
+
+def spin(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class SpinCommand(BaseCommand):
+    def run(self):
+        spin(0.1)
+        return 0
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.profiledir = tempfile.mkdtemp()
+        self.argv = sys.argv
+
+    def tearDown(self):
+        profile._config = None
+        sys.argv = self.argv
+        shutil.rmtree(self.profiledir)
+
+    def folded(self, name):
+        return profile.read_folded(os.path.join(self.profiledir, "%s.folded" % name))
+
+    def test_not_configured(self):
+        with profile.profiled("worker"):
+            spin(0.01)
+        self.assertEqual(os.listdir(self.profiledir), [])
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, profile.configure, self.profiledir, "dtrace")
+        self.assertIsNone(profile._config)
+
+    def test_sample(self):
+        profile.configure(self.profiledir, "sample")
+        with profile.profiled("worker"):
+            spin(0.2)
+        stacks = self.folded("worker")
+        self.assertTrue(any("spin (TestProfile.py" in stack for stack in stacks))
+        self.assertTrue(all(stack.startswith("MainThread;") for stack in stacks))
+
+    def test_cprofile_and_merge(self):
+        profile.configure(self.profiledir, "cprofile")
+        for name in ("worker-1", "worker-2"):
+            with profile.profiled(name):
+                spin(0.01)
+        profile.write_folded({"MainThread;main;spin": 3}, os.path.join(self.profiledir, "worker-3.folded"))
+        profile.write_folded({"MainThread;main;spin": 2, "MainThread;main": 1},
+                             os.path.join(self.profiledir, "worker-4.folded"))
+        stats = profile.merge(self.profiledir)
+        self.assertTrue(any(func == "spin" for filename, line, func in stats.stats))
+        self.assertEqual(self.folded("merged"), {"MainThread;main;spin": 5, "MainThread;main": 1})
+        # merging again leaves the earlier merged files out
+        profile.merge(self.profiledir)
+        self.assertEqual(self.folded("merged"), {"MainThread;main;spin": 5, "MainThread;main": 1})
+        self.assertTrue(os.path.exists(os.path.join(self.profiledir, "merged.pstats")))
+
+    def test_profile_option(self):
+        sys.argv = ["netspryte-spin", "--profile", self.profiledir]
+        self.assertEqual(SpinCommand().execute(), 0)
+        stacks = self.folded("netspryte-spin-main")
+        self.assertTrue(any("spin (TestProfile.py" in stack for stack in stacks))
+
+
+if __name__ == '__main__':
+    unittest.main()
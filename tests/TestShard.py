@@ -0,0 +1,79 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from netspryte.shard import HashRing, Shard
+
+
+class FakeManager(object):
+    ''' keeps collector heartbeats the way Manager does, without a database '''
+
+    def __init__(self):
+        self.collectors = dict()
+
+    def heartbeat(self, name):
+        self.collectors[name] = True
+
+    def get_collectors(self, timeout):
+        return [name for name, alive in self.collectors.items() if alive]
+
+    def retire_collector(self, name):
+        self.collectors.pop(name, None)
+
+    def get_all(self, cls):
+        raise AssertionError("sharding should not look at Host records")
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = ["router%s.example.com" % i for i in range(300)]
+
+    def test_ring_spreads_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = dict((node, 0) for node in ring.nodes)
+        for device in self.devices:
+            counts[ring.get(device)] += 1
+        for node, count in counts.items():
+            self.assertGreater(count, len(self.devices) / 6)
+
+    def test_ring_remove_only_moves_its_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((device, ring.get(device)) for device in self.devices)
+        ring.remove('b')
+        for device in self.devices:
+            if before[device] != 'b':
+                self.assertEqual(ring.get(device), before[device])
+            else:
+                self.assertIn(ring.get(device), ('a', 'c'))
+        self.assertEqual(HashRing().get('anything'), None)
+
+    def test_shard_failover(self):
+        mgr = FakeManager()
+        shards = [Shard('a'), Shard('b')]
+        for shard in shards:
+            shard.heartbeat(mgr)
+        polled = [shard.devices(mgr, self.devices) for shard in shards]
+        self.assertEqual(sorted(polled[0] + polled[1]), sorted(self.devices))
+        self.assertFalse(set(polled[0]) & set(polled[1]))
+        # b stops sending heartbeats; a takes over its devices
+        mgr.collectors['b'] = False
+        self.assertEqual(shards[0].devices(mgr, self.devices), sorted(self.devices))
+        shards[0].retire(mgr)
+        self.assertNotIn('a', mgr.collectors)
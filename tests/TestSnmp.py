@@ -20,20 +20,59 @@ import unittest
 import json
 import os
 import sys
+import tempfile
+import time
+
+from pysnmp.proto.rfc1902 import Integer, ObjectIdentifier
 
 import netspryte
 import netspryte.snmp
 from netspryte import constants as C
 from netspryte.errors import *
 from netspryte.snmp.host.interface import HostInterface
+from netspryte.snmp.host.ups import HostUPS
 from netspryte.snmp.vendor.cisco.cbqos import CiscoCBQOS
 from netspryte.plugins import snmp_module_loader
 
 
+class FakeSNMPSession(object):
+    ''' answers walks from a dictionary of oid to value and counts queries '''
+
+    def __init__(self, data):
+        self.host = "fake"
+        self.data = data
+        self.walks = list()
+
+    def walk(self, *oids):
+        self.walks.append(oids)
+        return [(k, v) for k, v in sorted(self.data.items())
+                if any(k.startswith(oid + ".") for oid in oids)]
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCatalog(object):
+    ''' hands back instances discovery recorded at indexes, with stand-in attributes '''
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def get_instances_by_host_and_class(self, host, cls):
+        return [Row(index=index, attrs={'upsIdentManufacturer': 'cached'}, presentation=dict())
+                for index in self.indexes]
+
+
 class TestSnmp(unittest.TestCase):
 
     def setUp(self):
         self.msnmp = netspryte.snmp.SNMPSession()
+        self.statedir = C.DEFAULT_SNMP_STATEDIR
+
+    def tearDown(self):
+        C.DEFAULT_SNMP_STATEDIR = self.statedir
 
     def test_snmp_port_is_not_integer(self):
         with self.assertRaises(ValueError):
@@ -89,3 +128,186 @@ class TestSnmp(unittest.TestCase):
         snmp_modules = snmp_module_loader.all()
         for cls, module in snmp_modules.items():
             mod = cls(msnmp)
+
+    def test_collection_context_walks_columns_once(self):
+        fake = FakeSNMPSession({'1.3.6.1.2.1.2.2.1.2.1': 'eth0',
+                                '1.3.6.1.2.1.2.2.1.2.2': 'eth1',
+                                '1.3.6.1.2.1.2.2.1.20.1': 5})
+        ctx = netspryte.snmp.CollectionContext(fake)
+        self.assertEqual(len(ctx.walk('1.3.6.1.2.1.2.2.1.2')), 2)
+        self.assertEqual(len(ctx.walk('1.3.6.1.2.1.2.2.1.2', '1.3.6.1.2.1.2.2.1.20')), 3)
+        self.assertEqual(fake.walks, [('1.3.6.1.2.1.2.2.1.2',), ('1.3.6.1.2.1.2.2.1.20',)])
+
+    def test_deconstruct_oid_shared_prefix(self):
+        oid_set = {'ifDescr': '1.3.6.1.2.1.2.2.1.2', 'ifOutErrors': '1.3.6.1.2.1.2.2.1.20'}
+        oid = netspryte.snmp.deconstruct_oid('1.3.6.1.2.1.2.2.1.20.12', oid_set)
+        self.assertEqual(oid['name'], 'ifOutErrors')
+        self.assertEqual(oid['index'], '12')
+        oid = netspryte.snmp.deconstruct_oid('1.3.6.1.2.1.2.2.1.2.3.4', oid_set)
+        self.assertEqual(oid['name'], 'ifDescr')
+        self.assertEqual(oid['index'], '3.4')
+
+    def test_deconstruct_oid_no_match(self):
+        oid_set = {'ifDescr': '1.3.6.1.2.1.2.2.1.2'}
+        self.assertNotIn('index', netspryte.snmp.deconstruct_oid('1.3.6.1.2.1.2.2.1.2', oid_set))
+        self.assertNotIn('index', netspryte.snmp.deconstruct_oid('1.3.6.1.2.1.2.2.1.3.1', oid_set))
+
+    def test_oid_trie_cache(self):
+        oid_set = {'ifDescr': '1.3.6.1.2.1.2.2.1.2'}
+        trie = netspryte.snmp.get_oid_trie(oid_set)
+        # dicts of the same OIDs share a trie, whatever their identity
+        self.assertIs(netspryte.snmp.get_oid_trie(dict(oid_set)), trie)
+        for i in range(netspryte.snmp._OID_TRIES_SIZE + 10):
+            netspryte.snmp.get_oid_trie({'ifDescr': '1.3.6.1.2.1.2.2.1.2.%s' % i})
+        self.assertEqual(len(netspryte.snmp._OID_TRIES), netspryte.snmp._OID_TRIES_SIZE)
+        self.assertIsNot(netspryte.snmp.get_oid_trie(oid_set), trie)
+
+    def test_cached_instances(self):
+        data = {'1.3.6.1.2.1.1.5.0': 'ups', '1.3.6.1.2.1.33.1.1.1.0': 'acme',
+                '1.3.6.1.2.1.33.1.2.1.0': Integer(2), '1.3.6.1.2.1.33.1.2.4.0': Integer(90)}
+        # cached instances that did not answer are left out
+        ups = HostUPS(netspryte.snmp.CollectionContext(FakeSNMPSession(data), FakeCatalog(['0', '1'])))
+        self.assertEqual([inst['index'] for inst in ups.data], ['0'])
+        self.assertEqual(ups.data[0]['attrs'], {'upsIdentManufacturer': 'cached'})
+        self.assertEqual(ups.data[0]['metrics']['upsBatteryStatus'], 'batteryNormal')
+        # an index discovery has not recorded has its attributes walked again
+        ups = HostUPS(netspryte.snmp.CollectionContext(FakeSNMPSession(data), FakeCatalog(['1'])))
+        self.assertEqual([inst['index'] for inst in ups.data], ['0'])
+        self.assertEqual(ups.data[0]['attrs']['upsIdentManufacturer'], 'acme')
+
+    def test_adaptive_bulk(self):
+        bulk = netspryte.snmp.AdaptiveBulk(20)
+        bulk.update(2, 20, 0.01)
+        self.assertEqual(bulk.value, 20)
+        bulk.update(2, 400, 0.01)
+        self.assertEqual(bulk.value, 20 + C.DEFAULT_SNMP_BULK_STEP)
+        self.assertFalse(bulk.backoff("noSuchName"))
+        self.assertTrue(bulk.backoff("tooBig"))
+        self.assertEqual(bulk.value, (20 + C.DEFAULT_SNMP_BULK_STEP) // 2)
+        # an unreachable device keeps its learned value
+        value = bulk.value
+        self.assertFalse(bulk.backoff("No SNMP response received before timeout"))
+        self.assertEqual(bulk.value, value)
+        self.assertTrue(bulk.backoff("No SNMP response received before timeout", responded=True))
+        self.assertEqual(bulk.value, max(C.DEFAULT_SNMP_BULK_MIN, value // 2))
+
+    def test_circuit_breaker(self):
+        timeout = "No SNMP response received before timeout"
+        breaker = netspryte.snmp.CircuitBreaker()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.failure("noSuchName"))
+        self.assertTrue(breaker.failure(timeout))
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.failures, 1)
+        # the next cycle fails fast until the backoff delay has passed
+        breaker.reset()
+        self.assertFalse(breaker.allow())
+        # then one probe is let through; another timeout trips it again for longer
+        breaker.state.update(retry_after=time.time() - 1)
+        breaker.reset()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure(timeout))
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.failures, 2)
+        self.assertGreater(breaker.retry_after, time.time() + C.DEFAULT_SNMP_BACKOFF)
+        # an answer to the probe resets it
+        breaker.state.update(retry_after=time.time() - 1)
+        breaker.reset()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.failures, 0)
+        self.assertFalse(breaker.failure(timeout))
+        # and a device that answered in one cycle can still trip in the next
+        breaker.reset()
+        self.assertTrue(breaker.failure(timeout))
+        self.assertFalse(breaker.allow())
+
+    def test_snmp_cache(self):
+        cache = netspryte.snmp.SNMPCache(size=2, timeout=60)
+        cache.set_policy('1.3.6.1.2.1.4.34', 3600)
+        cache.set_policy('1.3.6.1.2.1.2.2.1.10', 0)
+        self.assertEqual(cache.ttl(['1.3.6.1.2.1.4.34.1.3']), 3600)
+        self.assertEqual(cache.ttl(['1.3.6.1.2.1.4.34.1.3', '1.3.6.1.2.1.1.5']), 60)
+        self.assertEqual(cache.ttl(['1.3.6.1.2.1.2.2.1.10']), 0)
+        cache.put(('nextCmd', ('1.3.6.1.2.1.2.2.1.10',)), ['counter'], 0)
+        self.assertEqual(cache.get(('nextCmd', ('1.3.6.1.2.1.2.2.1.10',))), None)
+        for n in range(3):
+            cache.put(('getCmd', ('1.3.6.1.2.1.1.%s' % n,)), [n], 60)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(('getCmd', ('1.3.6.1.2.1.1.0',))), None)
+        self.assertEqual(cache.get(('getCmd', ('1.3.6.1.2.1.1.2',))), [2])
+        cache.invalidate('1.3.6.1.2.1.1')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_walk_store(self):
+        from netspryte.snmp.store import WalkStore
+        path = os.path.join(tempfile.mkdtemp(), "cache.db")
+        store = WalkStore(path)
+        store.open()
+        key = ('nextCmd', ('1.3.6.1.2.1.4.34.1.3',))
+        cache = netspryte.snmp.SNMPCache(store=store, host='router')
+        cache.put(key, [('1.3.6.1.2.1.4.34.1.3.1.4.10.0.0.1', 3)], 3600)
+        other = WalkStore(path)
+        other.open()
+        cache = netspryte.snmp.SNMPCache(store=other, host='router')
+        self.assertEqual(cache.get(key), [('1.3.6.1.2.1.4.34.1.3.1.4.10.0.0.1', 3)])
+        cache.invalidate('1.3.6.1.2.1.4.34')
+        self.assertEqual(store.get('router', key), None)
+
+    def test_device_profile(self):
+        class ProfiledSession(object):
+            host = 'router'
+            def get(self, *oids):
+                return [(oids[0], ObjectIdentifier('1.3.6.1.4.1.9.1.1'))]
+            def probe(self, oid):
+                return oid.startswith('1.3.6.1.4.1.9.')
+        profile = netspryte.snmp.DeviceProfile(ProfiledSession())
+        self.assertTrue(profile.applies(CiscoCBQOS))
+        self.assertFalse(profile.applies(HostUPS))
+        self.assertTrue(profile.applies(HostInterface))
+        self.assertEqual(profile.state.get('profile')['sysObjectID'], '1.3.6.1.4.1.9.1.1')
+
+    def test_simulated_agent(self):
+        from netspryte.snmp.simulator import SNMPAgent, Fixture, mk_device, record
+        C.DEFAULT_SNMP_STATEDIR = tempfile.mkdtemp()
+        device = mk_device('sim', interfaces=4)
+        with SNMPAgent(device, max_varbinds=10) as agent:
+            snmp = netspryte.snmp.SNMPSession(host='127.0.0.1', port=agent.port, community='public',
+                                              version='2c', timeout=1, retries=0)
+            self.assertEqual(snmp.get('1.3.6.1.2.1.1.5.0')[0][1], 'sim')
+            self.assertEqual(len(snmp.walk('1.3.6.1.2.1.31.1.1.1.1')), 4)
+            path = os.path.join(tempfile.mkdtemp(), "sim.snmprec")
+            count = record(snmp, path, ('1.3.6.1.2.1.1', '1.3.6.1.2.1.2.2.1.6'))
+        recorded = Fixture.load(path)
+        self.assertEqual(len(recorded), count)
+        self.assertEqual(count, 10)
+        # values are recorded as sent, not as decoded for display
+        for oid in ('1.3.6.1.2.1.1.2.0', '1.3.6.1.2.1.1.5.0', '1.3.6.1.2.1.2.2.1.6.1'):
+            self.assertEqual(type(recorded.get(oid)), type(device.get(oid)))
+            self.assertEqual(recorded.get(oid), device.get(oid))
+
+    def test_microbench(self):
+        import netspryte.microbench
+        tables = netspryte.microbench.mk_tables(interfaces=4, policers=4, entities=4)
+        results = netspryte.microbench.run(tables, repeat=1)
+        self.assertEqual(set(r['function'] for r in results if r['table'] == 'interface'),
+                         set(['deconstruct_oid', 'strip_oid', '_snmp_varbind_to_list', 'mk_pretty_value',
+                              'json_ready', 'xlate_metric_names', 'clean_metric_name']))
+        self.assertEqual(netspryte.microbench.compare(results, results), [])
+
+    def test_mk_tasks(self):
+        from netspryte.commands import mk_tasks
+        from netspryte.snmp.store import get_task_history
+        C.DEFAULT_SNMP_STATEDIR = tempfile.mkdtemp()
+        history = get_task_history()
+        history.record('small', 'interface', 1.0)
+        history.record('small', 'cbqos', 1.0)
+        history.record('big', 'interface', 10.0)
+        # cbqos is known not to apply to big, so it is left out of its task
+        netspryte.snmp.DeviceState.for_host('big').set('profile', dict(
+            updated=time.time(), sysObjectID='1.3.6.1.4.1.9.1.1', mibs={'1.3.6.1.4.1.9.9.166': False}))
+        tasks = mk_tasks(['small', 'big', 'new'], [HostInterface, CiscoCBQOS])
+        self.assertEqual(tasks, [('new', ['interface', 'cbqos']),
+                                 ('big', ['interface']),
+                                 ('small', ['interface', 'cbqos'])])
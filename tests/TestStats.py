@@ -0,0 +1,110 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import netspryte.utils.stats as stats
+from netspryte import constants as C
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.statsdir = tempfile.mkdtemp()
+        self.enabled = C.DEFAULT_STATS
+        C.DEFAULT_STATS = True
+
+    def tearDown(self):
+        C.DEFAULT_STATS = self.enabled
+        shutil.rmtree(self.statsdir)
+
+    def save(self, name, counts, age=0):
+        ''' save a registry as a process named name would, aged by age seconds '''
+        registry = stats.Registry()
+        registry.bind(os.path.join(self.statsdir, "%s.json" % name))
+        for device, n in counts.items():
+            registry.counter("snmp_timeouts", "timeouts").inc(n, device=device)
+        registry.histogram("poll_seconds", "polls").observe(0.2)
+        registry.gauge("cycle_seconds").set(len(counts))
+        registry.save()
+        if age:
+            then = time.time() - age
+            os.utime(registry.path, (then, then))
+        return registry
+
+    def values(self, merged, name):
+        return dict((tuple(sorted(s['labels'].items())), s.get('value', s.get('count')))
+                    for s in merged[name]['samples'])
+
+    def test_registry_continues_counters(self):
+        self.save("snmp-worker-1", {"a": 2})
+        registry = self.save("snmp-worker-1", {"a": 3})
+        self.assertEqual(self.values(stats.read_stats(self.statsdir), "snmp_timeouts"),
+                         {(('device', 'a'),): 5})
+        self.assertEqual(registry.histogram("poll_seconds").samples()[0]['count'], 2)
+
+    def test_merge(self):
+        self.save("snmp-worker-1", {"a": 2, "b": 1})
+        self.save("snmp-worker-2", {"a": 4})
+        merged = stats.read_stats(self.statsdir)
+        self.assertEqual(self.values(merged, "snmp_timeouts"), {(('device', 'a'),): 6, (('device', 'b'),): 1})
+        self.assertEqual(self.values(merged, "poll_seconds"), {(): 2})
+        self.assertEqual(len(merged["cycle_seconds"]['samples']), 1)
+
+    def test_prune_processes_that_are_gone(self):
+        self.save("snmp-worker-1", {"a": 2})
+        self.save("snmp-worker-9", {"a": 7}, age=C.DEFAULT_STATS_EXPIRE + 60)
+        merged = stats.read_stats(self.statsdir)
+        self.assertEqual(self.values(merged, "snmp_timeouts"), {(('device', 'a'),): 2})
+        self.assertEqual(os.listdir(self.statsdir), ["snmp-worker-1.json"])
+
+    def test_save_interval(self):
+        registry = stats.Registry()
+        registry.bind(os.path.join(self.statsdir, "snmp-worker-1.json"))
+        previous = stats._REGISTRIES.get(os.getpid())
+        stats._REGISTRIES[os.getpid()] = registry
+        try:
+            registry.counter("snmp_timeouts").inc()
+            stats.save(60)
+            registry.counter("snmp_timeouts").inc()
+            # saved less than interval ago, so only an unthrottled save writes
+            stats.save(60)
+            self.assertEqual(self.values(stats.read_stats(self.statsdir), "snmp_timeouts"), {(): 1})
+            stats.save()
+            self.assertEqual(self.values(stats.read_stats(self.statsdir), "snmp_timeouts"), {(): 2})
+        finally:
+            if previous is None:
+                del stats._REGISTRIES[os.getpid()]
+            else:
+                stats._REGISTRIES[os.getpid()] = previous
+
+    def test_openmetrics(self):
+        self.save("snmp-worker-1", {"a": 2})
+        text = stats.openmetrics(stats.read_stats(self.statsdir))
+        self.assertIn('snmp_timeouts_total{device="a"} 2', text.splitlines())
+        self.assertIn('poll_seconds_bucket{le="0.25"} 1', text.splitlines())
+        self.assertIn('poll_seconds_bucket{le="+Inf"} 1', text.splitlines())
+        self.assertTrue(text.endswith("# EOF\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
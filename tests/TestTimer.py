@@ -0,0 +1,91 @@
+# Written by Stephen Fromm <stephenf nero net>
+# Copyright (C) 2015-2017 University of Oregon
+
+# This file is part of netspryte
+#
+# netspryte is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# netspryte is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with netspryte.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from netspryte.utils import timer
+
+
+class TestTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tracedir)
+
+    def write_spans(self, name, durations):
+        stats = timer.SpanStats()
+        for elapsed in durations:
+            stats.add(elapsed)
+        with open(os.path.join(self.tracedir, "spans-%s.json" % name), 'w') as f:
+            json.dump({"poll": stats.summary(samples=True)}, f)
+
+    def test_read_spans_merges_percentiles(self):
+        # one busy process with fast spans, more than its reservoir holds,
+        # and one quiet process with slow spans
+        self.write_spans("busy", [0.001] * 10000)
+        self.write_spans("quiet", [1.0] * 100)
+        merged = timer.read_spans(self.tracedir)["poll"]
+        self.assertEqual(merged['count'], 10100)
+        self.assertEqual(merged['max'], 1.0)
+        self.assertEqual(merged['p50'], 0.001)
+        self.assertEqual(merged['p90'], 0.001)
+        self.assertEqual(merged['p99'], 0.001)
+        self.assertNotIn('samples', merged)
+
+    def test_read_spans_slow_tail(self):
+        self.write_spans("fast", [0.001] * 90)
+        self.write_spans("slow", [1.0] * 10)
+        merged = timer.read_spans(self.tracedir)["poll"]
+        self.assertEqual(merged['p50'], 0.001)
+        self.assertEqual(merged['p90'], 1.0)
+        self.assertEqual(merged['p99'], 1.0)
+
+    def test_write_json_replaces_whole_file(self):
+        path = os.path.join(self.tracedir, "spans-test.json")
+        timer._write_json({"old": 1}, path)
+        self.assertRaises(TypeError, timer._write_json, {"new": object()}, path)
+        with open(path) as f:
+            self.assertEqual(json.load(f), {"old": 1})
+        self.assertEqual(os.listdir(self.tracedir), ["spans-test.json"])
+
+    def test_export_interval(self):
+        path = os.path.join(self.tracedir, "spans-interval.json")
+        timer.export("interval", self.tracedir, interval=60)
+        self.assertTrue(os.path.exists(path))
+        os.remove(path)
+        # written again at once only without an interval
+        timer.export("interval", self.tracedir, interval=60)
+        self.assertFalse(os.path.exists(path))
+        timer.export("interval", self.tracedir)
+        self.assertTrue(os.path.exists(path))
+
+    def test_weighted_percentile(self):
+        self.assertEqual(timer.weighted_percentile([], 50), 0.0)
+        samples = [(float(i), 1) for i in range(100)]
+        self.assertEqual(timer.weighted_percentile(samples, 50), 50.0)
+        self.assertEqual(timer.weighted_percentile([(1.0, 1), (2.0, 3)], 50), 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
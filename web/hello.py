@@ -23,9 +23,9 @@ import operator
 import time
 import urllib.parse
 
-from netspryte.utils import get_db_backend
+from netspryte.utils import get_db_backend, json_ready
 from netspryte import constants as C
-from netspryte.manager import MeasurementInstance, MeasurementClass, Manager, Tag, Host
+from netspryte.manager import MeasurementInstance, MeasurementClass, Manager, Tag, Host, LatestMetric
 from netspryte.db.rrd import *
 
 LIMIT = 10
@@ -218,11 +218,16 @@ def get_measurement_classes():
 
 @app.route('/api/v1.0/instance/<arg>', methods=['GET'])
 def get_measurement_instance(arg):
+    ''' return a measurement instance, with the metrics of its latest sample '''
     mgr = Manager()
     modinst = mgr.get(MeasurementInstance, name=arg)
     if not modinst:
-        modinst = dict()
-    return jsonify(mgr.to_dict(modinst))
+        return jsonify({})
+    result = mgr.to_dict(modinst)
+    latest = mgr.get_latest_metrics([modinst])
+    if modinst.id in latest:
+        result['metrics'] = json_ready(latest[modinst.id])
+    return jsonify(result)
 
 
 @app.route('/api/v1.0/instances', methods=['GET'])
@@ -254,7 +259,8 @@ def close_db(error):
 
 def filter_measurement_instance_clauses():
     clauses = [
-        (MeasurementInstance.metrics.is_null(False)),
+        ((MeasurementInstance.metrics.is_null(False)) |
+         (MeasurementInstance.id << LatestMetric.select(LatestMetric.measurement_instance))),
         (MeasurementInstance.presentation['title'].is_null(False)),
         (MeasurementInstance.presentation['description'].is_null(False)),
         (MeasurementInstance.presentation['title'] != ""),